@@ -129,6 +129,12 @@ class QubesVm(object):
                 'xml_deserialize': lambda _x: QubesVmLabels[_x] },
             "memory": { "default": defaults["memory"], 'order': 20 },
             "maxmem": { "default": None, 'order': 25 },
+            # memory QoS for qmemman: share of free memory relative to other
+            # VMs (100 - default), guaranteed memory (MB) and priority tier
+            # when there is not enough memory for all VMs (higher first)
+            "memory_weight": { "default": 100, "func": int },
+            "memory_min": { "default": 0, "func": int },
+            "memory_tier": { "default": 1, "func": int },
             "pcidevs": {
                 "default": '[]',
                 "order": 25,
@@ -197,7 +203,7 @@ class QubesVm(object):
         ### Mark attrs for XML inclusion
         # Simple string attrs
         for prop in ['qid', 'uuid', 'name', 'dir_path', 'memory', 'maxmem',
-            'pcidevs', 'pci_strictreset', 'vcpus', 'internal',\
+            'memory_weight', 'memory_min', 'memory_tier', 'pcidevs', 'pci_strictreset', 'vcpus', 'internal',\
             'uses_default_kernel', 'kernel', 'uses_default_kernelopts',\
             'kernelopts', 'services', 'installed_by_rpm',\
             'uses_default_netvm', 'include_in_backups', 'debug',\
@@ -1138,6 +1144,16 @@ class QubesVm(object):
         if qmemman_present:
             vmm.xs.set_permissions('', '/local/domain/{0}/memory'.format(self.xid),
                     [{ 'dom': self.xid }])
+            # memory QoS settings - owned by dom0, so the VM cannot change
+            # them
+            qos_path = '/local/domain/{0}/qmemman'.format(self.xid)
+            vmm.xs.mkdir('', qos_path)
+            vmm.xs.set_permissions('', qos_path,
+                    [{ 'dom': 0 }, { 'dom': self.xid, 'read': True }])
+            vmm.xs.write('', qos_path + '/weight', str(self.memory_weight))
+            vmm.xs.write('', qos_path + '/min-memory',
+                    str(self.memory_min * 1024))
+            vmm.xs.write('', qos_path + '/tier', str(self.memory_tier))
 
         # fire hooks
         for hook in self.hooks_create_qubesdb_entries:
@@ -1315,7 +1331,8 @@ class QubesVm(object):
 
     def get_clone_attrs(self):
         attrs = ['kernel', 'uses_default_kernel', 'netvm', 'uses_default_netvm',
-                 'memory', 'maxmem', 'kernelopts', 'uses_default_kernelopts',
+                 'memory', 'maxmem', 'memory_weight', 'memory_min',
+                 'memory_tier', 'kernelopts', 'uses_default_kernelopts',
                  'services', 'vcpus', '_mac', 'pcidevs', 'include_in_backups',
                  '_label', 'default_user', 'qrexec_timeout']
 
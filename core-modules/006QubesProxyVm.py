@@ -113,6 +113,69 @@ class QubesProxyVm(QubesNetVm):
             self.qdb.write("/qubes-netvm-domid",
                     "{0}".format(self.netvm.get_xid()))
 
+    def get_vm_iptables_rules(self, vm):
+        """
+        Generate iptables rules for a single VM connected to this ProxyVM.
+
+        :param vm: VM connected to this ProxyVM
+        :return: rules in iptables-restore format, or None when the VM has
+            no IP address
+        """
+        iptables="*filter\n"
+        conf = vm.get_firewall_conf()
+
+        ip = vm.ip
+        if ip is None:
+            return None
+
+        # Anti-spoof rules are added by vif-script (vif-route-qubes), here we trust IP address
+
+        accept_action = "ACCEPT"
+        reject_action = "REJECT --reject-with icmp-host-prohibited"
+
+        if conf["allow"]:
+            default_action = accept_action
+            rules_action = reject_action
+        else:
+            default_action = reject_action
+            rules_action = accept_action
+
+        for rule in conf["rules"]:
+            iptables += "-A FORWARD -s {0} -d {1}".format(ip, rule["address"])
+            if rule["netmask"] != 32:
+                iptables += "/{0}".format(rule["netmask"])
+
+            if rule["proto"] is not None and rule["proto"] != "any":
+                iptables += " -p {0}".format(rule["proto"])
+                if rule["portBegin"] is not None and rule["portBegin"] > 0:
+                    iptables += " --dport {0}".format(rule["portBegin"])
+                    if rule["portEnd"] is not None and rule["portEnd"] > rule["portBegin"]:
+                        iptables += ":{0}".format(rule["portEnd"])
+
+            iptables += " -j {0}\n".format(rules_action)
+
+        if conf["allowDns"] and self.netvm is not None:
+            # PREROUTING does DNAT to NetVM DNSes, so we need self.netvm.
+            # properties
+            iptables += "-A FORWARD -s {0} -p udp -d {1} --dport 53 -j " \
+                        "ACCEPT\n".format(ip,self.netvm.gateway)
+            iptables += "-A FORWARD -s {0} -p udp -d {1} --dport 53 -j " \
+                        "ACCEPT\n".format(ip,self.netvm.secondary_dns)
+            iptables += "-A FORWARD -s {0} -p tcp -d {1} --dport 53 -j " \
+                        "ACCEPT\n".format(ip,self.netvm.gateway)
+            iptables += "-A FORWARD -s {0} -p tcp -d {1} --dport 53 -j " \
+                        "ACCEPT\n".format(ip,self.netvm.secondary_dns)
+        if conf["allowIcmp"]:
+            iptables += "-A FORWARD -s {0} -p icmp -j ACCEPT\n".format(ip)
+        if conf["allowYumProxy"]:
+            iptables += "-A FORWARD -s {0} -p tcp -d {1} --dport {2} -j ACCEPT\n".format(ip, yum_proxy_ip, yum_proxy_port)
+        else:
+            iptables += "-A FORWARD -s {0} -p tcp -d {1} --dport {2} -j DROP\n".format(ip, yum_proxy_ip, yum_proxy_port)
+
+        iptables += "-A FORWARD -s {0} -j {1}\n".format(ip, default_action)
+        iptables += "COMMIT\n"
+        return iptables
+
     def write_iptables_qubesdb_entry(self):
         self.qdb.rm("/qubes-iptables-domainrules/")
         iptables =  "# Generated by Qubes Core on {0}\n".format(datetime.now().ctime())
@@ -140,63 +203,13 @@ class QubesProxyVm(QubesNetVm):
 
         vms = [vm for vm in self.connected_vms.values()]
         for vm in vms:
-            iptables="*filter\n"
-            conf = vm.get_firewall_conf()
-
             xid = vm.get_xid()
             if xid < 0: # VM not active ATM
                 continue
 
-            ip = vm.ip
-            if ip is None:
+            iptables = self.get_vm_iptables_rules(vm)
+            if iptables is None:
                 continue
-
-            # Anti-spoof rules are added by vif-script (vif-route-qubes), here we trust IP address
-
-            accept_action = "ACCEPT"
-            reject_action = "REJECT --reject-with icmp-host-prohibited"
-
-            if conf["allow"]:
-                default_action = accept_action
-                rules_action = reject_action
-            else:
-                default_action = reject_action
-                rules_action = accept_action
-
-            for rule in conf["rules"]:
-                iptables += "-A FORWARD -s {0} -d {1}".format(ip, rule["address"])
-                if rule["netmask"] != 32:
-                    iptables += "/{0}".format(rule["netmask"])
-
-                if rule["proto"] is not None and rule["proto"] != "any":
-                    iptables += " -p {0}".format(rule["proto"])
-                    if rule["portBegin"] is not None and rule["portBegin"] > 0:
-                        iptables += " --dport {0}".format(rule["portBegin"])
-                        if rule["portEnd"] is not None and rule["portEnd"] > rule["portBegin"]:
-                            iptables += ":{0}".format(rule["portEnd"])
-
-                iptables += " -j {0}\n".format(rules_action)
-
-            if conf["allowDns"] and self.netvm is not None:
-                # PREROUTING does DNAT to NetVM DNSes, so we need self.netvm.
-                # properties
-                iptables += "-A FORWARD -s {0} -p udp -d {1} --dport 53 -j " \
-                            "ACCEPT\n".format(ip,self.netvm.gateway)
-                iptables += "-A FORWARD -s {0} -p udp -d {1} --dport 53 -j " \
-                            "ACCEPT\n".format(ip,self.netvm.secondary_dns)
-                iptables += "-A FORWARD -s {0} -p tcp -d {1} --dport 53 -j " \
-                            "ACCEPT\n".format(ip,self.netvm.gateway)
-                iptables += "-A FORWARD -s {0} -p tcp -d {1} --dport 53 -j " \
-                            "ACCEPT\n".format(ip,self.netvm.secondary_dns)
-            if conf["allowIcmp"]:
-                iptables += "-A FORWARD -s {0} -p icmp -j ACCEPT\n".format(ip)
-            if conf["allowYumProxy"]:
-                iptables += "-A FORWARD -s {0} -p tcp -d {1} --dport {2} -j ACCEPT\n".format(ip, yum_proxy_ip, yum_proxy_port)
-            else:
-                iptables += "-A FORWARD -s {0} -p tcp -d {1} --dport {2} -j DROP\n".format(ip, yum_proxy_ip, yum_proxy_port)
-
-            iptables += "-A FORWARD -s {0} -j {1}\n".format(ip, default_action)
-            iptables += "COMMIT\n"
             self.qdb.write("/qubes-iptables-domainrules/"+str(xid), iptables)
         # no need for ending -A FORWARD -j DROP, cause default action is DROP
 
@@ -205,4 +218,43 @@ class QubesProxyVm(QubesNetVm):
         self.rules_applied = None
         self.qdb.write("/qubes-iptables", 'reload')
 
+    def add_vm_iptables_qubesdb_entry(self, vm):
+        """
+        Incrementally add (or update) rules of a single running VM, without
+        regenerating rules of other connected VMs.
+
+        The rules header must already be in place (it is written when this
+        ProxyVM starts).
+        """
+        if not self.is_running():
+            return
+
+        xid = vm.get_xid()
+        if xid < 0: # VM not active ATM
+            return
+
+        iptables = self.get_vm_iptables_rules(vm)
+        if iptables is None:
+            return
+        self.qdb.write("/qubes-iptables-domainrules/"+str(xid), iptables)
+
+        self.rules_applied = None
+        self.qdb.write("/qubes-iptables", 'reload')
+
+    def remove_vm_iptables_qubesdb_entry(self, xid):
+        """
+        Incrementally remove rules of a single VM, identified by its xid (VM
+        may be already destroyed at this point).
+        """
+        if not self.is_running():
+            return
+
+        if xid < 0:
+            return
+
+        self.qdb.rm("/qubes-iptables-domainrules/"+str(xid))
+
+        self.rules_applied = None
+        self.qdb.write("/qubes-iptables", 'reload')
+
 register_qubes_vm_class(QubesProxyVm)
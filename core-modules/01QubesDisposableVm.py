@@ -25,11 +25,11 @@
 import os
 import sys
 import libvirt
-import time
 from qubes.qubes import QubesVm,QubesVmLabel,register_qubes_vm_class, \
     QubesException
 from qubes.qubes import QubesDispVmLabels
 from qubes.qubes import dry_run,vmm
+from qubes.dispvmstats import DispVMStats
 import grp
 
 qmemman_present = False
@@ -159,11 +159,19 @@ class QubesDisposableVm(QubesVm):
         self.qdb.write("/qubes-vm-persistence", "none")
         self.qdb.write('/qubes-restore-complete', '1')
 
-    def start(self, verbose = False, **kwargs):
+    def start(self, verbose = False, stats = None, **kwargs):
+        """
+        :param stats: optional DispVMStats object to record startup phases
+        timings in
+        """
         self.log.debug('start()')
         if dry_run:
             return
 
+        if stats is None:
+            # not saved anywhere
+            stats = DispVMStats()
+
         # Intentionally not used is_running(): eliminate also "Paused", "Crashed", "Halting"
         if self.get_power_state() != "Halted":
             raise QubesException ("VM is already running!")
@@ -179,7 +187,7 @@ class QubesDisposableVm(QubesVm):
         if verbose:
             print >> sys.stderr, "--> Loading the VM (type = {0})...".format(self.type)
 
-        print >>sys.stderr, "time=%s, creating config file" % (str(time.time()))
+        stats.begin('restore')
         # refresh config file
         domain_config = self.create_config_file()
 
@@ -188,22 +196,21 @@ class QubesDisposableVm(QubesVm):
         # dispvm cannot have PCI devices
         assert (len(self.pcidevs) == 0), "DispVM cannot have PCI devices"
 
-        print >>sys.stderr, "time=%s, calling restore" % (str(time.time()))
         vmm.libvirt_conn.restoreFlags(self.disp_savefile,
                 domain_config, libvirt.VIR_DOMAIN_SAVE_PAUSED)
 
-        print >>sys.stderr, "time=%s, done" % (str(time.time()))
         self._libvirt_domain = None
+        stats.end('restore')
 
         if verbose:
             print >> sys.stderr, "--> Starting Qubes DB..."
+        stats.begin('qubesdb')
         self.start_qubesdb()
 
         self.services['qubes-dvm'] = True
         if verbose:
             print >> sys.stderr, "--> Setting Qubes DB info for the VM..."
         self.create_qubesdb_entries()
-        print >>sys.stderr, "time=%s, done qubesdb" % (str(time.time()))
 
         # fire hooks
         for hook in self.hooks_start:
@@ -212,7 +219,7 @@ class QubesDisposableVm(QubesVm):
         if verbose:
             print >> sys.stderr, "--> Starting the VM..."
         self.libvirt_domain.resume()
-        print >>sys.stderr, "time=%s, resumed" % (str(time.time()))
+        stats.end('qubesdb')
 
 # close() is not really needed, because the descriptor is close-on-exec
 # anyway, the reason to postpone close() is that possibly xl is not done
@@ -223,17 +230,21 @@ class QubesDisposableVm(QubesVm):
             qmemman_client.close()
 
         if kwargs.get('start_guid', True) and os.path.exists('/var/run/shm.id'):
+            stats.begin('guid')
             self.start_guid(verbose=verbose, before_qrexec=True,
                     notify_function=kwargs.get('notify_function', None))
+            stats.end('guid')
 
+        stats.begin('qrexec')
         self.start_qrexec_daemon(verbose=verbose,
                 notify_function=kwargs.get('notify_function', None))
-        print >>sys.stderr, "time=%s, qrexec done" % (str(time.time()))
+        stats.end('qrexec')
 
         if kwargs.get('start_guid', True) and os.path.exists('/var/run/shm.id'):
+            stats.begin('guid')
             self.start_guid(verbose=verbose,
                     notify_function=kwargs.get('notify_function', None))
-        print >>sys.stderr, "time=%s, guid done" % (str(time.time()))
+            stats.end('guid')
 
         return self.xid
 
@@ -27,6 +27,8 @@ from qubes import QubesException, QubesVmCollection
 from qubes import QubesVmClasses
 from qubes import system_path, vm_files
 from qubesutils import size_to_human, print_stdout, print_stderr, get_disk_usage
+from qubesutils import get_file_extents, get_data_size
+from backup_compress import parse_compression_filter, compression_command
 import sys
 import os
 import fcntl
@@ -39,7 +41,44 @@ import grp
 import pwd
 import errno
 import datetime
-from multiprocessing import Queue, Process
+import hashlib
+import zlib
+import bz2
+import mmap
+import stat
+import tarfile
+import threading
+import uuid
+from collections import deque
+from cStringIO import StringIO
+from hmac import HMAC
+from Queue import Queue as ThreadQueue
+from multiprocessing import Queue, Process, Condition, Value, cpu_count
+from multiprocessing.pool import ThreadPool
+
+crypto_backend_present = False
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, \
+        modes
+    from cryptography.hazmat.primitives import padding
+    crypto_backend_present = True
+except ImportError:
+    pass
+
+# splice(2) is not exposed by python2 os module
+splice_present = False
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.splice.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                            ctypes.c_int, ctypes.c_void_p,
+                            ctypes.c_size_t, ctypes.c_uint]
+    libc.splice.restype = ctypes.c_ssize_t
+    splice_present = True
+except (ImportError, OSError, AttributeError):
+    pass
 
 BACKUP_DEBUG = False
 
@@ -48,10 +87,58 @@ DEFAULT_CRYPTO_ALGORITHM = 'aes-256-cbc'
 DEFAULT_HMAC_ALGORITHM = 'SHA512'
 DEFAULT_COMPRESSION_FILTER = 'gzip'
 CURRENT_BACKUP_FORMAT_VERSION = '3'
+# Backup with incremental (see ImageManifest) or deduplicated (see
+# DedupRecipe) images
+EXTENDED_BACKUP_FORMAT_VERSION = '4'
 # Maximum size of error message get from process stderr (including VM process)
 MAX_STDERR_BYTES = 1024
 # header + qubes.xml max size
 HEADER_QUBES_XML_MAX_SIZE = 1024 * 1024
+# Size of backup data chunks (.000, .001, ... files)
+CHUNK_SIZE = 100 * 1024 * 1024
+# Size of a single read from the backup data stream
+BUFFER_SIZE = 1024 * 1024
+# Default limit of backup data written to chunks, but not yet sent to the
+# backup target (staged in the temporary directory, or held in memory)
+DEFAULT_INFLIGHT_LIMIT = 4 * CHUNK_SIZE
+# Interval (seconds) of checks if the sending process is alive, while
+# waiting for it
+SEND_CHECK_INTERVAL = 1
+# Space reserved for a HMAC file (more than any digest needs)
+HMAC_FILE_MAX_SIZE = 1024
+# Size of data blocks compressed independently by ParallelCompressor
+COMPRESS_BLOCK_SIZE = 4 * 1024 * 1024
+# Size of image blocks compared by incremental backup
+INCREMENT_BLOCK_SIZE = 1024 * 1024
+BACKUP_MANIFEST_SUFFIX = '.manifest'
+BACKUP_INCREMENT_SUFFIX = '.increment'
+# Manifests of the last incremental backup, relative to qubes_base_dir
+BACKUP_MANIFESTS_DIR = 'backup-manifests'
+LAST_BACKUP_ID_FILENAME = 'last-backup-id'
+# Deduplication: chunk boundaries are placed after blocks of
+# DEDUP_BLOCK_SIZE (filesystem block size) selected by their checksum
+DEDUP_BLOCK_SIZE = 4096
+DEDUP_MIN_CHUNK_SIZE = 64 * 1024
+DEDUP_MAX_CHUNK_SIZE = 1024 * 1024
+DEDUP_BOUNDARY_MASK = 0x1f
+# Pack files with unique chunks, relative to the backup root
+DEDUP_DIR = 'dedup'
+BACKUP_DEDUP_SUFFIX = '.dedup'
+# Checkpoint journal of a backup written to a local file, stored next to it
+BACKUP_JOURNAL_SUFFIX = '.journal'
+# Adaptive compression: files are compressed only if samples of their data
+# (COMPRESSION_SAMPLES of COMPRESSION_SAMPLE_SIZE, compressed with zlib at
+# the fastest level) shrink at least to COMPRESSION_MAX_RATIO of the size
+COMPRESSION_SAMPLES = 16
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_MAX_RATIO = 0.9
+# Decompression program for backups with adaptive compression, selecting the
+# decompressor by the data format of each file
+ADAPTIVE_DECOMPRESSION_FILTER = 'python2 -m qubes.backup_compress'
+
+SPLICE_F_MOVE = 1
+SPLICE_F_MORE = 4
+F_SETPIPE_SZ = 1031
 
 # global state for backup_cancel()
 running_backup_operation = None
@@ -77,12 +164,1011 @@ class BackupHeader:
     compression_filter = 'compression-filter'
     crypto_algorithm = 'crypto-algorithm'
     hmac_algorithm = 'hmac-algorithm'
-    bool_options = ['encrypted', 'compressed']
+    backup_id = 'backup-id'
+    base_backup_id = 'base-backup-id'
+    dedup = 'dedup'
+    compression_adaptive = 'compression-adaptive'
+    bool_options = ['encrypted', 'compressed', 'dedup', 'compression-adaptive']
     int_options = ['version']
 
 
-def file_to_backup(file_path, subdir=None):
-    sz = get_disk_usage(file_path)
+def splice(fd_in, fd_out, size):
+    """
+    Move up to *size* bytes from *fd_in* to *fd_out* without copying them
+    to userspace; one of the descriptors must be a pipe.
+
+    :return: number of bytes moved, 0 at the end of input
+    """
+    ret = libc.splice(fd_in, None, fd_out, None, size,
+                      SPLICE_F_MOVE | SPLICE_F_MORE)
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise IOError(err, os.strerror(err))
+    return ret
+
+
+def is_pipe(fd):
+    return stat.S_ISFIFO(os.fstat(fd).st_mode)
+
+
+def set_pipe_size(fd, size=BUFFER_SIZE):
+    """Enlarge pipe buffer, so a single splice() call can move more data"""
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except IOError:
+        # not supported or over the limit, keep the default size
+        pass
+
+
+class BackupHmac(object):
+    """
+    HMAC of backup file data, stored in the same format as the output of
+    "openssl dgst -<algorithm> -hmac <passphrase>". Computed in-process when
+    the algorithm is known to hashlib, otherwise by openssl process.
+    """
+
+    def __init__(self, algorithm, passphrase):
+        self.hmac = None
+        self.proc = None
+        self.digest = None
+        try:
+            self.hmac = HMAC(passphrase,
+                             digestmod=lambda d=b'': hashlib.new(algorithm, d))
+        except ValueError:
+            self.proc = subprocess.Popen(["openssl", "dgst",
+                                          "-" + algorithm, "-hmac",
+                                          passphrase],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         close_fds=True)
+
+    def update(self, data):
+        if self.hmac:
+            self.hmac.update(data)
+        else:
+            try:
+                self.proc.stdin.write(data)
+            except IOError as e:
+                # openssl failed, error reported by hexdigest()
+                if e.errno != errno.EPIPE:
+                    raise
+
+    def update_from_file(self, path):
+        with open(path, 'rb') as f:
+            for buf in iter(lambda: f.read(BUFFER_SIZE), b''):
+                self.update(buf)
+
+    def update_from_fd(self, fd, length):
+        """Update with the first *length* bytes of file *fd*, mapped into
+        memory instead of read"""
+        if length == 0:
+            return
+        data = mmap.mmap(fd, length, prot=mmap.PROT_READ)
+        try:
+            self.update(data)
+        finally:
+            data.close()
+
+    def hexdigest(self):
+        if self.digest is not None:
+            return self.digest
+        if self.hmac:
+            self.digest = self.hmac.hexdigest()
+            return self.digest
+        proc_stdout, proc_stderr = self.proc.communicate()
+        if self.proc.returncode != 0 or len(proc_stderr) > 0:
+            raise QubesException(
+                "ERROR: failed to compute hmac: {0}".format(proc_stderr))
+        self.digest = load_hmac(proc_stdout)
+        return self.digest
+
+    def content(self):
+        """Content of the HMAC file"""
+        return str("(stdin)= %s\n" % self.hexdigest())
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.content())
+
+    def abort(self):
+        if self.proc:
+            try:
+                self.proc.terminate()
+            except OSError:
+                pass
+            self.proc.wait()
+
+
+# openssl enc uses EVP_BytesToKey with this digest to derive key from the
+# passphrase; the default was changed in OpenSSL 1.1.0
+openssl_enc_digest = None
+
+
+def get_openssl_enc_digest():
+    """
+    Digest used by "openssl enc" (without -md option) of the installed
+    OpenSSL, None if unknown
+    """
+    global openssl_enc_digest
+    if openssl_enc_digest is None:
+        try:
+            version = subprocess.check_output(['openssl', 'version'])
+        except (OSError, subprocess.CalledProcessError):
+            version = ''
+        match = re.match(r'OpenSSL (\d+)\.(\d+)\.(\d+)', version)
+        if not match:
+            openssl_enc_digest = ''
+        elif tuple(map(int, match.groups())) < (1, 1, 0):
+            openssl_enc_digest = 'md5'
+        else:
+            openssl_enc_digest = 'sha256'
+    return openssl_enc_digest or None
+
+
+class BackupEncryptor(object):
+    """
+    In-process encryption of backup data stream, with output identical to
+    "openssl enc -e -<algorithm> -pass pass:<passphrase>": "Salted__" magic,
+    8 bytes of salt and then the encrypted data. Use create() to get an
+    instance, it returns None if the algorithm is not supported in-process.
+    The salt is random, unless given (to reproduce the output).
+    """
+
+    # supported openssl cipher names
+    cipher_re = re.compile(r'^aes-(128|192|256)-(cbc|cfb|ofb|ctr)$')
+    salt_size = 8
+
+    def __init__(self, algorithm, passphrase, digest, salt=None):
+        key_size, mode = self.cipher_re.match(algorithm.lower()).groups()
+        if salt is None:
+            salt = os.urandom(self.salt_size)
+        key, iv = self.derive_key(passphrase, salt, digest,
+                                  int(key_size) / 8,
+                                  algorithms.AES.block_size / 8)
+        cipher = Cipher(algorithms.AES(key),
+                        {'cbc': modes.CBC, 'cfb': modes.CFB, 'ofb': modes.OFB,
+                         'ctr': modes.CTR}[mode](iv),
+                        backend=default_backend())
+        self.encryptor = cipher.encryptor()
+        self.padder = None
+        if mode == 'cbc':
+            self.padder = padding.PKCS7(algorithms.AES.block_size).padder()
+        self.header = b'Salted__' + salt
+
+    @classmethod
+    def supported(cls, algorithm):
+        return (crypto_backend_present and
+                cls.cipher_re.match(algorithm.lower()) is not None and
+                get_openssl_enc_digest() is not None)
+
+    @classmethod
+    def create(cls, algorithm, passphrase, salt=None):
+        if not cls.supported(algorithm):
+            return None
+        return cls(algorithm, passphrase, get_openssl_enc_digest(), salt)
+
+    @staticmethod
+    def derive_key(passphrase, salt, digest, key_len, iv_len):
+        """EVP_BytesToKey with a single iteration, as used by openssl enc"""
+        derived = b''
+        block = b''
+        while len(derived) < key_len + iv_len:
+            block = hashlib.new(digest, block + passphrase + salt).digest()
+            derived += block
+        return derived[:key_len], derived[key_len:key_len + iv_len]
+
+    def update(self, data):
+        if self.padder:
+            data = self.padder.update(data)
+        data = self.encryptor.update(data)
+        if self.header:
+            data = self.header + data
+            self.header = None
+        return data
+
+    def finalize(self):
+        data = b''
+        if self.padder:
+            data = self.encryptor.update(self.padder.finalize())
+        data += self.encryptor.finalize()
+        if self.header:
+            data = self.header + data
+            self.header = None
+        return data
+
+
+def compress_gzip(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_bzip2(data, level=9):
+    return bz2.compress(data, level)
+
+
+# Compression filters which can be applied in-process, to independent blocks
+# of data - concatenation of compressed blocks is a valid input for the
+# decompressor (multi-member gzip/bzip2 file), so restore is not affected
+inprocess_compressors = {
+    'gzip': compress_gzip,
+    'bzip2': compress_bzip2,
+}
+
+
+def makedirs(path):
+    """os.makedirs, which may be called for the same path from several
+    threads at once"""
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def is_compressible(path):
+    """
+    Estimate if the file is worth compressing, by compressing samples spread
+    over its data. Directories are always compressed.
+    """
+    if not os.path.isfile(path):
+        return True
+    extents = get_file_extents(path)
+    data_size = sum(length for (_, length) in extents)
+    if data_size < COMPRESSION_SAMPLE_SIZE:
+        # not worth checking
+        return True
+    count = min(COMPRESSION_SAMPLES,
+                (data_size + COMPRESSION_SAMPLE_SIZE - 1) /
+                COMPRESSION_SAMPLE_SIZE)
+    extents = iter(extents)
+    (extent_offset, extent_length) = next(extents)
+    # position of the current extent in the data (without holes)
+    extent_data_pos = 0
+    sampled = 0
+    compressed = 0
+    with open(path, 'rb') as f:
+        for i in range(count):
+            sample_pos = i * data_size / count
+            while sample_pos >= extent_data_pos + extent_length:
+                extent_data_pos += extent_length
+                (extent_offset, extent_length) = next(extents)
+            f.seek(extent_offset + sample_pos - extent_data_pos)
+            data = f.read(COMPRESSION_SAMPLE_SIZE)
+            sampled += len(data)
+            compressed += len(zlib.compress(data, 1))
+    return sampled == 0 or compressed < sampled * COMPRESSION_MAX_RATIO
+
+
+def should_compress(fileinfo, compressed, compression_adaptive=False):
+    """
+    Check if the data of *fileinfo* (see file_to_backup) should be
+    compressed: always if *compressed*, unless with *compression_adaptive*
+    it does not compress well (see is_compressible).
+    """
+    if not compressed:
+        return False
+    if not compression_adaptive:
+        return True
+    return is_compressible(fileinfo.get("dedup_source", fileinfo["path"]))
+
+
+class ParallelCompressor(object):
+    """
+    Compress data read from *in_stream* using worker threads of *pool*. Input
+    is split into COMPRESS_BLOCK_SIZE blocks, compressed concurrently, and
+    returned in order by read(). At most *max_blocks* blocks are kept in
+    memory.
+    """
+
+    def __init__(self, in_stream, compression_filter, pool, max_blocks,
+                 level=None):
+        self.in_stream = in_stream
+        self.compress = inprocess_compressors[compression_filter]
+        self.compress_args = () if level is None else (level,)
+        self.pool = pool
+        self.max_blocks = max_blocks
+        self.blocks = deque()
+        self.eof = False
+
+    def fill(self):
+        while not self.eof and len(self.blocks) < self.max_blocks:
+            data = self.in_stream.read(COMPRESS_BLOCK_SIZE)
+            if not data:
+                self.eof = True
+            else:
+                self.blocks.append(self.pool.apply_async(
+                    self.compress, (data,) + self.compress_args))
+
+    def read(self, size=None):
+        """Read next compressed block, empty string at the end of data"""
+        self.fill()
+        if not self.blocks:
+            return b''
+        return self.blocks.popleft().get()
+
+
+class BackupStreamReader(object):
+    """
+    Backup data stream of a single file (tar output), encrypted with
+    *encryptor* if given. Data read from the input, but not returned yet (not
+    fitting in the current chunk), is kept for the next read.
+    """
+
+    def __init__(self, in_stream, encryptor=None):
+        self.in_stream = in_stream
+        self.encryptor = encryptor
+        self.pending = b''
+        self.eof = False
+
+    def read(self, size):
+        """Read up to *size* bytes, empty string means end of the stream"""
+        while not self.pending and not self.eof:
+            buf = self.in_stream.read(size)
+            if not buf:
+                self.eof = True
+                if self.encryptor:
+                    self.pending = self.encryptor.finalize()
+            elif self.encryptor:
+                self.pending = self.encryptor.update(buf)
+            else:
+                self.pending = buf
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def splice_fd(self):
+        """
+        Input file descriptor, if the data doesn't need to pass through
+        Python (no in-process processing, input is a pipe) and can be moved
+        with splice(); otherwise None
+        """
+        if not splice_present or self.encryptor or self.pending:
+            return None
+        try:
+            fd = self.in_stream.fileno()
+        except AttributeError:
+            return None
+        if not is_pipe(fd):
+            return None
+        set_pipe_size(fd)
+        return fd
+
+
+def read_sparse_file(path, block_size):
+    """
+    Read the file in segments aligned to *block_size*, without reading its
+    holes (as reported by get_file_extents).
+
+    :return: generator of (offset, length, data) - data is None for a hole
+    """
+    size = os.path.getsize(path)
+    # data extents, extended to whole blocks
+    segments = []
+    for (offset, length) in get_file_extents(path):
+        start = offset - offset % block_size
+        end = min(size, offset + length + -(offset + length) % block_size)
+        if segments and start <= segments[-1][1]:
+            segments[-1] = (segments[-1][0], max(end, segments[-1][1]))
+        else:
+            segments.append((start, end))
+    read_size = max(block_size, BUFFER_SIZE - BUFFER_SIZE % block_size)
+    position = 0
+    with open(path, 'rb') as f:
+        for (start, end) in segments:
+            if start > position:
+                yield (position, start - position, None)
+            f.seek(start)
+            position = start
+            while position < end:
+                data = f.read(min(read_size, end - position))
+                if not data:
+                    raise IOError(errno.EIO, "File %s truncated" % path)
+                yield (position, len(data), data)
+                position += len(data)
+    if size > position:
+        yield (position, size - position, None)
+
+
+def iter_blocks(path, block_size):
+    """
+    Split the file into blocks of *block_size* (the last one may be
+    shorter), without reading its holes.
+
+    :return: generator of block data, None for a block in a hole
+    """
+    for (_, length, data) in read_sparse_file(path, block_size):
+        for pos in xrange(0, length, block_size):
+            if data is None:
+                yield None
+            else:
+                yield data[pos:pos + block_size]
+
+
+class ImageManifest(object):
+    """
+    Hashes of fixed size blocks of a VM image, stored next to the image in an
+    incremental backup. Hashes from the previous backup select blocks to
+    include in the next one, and verify the image restored from a chain of
+    increments.
+
+    File format: "key=value" header lines, an empty line, then a line for
+    each block: its hash, followed by " changed" if the block is included in
+    the increment (the .increment file holds the changed blocks, in order).
+    """
+    format_version = 1
+    hash_algorithm = 'sha256'
+
+    def __init__(self, backup_id, base_backup_id='', size=0,
+                 block_size=INCREMENT_BLOCK_SIZE):
+        self.backup_id = backup_id
+        self.base_backup_id = base_backup_id
+        self.size = size
+        self.block_size = block_size
+        # hex digest of each block
+        self.blocks = []
+        # indexes of blocks included in the increment, ascending
+        self.changed = []
+        # cache of zero_block_hash()
+        self.zero_hashes = {}
+
+    @classmethod
+    def block_hash(cls, data):
+        return hashlib.new(cls.hash_algorithm, data).hexdigest()
+
+    def zero_block_hash(self, length):
+        """Hash of a block of zeros (in a hole of the image)"""
+        if length not in self.zero_hashes:
+            self.zero_hashes[length] = self.block_hash(b'\0' * length)
+        return self.zero_hashes[length]
+
+    def block_length(self, index):
+        return min(self.block_size, self.size - index * self.block_size)
+
+    def save(self, path):
+        changed = set(self.changed)
+        with open(path, 'w') as f:
+            f.write(str("version=%d\n" % self.format_version))
+            f.write(str("backup-id=%s\n" % self.backup_id))
+            f.write(str("base-backup-id=%s\n" % self.base_backup_id))
+            f.write(str("size=%d\n" % self.size))
+            f.write(str("block-size=%d\n" % self.block_size))
+            f.write(str("hash=%s\n" % self.hash_algorithm))
+            f.write(str("\n"))
+            for index, digest in enumerate(self.blocks):
+                if index in changed:
+                    f.write(str("%s changed\n" % digest))
+                else:
+                    f.write(str("%s\n" % digest))
+
+    @classmethod
+    def load(cls, path):
+        header = {}
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    break
+                (key, _, value) = line.partition('=')
+                header[key] = value
+            if header.get('version') != str(cls.format_version) or \
+                    header.get('hash') != cls.hash_algorithm:
+                raise QubesException("Unsupported image manifest: %s" % path)
+            try:
+                manifest = cls(header['backup-id'],
+                               header.get('base-backup-id', ''),
+                               int(header['size']), int(header['block-size']))
+            except (KeyError, ValueError):
+                raise QubesException("Invalid image manifest: %s" % path)
+            for index, line in enumerate(f):
+                fields = line.split()
+                manifest.blocks.append(fields[0])
+                if fields[1:] == ['changed']:
+                    manifest.changed.append(index)
+        expected_blocks = (manifest.size + manifest.block_size - 1) / \
+            manifest.block_size
+        if len(manifest.blocks) != expected_blocks:
+            raise QubesException("Invalid image manifest: %s" % path)
+        return manifest
+
+    def verify(self, image_path):
+        """
+        Check that image content matches the manifest
+
+        :raise QubesException: on mismatch
+        """
+        if os.path.getsize(image_path) != self.size:
+            raise QubesException(
+                "Image {0} has size {1}, expected {2}".format(
+                    image_path, os.path.getsize(image_path), self.size))
+        for index, data in enumerate(iter_blocks(image_path,
+                                                 self.block_size)):
+            if data is None:
+                digest = self.zero_block_hash(self.block_length(index))
+            else:
+                digest = self.block_hash(data)
+            if digest != self.blocks[index]:
+                raise QubesException(
+                    "Image {0} does not match its manifest (block {1} "
+                    "differs)".format(image_path, index))
+
+
+def create_image_manifest(image_path, backup_id, base_manifest=None,
+                          increment_path=None):
+    """
+    Hash blocks of the image. If *base_manifest* is given, write blocks
+    changed since that backup to *increment_path*.
+
+    :return: ImageManifest of the image
+    """
+    manifest = ImageManifest(backup_id,
+                             base_manifest.backup_id if base_manifest else '')
+    increment = None
+    if base_manifest is not None:
+        assert base_manifest.block_size == manifest.block_size
+        increment = open(increment_path, 'wb')
+    image_size = os.path.getsize(image_path)
+    try:
+        for data in iter_blocks(image_path, manifest.block_size):
+            index = len(manifest.blocks)
+            if data is None:
+                length = min(manifest.block_size, image_size - manifest.size)
+                digest = manifest.zero_block_hash(length)
+            else:
+                length = len(data)
+                digest = manifest.block_hash(data)
+            manifest.size += length
+            manifest.blocks.append(digest)
+            if increment is None:
+                continue
+            if index >= len(base_manifest.blocks) or \
+                    base_manifest.blocks[index] != digest:
+                manifest.changed.append(index)
+                increment.write(data if data is not None else
+                                b'\0' * length)
+    finally:
+        if increment is not None:
+            increment.close()
+    return manifest
+
+
+def apply_image_increment(image_path, increment_path, manifest):
+    """
+    Write changed blocks from the increment into the image restored from the
+    base backup. The image manifest of the base backup must be stored next to
+    the image.
+    """
+    base_manifest = ImageManifest.load(image_path + BACKUP_MANIFEST_SUFFIX)
+    if base_manifest.backup_id != manifest.base_backup_id:
+        raise QubesException(
+            "Increment of {0} is based on backup {1}, but the image was "
+            "restored from backup {2}".format(image_path,
+                                              manifest.base_backup_id,
+                                              base_manifest.backup_id))
+    with open(image_path, 'r+b') as image:
+        with open(increment_path, 'rb') as increment:
+            for index in manifest.changed:
+                length = manifest.block_length(index)
+                data = increment.read(length)
+                if len(data) != length:
+                    raise QubesException(
+                        "Increment {0} is truncated".format(increment_path))
+                image.seek(index * manifest.block_size)
+                image.write(data)
+            if increment.read(1):
+                raise QubesException(
+                    "Increment {0} is too long".format(increment_path))
+        image.truncate(manifest.size)
+
+
+def merge_backup_increment(increment_dir, restore_dir):
+    """
+    Merge VM files extracted from an incremental backup (*increment_dir*)
+    into files extracted from its base backups (*restore_dir*): images are
+    updated with their increments, other files replace the older ones.
+    """
+    if not os.path.isdir(restore_dir):
+        os.makedirs(restore_dir)
+    for name in os.listdir(increment_dir):
+        if name.endswith(BACKUP_INCREMENT_SUFFIX):
+            # applied together with the manifest
+            continue
+        src = os.path.join(increment_dir, name)
+        dst = os.path.join(restore_dir, name)
+        if name.endswith(BACKUP_MANIFEST_SUFFIX):
+            increment = src[:-len(BACKUP_MANIFEST_SUFFIX)] + \
+                BACKUP_INCREMENT_SUFFIX
+            if os.path.exists(increment):
+                image = dst[:-len(BACKUP_MANIFEST_SUFFIX)]
+                if not os.path.exists(image) or not os.path.exists(dst):
+                    raise QubesException(
+                        "Base backups do not contain {0}".format(image))
+                apply_image_increment(image, increment,
+                                      ImageManifest.load(src))
+                os.unlink(increment)
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        os.rename(src, dst)
+
+
+def verify_restored_images(restore_dir):
+    """
+    Verify images restored from an incremental backup against their
+    manifests, then remove the manifests.
+    """
+    for name in os.listdir(restore_dir):
+        if not name.endswith(BACKUP_MANIFEST_SUFFIX):
+            continue
+        manifest_path = os.path.join(restore_dir, name)
+        ImageManifest.load(manifest_path).verify(
+            manifest_path[:-len(BACKUP_MANIFEST_SUFFIX)])
+        os.unlink(manifest_path)
+
+
+def install_backup_manifests(manifests, backup_id):
+    """
+    Save manifests of images included in a just finished incremental backup,
+    as the base for the next one.
+
+    :param manifests: list of tuples (staged manifest, local manifest path)
+    """
+    manifests_dir = os.path.join(system_path["qubes_base_dir"],
+                                 BACKUP_MANIFESTS_DIR)
+    for (staged_path, local_path) in manifests:
+        if not os.path.isdir(os.path.dirname(local_path)):
+            os.makedirs(os.path.dirname(local_path))
+        shutil.copy(staged_path, local_path + '.new')
+        os.rename(local_path + '.new', local_path)
+    last_backup_id_path = os.path.join(manifests_dir, LAST_BACKUP_ID_FILENAME)
+    with open(last_backup_id_path + '.new', 'w') as f:
+        f.write(str(backup_id + "\n"))
+    os.rename(last_backup_id_path + '.new', last_backup_id_path)
+
+
+def get_last_backup_id():
+    """
+    :return: id of the last incremental backup, or '' if there was none
+    """
+    try:
+        with open(os.path.join(system_path["qubes_base_dir"],
+                               BACKUP_MANIFESTS_DIR,
+                               LAST_BACKUP_ID_FILENAME)) as f:
+            return f.read().strip()
+    except IOError:
+        return ''
+
+
+def get_local_manifest_path(image_path):
+    return os.path.join(system_path["qubes_base_dir"], BACKUP_MANIFESTS_DIR,
+                        os.path.abspath(image_path).lstrip('/') +
+                        BACKUP_MANIFEST_SUFFIX)
+
+
+def dedup_chunks(path):
+    """
+    Split the file into content-defined chunks: a chunk ends after a block
+    (of DEDUP_BLOCK_SIZE) with checksum matching DEDUP_BOUNDARY_MASK, so
+    identical data in different images gives identical chunks, even when not
+    placed at the same offset.
+
+    :return: generator of (offset, length, hex digest) of chunks
+    """
+    # chunk of zeros starting at a chunk boundary - the same for every hole
+    # in the file, so no need to split holes block by block
+    zero_block = b'\0' * DEDUP_BLOCK_SIZE
+    if zlib.crc32(zero_block) & DEDUP_BOUNDARY_MASK == 0:
+        zero_chunk_length = DEDUP_MIN_CHUNK_SIZE
+    else:
+        zero_chunk_length = DEDUP_MAX_CHUNK_SIZE
+    zero_chunk_digest = hashlib.new(DedupRecipe.hash_algorithm,
+                                    b'\0' * zero_chunk_length).hexdigest()
+
+    offset = 0
+    chunk_start = 0
+    chunk_hash = hashlib.new(DedupRecipe.hash_algorithm)
+    for (_, segment_length, data) in read_sparse_file(path,
+                                                      DEDUP_BLOCK_SIZE):
+        pos = 0
+        while pos < segment_length:
+            if data is None and offset == chunk_start and \
+                    segment_length - pos >= zero_chunk_length:
+                yield (offset, zero_chunk_length, zero_chunk_digest)
+                offset += zero_chunk_length
+                chunk_start = offset
+                pos += zero_chunk_length
+                continue
+            if data is None:
+                block = zero_block[:segment_length - pos]
+            else:
+                block = data[pos:pos + DEDUP_BLOCK_SIZE]
+            chunk_hash.update(block)
+            offset += len(block)
+            pos += len(block)
+            length = offset - chunk_start
+            if length >= DEDUP_MAX_CHUNK_SIZE or \
+                    (length >= DEDUP_MIN_CHUNK_SIZE and
+                     zlib.crc32(block) & DEDUP_BOUNDARY_MASK == 0):
+                yield (chunk_start, length, chunk_hash.hexdigest())
+                chunk_start = offset
+                chunk_hash = hashlib.new(DedupRecipe.hash_algorithm)
+    if offset > chunk_start:
+        yield (chunk_start, offset - chunk_start, chunk_hash.hexdigest())
+
+
+class DedupRecipe(object):
+    """
+    List of chunks of a deduplicated image, stored in place of the image.
+    Chunks are stored once in the whole backup, in pack files in DEDUP_DIR.
+
+    File format: "key=value" header lines, an empty line, then a line for
+    each chunk: "hash length pack offset", where pack is path of the pack
+    file in the backup.
+    """
+    format_version = 1
+    hash_algorithm = 'sha256'
+
+    def __init__(self, size=0):
+        self.size = size
+        # tuples (hex digest, length, pack, offset in the pack)
+        self.chunks = []
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(str("version=%d\n" % self.format_version))
+            f.write(str("size=%d\n" % self.size))
+            f.write(str("hash=%s\n" % self.hash_algorithm))
+            f.write(str("\n"))
+            for chunk in self.chunks:
+                f.write(str("%s %d %s %d\n" % chunk))
+
+    @classmethod
+    def load(cls, path):
+        header = {}
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    break
+                (key, _, value) = line.partition('=')
+                header[key] = value
+            if header.get('version') != str(cls.format_version) or \
+                    header.get('hash') != cls.hash_algorithm:
+                raise QubesException("Unsupported deduplicated image: %s" %
+                                     path)
+            try:
+                recipe = cls(int(header['size']))
+                for line in f:
+                    (digest, length, pack, offset) = line.split()
+                    recipe.chunks.append((digest, int(length), pack,
+                                          int(offset)))
+            except (KeyError, ValueError):
+                raise QubesException("Invalid deduplicated image: %s" % path)
+        for (_, _, pack, _) in recipe.chunks:
+            if os.path.dirname(pack) != DEDUP_DIR:
+                raise QubesException("Invalid deduplicated image: %s" % path)
+        return recipe
+
+    def restore(self, image_path, base_dir):
+        """
+        Write the image from chunks in pack files, verifying the chunks.
+        Paths of the packs are relative to *base_dir*.
+        """
+        packs = {}
+        try:
+            with open(image_path, 'wb') as image:
+                for (digest, length, pack, offset) in self.chunks:
+                    if pack not in packs:
+                        packs[pack] = open(os.path.join(base_dir, pack), 'rb')
+                    packs[pack].seek(offset)
+                    data = packs[pack].read(length)
+                    if len(data) != length or hashlib.new(
+                            self.hash_algorithm, data).hexdigest() != digest:
+                        raise QubesException(
+                            "Chunk at offset {0} of {1} is damaged".format(
+                                image.tell(), image_path))
+                    if data.count(b'\0') == length:
+                        # keep the image sparse
+                        image.seek(length, os.SEEK_CUR)
+                    else:
+                        image.write(data)
+                image.truncate(self.size)
+        finally:
+            for pack_file in packs.values():
+                pack_file.close()
+
+
+class DedupPackWriter(threading.Thread):
+    """
+    Write *chunks* (list of (offset, length)) of *image_path* as a tar
+    archive with a single file *member_name* into *path* (the backup pipe).
+    Used in place of the tar process in backup_do, so provides the part of
+    Popen interface used there.
+    """
+
+    def __init__(self, path, member_name, image_path, chunks):
+        super(DedupPackWriter, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.member_name = member_name
+        self.image_path = image_path
+        self.chunks = chunks
+        self.canceled = False
+        self.returncode = None
+
+    def run(self):
+        try:
+            with open(self.path, 'wb') as out:
+                self.write_pack(out)
+            self.returncode = 0
+        except EnvironmentError as e:
+            # the reader is gone (backup canceled or failed)
+            if BACKUP_DEBUG:
+                print "Writing pack failed:", e
+            self.returncode = 1
+
+    def write_pack(self, out):
+        size = sum(length for (_, length) in self.chunks)
+        tarinfo = tarfile.TarInfo(self.member_name)
+        tarinfo.size = size
+        tarinfo.mode = 0o644
+        # not the current time, to write the same pack again when resuming
+        # the backup
+        tarinfo.mtime = int(os.path.getmtime(self.image_path))
+        out.write(tarinfo.tobuf(format=tarfile.GNU_FORMAT))
+        with open(self.image_path, 'rb') as image:
+            for (offset, length) in self.chunks:
+                image.seek(offset)
+                while length > 0:
+                    if self.canceled:
+                        raise IOError(errno.EINTR, "Backup canceled")
+                    data = image.read(min(length, BUFFER_SIZE))
+                    if not data:
+                        raise IOError(errno.EIO, "Image %s truncated" %
+                                      self.image_path)
+                    out.write(data)
+                    length -= len(data)
+        # pad the file to a tar block, then end of archive marker (two empty
+        # blocks), padded to a tar record - as tar does
+        written = tarfile.BLOCKSIZE + size
+        padding = -written % tarfile.BLOCKSIZE + 2 * tarfile.BLOCKSIZE
+        padding += -(written + padding) % tarfile.RECORDSIZE
+        out.write(b'\0' * padding)
+
+    def poll(self):
+        if self.is_alive():
+            return None
+        return self.returncode
+
+    def wait(self):
+        self.join()
+        return self.returncode
+
+    def terminate(self):
+        self.canceled = True
+
+
+def restore_deduplicated_images(restore_dir, vm_dir):
+    """
+    Rebuild deduplicated images of a VM (in *vm_dir* relative to
+    *restore_dir*) from chunks extracted to *restore_dir*/DEDUP_DIR.
+    """
+    vm_path = os.path.join(restore_dir, vm_dir)
+    for name in os.listdir(vm_path):
+        if not name.endswith(BACKUP_DEDUP_SUFFIX):
+            continue
+        recipe_path = os.path.join(vm_path, name)
+        DedupRecipe.load(recipe_path).restore(
+            recipe_path[:-len(BACKUP_DEDUP_SUFFIX)], restore_dir)
+        os.unlink(recipe_path)
+
+
+def stage_incremental_file(fileinfo, staging_dir, backup_id):
+    """
+    For incremental backup, replace image *fileinfo* (see file_to_backup)
+    with the blocks changed since the previous backup (or the whole image,
+    if there is no manifest of it) and the manifest of all its blocks, both
+    written to *staging_dir*.
+
+    :return: tuple (list of files to back up in place of *fileinfo*, size
+    of the unchanged data, (staged manifest, local manifest path) to install
+    after the backup)
+    """
+    image_name = os.path.basename(fileinfo["path"])
+    makedirs(staging_dir)
+    local_manifest = get_local_manifest_path(fileinfo["path"])
+    base_manifest = None
+    if os.path.exists(local_manifest):
+        try:
+            base_manifest = ImageManifest.load(local_manifest)
+        except QubesException as e:
+            if BACKUP_DEBUG:
+                print "Ignoring image manifest:", e
+        if base_manifest and \
+                base_manifest.block_size != INCREMENT_BLOCK_SIZE:
+            base_manifest = None
+    increment_path = None
+    if base_manifest:
+        increment_path = os.path.join(
+            staging_dir, image_name + BACKUP_INCREMENT_SUFFIX)
+    manifest = create_image_manifest(fileinfo["path"], backup_id,
+                                     base_manifest, increment_path)
+    manifest_path = os.path.join(staging_dir,
+                                 image_name + BACKUP_MANIFEST_SUFFIX)
+    manifest.save(manifest_path)
+    files = []
+    unchanged_size = 0
+    if increment_path:
+        increment_size = os.path.getsize(increment_path)
+        if BACKUP_DEBUG:
+            print "Changed blocks of {0}: {1}/{2}".format(
+                fileinfo["path"], len(manifest.changed),
+                len(manifest.blocks))
+        unchanged_size = max(0, fileinfo["size"] - increment_size)
+        files.append({"path": increment_path, "size": increment_size,
+                      "subdir": fileinfo["subdir"], "staged": True})
+    else:
+        files.append(fileinfo)
+    files.append({"path": manifest_path,
+                  "size": os.path.getsize(manifest_path),
+                  "subdir": fileinfo["subdir"]})
+    return files, unchanged_size, (manifest_path, local_manifest)
+
+
+def stage_dedup_file(fileinfo, staging_dir, dedup_index, stats):
+    """
+    For deduplicated backup, replace image *fileinfo* (see file_to_backup)
+    with the list of its chunks, written to *staging_dir*. Chunks not in
+    *dedup_index* (chunk digest -> (pack, offset in the pack), updated here)
+    are stored in a pack file, written directly from the image (see
+    DedupPackWriter). Deduplication statistics are added to *stats* dict.
+    Images of a backup must be staged one at a time, in the backup order.
+
+    :return: tuple (list of files to back up in place of *fileinfo*, size
+    of the duplicated data)
+    """
+    pack_name = "image-%04d.pack" % stats.get('dedup-images', 0)
+    pack_path = DEDUP_DIR + '/' + pack_name
+    recipe = DedupRecipe()
+    # (offset, length) of new chunks in the image
+    pack_chunks = []
+    pack_size = 0
+    for (offset, length, digest) in dedup_chunks(fileinfo["path"]):
+        recipe.size += length
+        if digest not in dedup_index:
+            dedup_index[digest] = (pack_path, pack_size)
+            pack_size += length
+            if pack_chunks and sum(pack_chunks[-1]) == offset:
+                pack_chunks[-1] = (pack_chunks[-1][0],
+                                   pack_chunks[-1][1] + length)
+            else:
+                pack_chunks.append((offset, length))
+        (chunk_pack, chunk_offset) = dedup_index[digest]
+        recipe.chunks.append((digest, length, chunk_pack, chunk_offset))
+    stats['dedup-images'] = stats.get('dedup-images', 0) + 1
+    stats['dedup-input-size'] = stats.get('dedup-input-size', 0) + recipe.size
+    stats['dedup-stored-size'] = \
+        stats.get('dedup-stored-size', 0) + pack_size
+    makedirs(staging_dir)
+    recipe_path = os.path.join(
+        staging_dir, os.path.basename(fileinfo["path"]) + BACKUP_DEDUP_SUFFIX)
+    recipe.save(recipe_path)
+    files = []
+    if pack_chunks:
+        files.append({"path": pack_name, "size": pack_size,
+                      "subdir": DEDUP_DIR + '/',
+                      "dedup_source": fileinfo["path"],
+                      "dedup_chunks": pack_chunks})
+    files.append({"path": recipe_path,
+                  "size": os.path.getsize(recipe_path),
+                  "subdir": fileinfo["subdir"], "staged": True})
+    return files, max(0, fileinfo["size"] - pack_size)
+
+
+def file_to_backup(file_path, subdir=None, image=False):
+    if image and os.path.isfile(file_path):
+        # only data extents of (sparse) image are read
+        sz = get_data_size(file_path)
+    else:
+        sz = get_disk_usage(file_path)
 
     if subdir is None:
         abs_file_path = os.path.abspath(file_path)
@@ -94,7 +1180,7 @@ def file_to_backup(file_path, subdir=None):
     else:
         if len(subdir) > 0 and not subdir.endswith('/'):
             subdir += '/'
-    return [{"path": file_path, "size": sz, "subdir": subdir}]
+    return [{"path": file_path, "size": sz, "subdir": subdir, "image": image}]
 
 
 def backup_cancel():
@@ -189,7 +1275,8 @@ def backup_prepare(vms_list=None, exclude_list=None,
             subdir = None
 
         if vm.private_img is not None:
-            files_to_backup += file_to_backup(vm.private_img, subdir)
+            files_to_backup += file_to_backup(vm.private_img, subdir,
+                                              image=True)
 
         if vm.is_appvm():
             files_to_backup += file_to_backup(vm.icon_path, subdir)
@@ -215,7 +1302,8 @@ def backup_prepare(vms_list=None, exclude_list=None,
                 subdir)
 
         if vm.updateable:
-            files_to_backup += file_to_backup(vm.root_img, subdir)
+            files_to_backup += file_to_backup(vm.root_img, subdir,
+                                              image=True)
 
         s = ""
         fmt = "{{0:>{0}}} |".format(fields_to_display[0]["width"] + 1)
@@ -370,12 +1458,408 @@ def backup_prepare(vms_list=None, exclude_list=None,
     return files_to_backup
 
 
+class BackupJournal(object):
+    """
+    Checkpoint journal of a backup written to a local file: files (chunks
+    and their HMACs) written to the backup file so far, each with offset of
+    its end in the backup file. An entry is added only after the data is
+    synced to disk, so an interrupted backup can be resumed after the last
+    complete chunk. Files backed up (not images) are recorded too, once all
+    their chunks are written, with their size and modification time - such
+    files, if unchanged, are not read again when resuming.
+
+    File format: a line for each file: "end-offset name", and for each
+    backed up file: "file end-offset size mtime path".
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # tuples (name, end offset)
+        self.entries = []
+        # path -> (size, mtime, end offset)
+        self.files = {}
+
+    @classmethod
+    def create(cls, path):
+        journal = cls(path)
+        journal.save()
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        journal = cls(path)
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    if line.startswith('file '):
+                        (_, offset, size, mtime, path) = \
+                            line.rstrip('\n').split(' ', 4)
+                        journal.files[path] = (int(size), float(mtime),
+                                               int(offset))
+                        continue
+                    (offset, name) = line.rstrip('\n').split(' ', 1)
+                    journal.entries.append((name, int(offset)))
+        except IOError as e:
+            raise QubesException(
+                "Cannot resume the backup, no journal found: {0}".format(e))
+        except ValueError:
+            # incomplete last line, or damaged journal - use entries before
+            pass
+        return journal
+
+    def save(self):
+        with open(self.path + '.new', 'w') as f:
+            for (name, offset) in self.entries:
+                f.write(str("%d %s\n" % (offset, name)))
+            for (path, (size, mtime, offset)) in self.files.iteritems():
+                f.write(str("file %d %d %r %s\n" % (offset, size, mtime,
+                                                    path)))
+        os.rename(self.path + '.new', self.path)
+
+    def record(self, name, offset):
+        """Add the entry, used by SendWorker (in a separate process)"""
+        self.entries.append((name, offset))
+        with open(self.path, 'a') as f:
+            f.write(str("%d %s\n" % (offset, name)))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record_file(self, path, size, mtime, offset):
+        """Add the backed up file, its chunks ending at *offset*; used by
+        SendWorker"""
+        self.files[path] = (size, mtime, offset)
+        with open(self.path, 'a') as f:
+            f.write(str("file %d %d %r %s\n" % (offset, size, mtime, path)))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def truncate(self, offset):
+        """Remove entries of files ending after *offset*"""
+        self.entries = [(name, end) for (name, end) in self.entries
+                        if end <= offset]
+        self.files = dict((path, info) for (path, info)
+                          in self.files.iteritems() if info[2] <= offset)
+        self.save()
+
+    def remove(self):
+        os.unlink(self.path)
+
+
+def get_resumable_backup(base_backup_dir):
+    """
+    :return: path of the backup file to resume: *base_backup_dir* itself,
+    or the last backup with a journal in that directory
+    """
+    if not os.path.isdir(base_backup_dir):
+        return base_backup_dir
+    journals = sorted(name for name in os.listdir(base_backup_dir)
+                      if name.startswith('qubes-') and
+                      name.endswith(BACKUP_JOURNAL_SUFFIX))
+    if not journals:
+        raise QubesException(
+            "No interrupted backup found in {0}".format(base_backup_dir))
+    return os.path.join(base_backup_dir,
+                        journals[-1][:-len(BACKUP_JOURNAL_SUFFIX)])
+
+
+def backup_resume_prepare(backup_target, passphrase):
+    """
+    Check the part of an interrupted backup already written to the local
+    file *backup_target*: the chunks listed in its journal, each followed by
+    its HMAC, must match their HMACs. The journal is cut after the last
+    valid chunk.
+
+    :return: tuple (journal, header data, chunks) - chunks is a list of
+    (name, start offset, data offset, HMAC hex digest) of valid chunks in
+    the backup file, header data is None if there is none
+    """
+    journal = BackupJournal.load(backup_target + BACKUP_JOURNAL_SUFFIX)
+    chunks = []
+    header_data = None
+    hmac_algorithm = None
+    offset = 0
+
+    def member_info(f, name, start):
+        f.seek(start)
+        member = tarfile.open(fileobj=f, mode='r:').firstmember
+        if member is None or member.name != name:
+            raise tarfile.ReadError("{0} not found".format(name))
+        return member.offset_data, member.size
+
+    with open(backup_target, 'rb') as f:
+        for index in range(0, len(journal.entries) - 1, 2):
+            (name, chunk_end) = journal.entries[index]
+            (hmac_name, hmac_end) = journal.entries[index + 1]
+            if hmac_name != name + ".hmac" or \
+                    (index == 0) != (name == HEADER_FILENAME):
+                break
+            try:
+                (data_offset, size) = member_info(f, name, offset)
+                (hmac_offset, hmac_size) = member_info(f, hmac_name,
+                                                       chunk_end)
+            except tarfile.TarError as e:
+                if BACKUP_DEBUG:
+                    print "Stopping at damaged chunk {0}: {1}".format(name, e)
+                break
+            f.seek(hmac_offset)
+            digest = load_hmac(f.read(hmac_size))
+            f.seek(data_offset)
+            if name == HEADER_FILENAME:
+                header = f.read(size)
+                header_data = dict(line.split('=', 1)
+                                   for line in header.splitlines()
+                                   if '=' in line)
+                header_data[HEADER_FILENAME] = header
+                hmac_algorithm = header_data.get(BackupHeader.hmac_algorithm,
+                                                 DEFAULT_HMAC_ALGORITHM)
+                f.seek(data_offset)
+            hmac = BackupHmac(hmac_algorithm, passphrase)
+            remaining = size
+            while remaining > 0:
+                data = f.read(min(remaining, BUFFER_SIZE))
+                if not data:
+                    break
+                hmac.update(data)
+                remaining -= len(data)
+            if remaining > 0 or hmac.hexdigest() != digest:
+                if name == HEADER_FILENAME:
+                    raise QubesException(
+                        "Cannot resume the backup: wrong passphrase or "
+                        "damaged backup header")
+                if BACKUP_DEBUG:
+                    print "Stopping at chunk with wrong HMAC:", name
+                break
+            chunks.append((name, offset, data_offset, digest))
+            offset = hmac_end
+    journal.truncate(offset)
+    return journal, header_data, chunks
+
+
+class ResumedBackup(object):
+    """
+    The part of an interrupted backup already in the local backup file
+    *backup_file* (opened for writing) with *journal*, when resuming it: its
+    valid *chunks* (see backup_resume_prepare), expected to be produced
+    again in the same order. Without chunks (not resuming), nothing is in
+    the backup.
+    """
+
+    def __init__(self, backup_file=None, journal=None, chunks=()):
+        self.backup_file = backup_file
+        self.journal = journal
+        self.chunks = deque(chunks)
+
+    def cut(self, offset):
+        """Discard the rest of the interrupted backup, from *offset*"""
+        self.backup_file.seek(offset)
+        self.backup_file.truncate()
+        self.journal.truncate(offset)
+        self.chunks.clear()
+
+    def chunk_in_backup(self, name, digest):
+        """
+        Check if chunk *name* with HMAC *digest* is the next chunk of the
+        interrupted backup. If it is not, the rest of the backup file is
+        discarded, the data will be written from here.
+        """
+        if not self.chunks:
+            return False
+        (resumed_name, start, _, resumed_digest) = self.chunks[0]
+        if (resumed_name, resumed_digest) == (name, digest):
+            self.chunks.popleft()
+            return True
+        if BACKUP_DEBUG:
+            print "Resuming the backup at", name
+        self.cut(start)
+        return False
+
+    def file_in_backup(self, path, file_stat):
+        """Check if file *path* (*file_stat* - its current os.stat) was
+        backed up completely by the interrupted backup and has not changed
+        since"""
+        if self.journal is None or path not in self.journal.files:
+            return False
+        (size, mtime, _) = self.journal.files[path]
+        return (size, mtime) == (file_stat.st_size, file_stat.st_mtime)
+
+    def skip_file(self, name, path, file_stat):
+        """
+        Keep file *path* (chunks *name*.000, *name*.001, ...) as it is in the
+        interrupted backup, if it is unchanged (see file_in_backup) and its
+        chunks are the next chunks of the backup - then they are not produced
+        again.
+
+        :return: True if the file is skipped
+        """
+        if not self.file_in_backup(path, file_stat):
+            return False
+        end = self.journal.files[path][2]
+        count = 0
+        for (chunk_name, start, _, _) in self.chunks:
+            if start >= end:
+                break
+            if chunk_name != "%s.%03d" % (name, count):
+                return False
+            count += 1
+        if not count:
+            return False
+        for _ in range(count):
+            self.chunks.popleft()
+        return True
+
+    def finish(self):
+        """Discard the chunks not produced again - the interrupted backup had
+        more data than this one"""
+        if self.chunks:
+            self.cut(self.chunks[0][1])
+
+    def salt(self, name):
+        """Encryption salt of file *name* (first chunk) in the interrupted
+        backup"""
+        # a copy - called by producer threads, while the main thread
+        # consumes the chunks
+        for (resumed_name, _, data_offset, _) in list(self.chunks):
+            if resumed_name == name:
+                with open(self.backup_file.name, 'rb') as f:
+                    f.seek(data_offset)
+                    data = f.read(16)
+                if data[:8] == b'Salted__':
+                    return data[8:]
+        return None
+
+
+class SendBudget(object):
+    """
+    Limit of data in flight between backup_do and SendWorker (written to
+    chunks, but not sent to the backup target yet) to *limit* bytes - the
+    producer acquires space for the data before writing it, SendWorker
+    releases it when the data is sent. Shared with the SendWorker process.
+
+    The producer waiting for the space (the backup target is slower than
+    reading the data) and SendWorker waiting for the data (the other way
+    round) are counted as stalls.
+
+    Data produced ahead (of files which will be sent after the current one)
+    must leave space for a chunk of the current file, otherwise the
+    current file could wait for the space forever.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.cond = Condition()
+        # protected by self.cond
+        self.in_flight = Value('l', 0, lock=False)
+        self.send_idle_time = Value('d', 0.0, lock=False)
+        # used only by the producer
+        self.peak = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+
+    def fits(self, size, ahead=None):
+        if ahead is not None and ahead():
+            return self.in_flight.value + size + CHUNK_SIZE + \
+                HMAC_FILE_MAX_SIZE <= self.limit
+        # anything fits when nothing is in flight, so data larger than the
+        # limit do not block forever
+        return self.in_flight.value + size <= self.limit or \
+            self.in_flight.value == 0
+
+    def acquire(self, size, check=None, ahead=None):
+        """
+        Wait until *size* bytes fit into the limit. *ahead* is a callable
+        returning True while the data is produced ahead of the file being
+        sent. While waiting, *check* is called every SEND_CHECK_INTERVAL
+        seconds; it may raise an exception, or return False to stop waiting.
+        """
+        with self.cond:
+            if not self.fits(size, ahead):
+                self.stalls += 1
+                start = time.time()
+                while not self.fits(size, ahead):
+                    if check and not check():
+                        break
+                    self.cond.wait(SEND_CHECK_INTERVAL)
+                self.stall_time += time.time() - start
+            self.in_flight.value += size
+            self.peak = max(self.peak, self.in_flight.value)
+
+    def release(self, size):
+        with self.cond:
+            self.in_flight.value -= size
+            self.cond.notify_all()
+
+    def wakeup(self):
+        """Wake up waiting producers, to check their *ahead* again"""
+        with self.cond:
+            self.cond.notify_all()
+
+    def add_send_idle_time(self, idle_time):
+        with self.cond:
+            self.send_idle_time.value += idle_time
+
+    def stats(self):
+        """Statistics for backup_do() result"""
+        with self.cond:
+            send_idle_time = self.send_idle_time.value
+        return {
+            'inflight-limit': self.limit,
+            'inflight-peak': self.peak,
+            'send-stalls': self.stalls,
+            'send-stall-time': self.stall_time,
+            'send-idle-time': send_idle_time,
+        }
+
+
 class SendWorker(Process):
-    def __init__(self, queue, base_dir, backup_stdout):
+    """
+    Send files queued in *queue* to *backup_stdout*, each as a separate tar
+    archive, and release their size from *budget* (SendBudget). A queued
+    element is either the name of a file in *base_dir* (removed when sent),
+    or a tuple (name, data) of a file held in memory. A dict (path, size,
+    mtime) of a file, which chunks were all queued before it, is only
+    recorded in *journal*.
+    """
+    def __init__(self, queue, base_dir, backup_stdout, journal=None,
+                 budget=None):
         super(SendWorker, self).__init__()
         self.queue = queue
         self.base_dir = base_dir
         self.backup_stdout = backup_stdout
+        self.journal = journal
+        self.budget = budget
+
+    def send_file(self, filename):
+        # This tar used for sending data out need to be as simple, as
+        # simple, as featureless as possible. It will not be
+        # verified before untaring.
+        tar_final_cmd = ["tar", "-cO", "--posix",
+                         "-C", self.base_dir, filename]
+        final_proc = subprocess.Popen(tar_final_cmd,
+                                      stdin=subprocess.PIPE,
+                                      stdout=self.backup_stdout)
+        # handle only exit code 2 (tar fatal error) or
+        # greater (call failed?)
+        return final_proc.wait() < 2
+
+    def send_data(self, name, data):
+        # the same format as of the tar above
+        tarinfo = tarfile.TarInfo(name.encode('utf-8'))
+        tarinfo.size = len(data)
+        tarinfo.mtime = int(time.time())
+        tarinfo.mode = 0644
+        tarinfo.uid = os.getuid()
+        tarinfo.gid = os.getgid()
+        try:
+            tar = tarfile.open(fileobj=self.backup_stdout, mode='w|',
+                               format=tarfile.PAX_FORMAT)
+            tar.addfile(tarinfo, StringIO(data))
+            tar.close()
+            self.backup_stdout.flush()
+        except EnvironmentError as e:
+            if BACKUP_DEBUG:
+                print "Sending data failed:", e
+            return False
+        return True
 
     def run(self):
         if BACKUP_DEBUG:
@@ -385,49 +1869,512 @@ class SendWorker(Process):
             print "Moving to temporary dir", self.base_dir
         os.chdir(self.base_dir)
 
-        for filename in iter(self.queue.get, None):
-            if filename == "FINISHED" or filename == "ERROR":
+        while True:
+            wait_start = time.time()
+            element = self.queue.get()
+            if self.budget:
+                self.budget.add_send_idle_time(time.time() - wait_start)
+            if element is None or element == "FINISHED" or \
+                    element == "ERROR":
                 break
 
+            if isinstance(element, dict):
+                if self.journal:
+                    self.journal.record_file(
+                        element["path"], element["size"], element["mtime"],
+                        os.lseek(self.backup_stdout.fileno(), 0, os.SEEK_CUR))
+                continue
+
+            if isinstance(element, tuple):
+                (filename, data) = element
+                size = len(data)
+            else:
+                (filename, data) = (element, None)
+                size = os.path.getsize(filename)
             if BACKUP_DEBUG:
                 print "Sending file", filename
-            # This tar used for sending data out need to be as simple, as
-            # simple, as featureless as possible. It will not be
-            # verified before untaring.
-            tar_final_cmd = ["tar", "-cO", "--posix",
-                             "-C", self.base_dir, filename]
-            final_proc = subprocess.Popen(tar_final_cmd,
-                                          stdin=subprocess.PIPE,
-                                          stdout=self.backup_stdout)
-            if final_proc.wait() >= 2:
-                if self.queue.full():
-                    # if queue is already full, remove some entry to wake up
-                    # main thread, so it will be able to notice error
-                    self.queue.get()
-                # handle only exit code 2 (tar fatal error) or
-                # greater (call failed?)
+            if data is None:
+                sent = self.send_file(filename)
+            else:
+                sent = self.send_data(filename, data)
+            if not sent:
                 raise QubesException(
                     "ERROR: Failed to write the backup, out of disk space? "
                     "Check console output or ~/.xsession-errors for details.")
 
-            # Delete the file as we don't need it anymore
-            if BACKUP_DEBUG:
-                print "Removing file", filename
-            os.remove(filename)
+            if self.journal:
+                backup_fd = self.backup_stdout.fileno()
+                os.fsync(backup_fd)
+                self.journal.record(filename,
+                                    os.lseek(backup_fd, 0, os.SEEK_CUR))
+
+            if data is None:
+                # Delete the file as we don't need it anymore
+                if BACKUP_DEBUG:
+                    print "Removing file", filename
+                os.remove(filename)
+            del data
+            if self.budget:
+                self.budget.release(size)
 
         if BACKUP_DEBUG:
             print "Finished sending thread"
 
 
+class BackupProducer(object):
+    """
+    Write the backup data of files (see file_to_backup) into chunks in
+    *tmpdir*, each file by a separate thread, for several files at once.
+    Files are staged first for incremental or deduplicated backup if needed
+    - this reads the whole image, so it is done by the thread of the file
+    too, not to stall sending of the files before it.
+
+    (chunk name, data in memory or None, size, HMAC) of each chunk of a file
+    is put into its "output" queue, then a dict (path, size, mtime) of the
+    file if it can be skipped when resuming the backup (see
+    ResumedBackup.skip_file), then None - or the exception, if producing
+    the data failed. The files must be consumed in the order they
+    were started, see next_file(). Space for the chunks is acquired from
+    *budget* (SendBudget), leaving space for the file being sent; *check* is
+    called while waiting for it, see SendBudget.acquire. Chunks already in
+    the interrupted backup (*resumed*, ResumedBackup) are encrypted with the
+    same salt.
+
+    Backup statistics are added to *stats* dict, manifests of images to
+    install after incremental backup are collected in self.manifests.
+    """
+
+    def __init__(self, tmpdir, passphrase, budget, check, operation,
+                 total_size, progress_callback, vmproc=None, resumed=None,
+                 encrypted=False, crypto_algorithm=DEFAULT_CRYPTO_ALGORITHM,
+                 hmac_algorithm=DEFAULT_HMAC_ALGORITHM, compressed=False,
+                 compression_filter=DEFAULT_COMPRESSION_FILTER,
+                 compression_level=None, compression_adaptive=False,
+                 in_memory=False, incremental=False, backup_id=None,
+                 dedup=False, stats=None):
+        self.tmpdir = tmpdir
+        self.passphrase = passphrase
+        self.budget = budget
+        self.check = check
+        self.operation = operation
+        self.total_size = total_size
+        self.progress_callback = progress_callback
+        self.vmproc = vmproc
+        self.resumed = resumed if resumed is not None else ResumedBackup()
+        self.encrypted = encrypted
+        self.crypto_algorithm = crypto_algorithm
+        self.hmac_algorithm = hmac_algorithm
+        self.compressed = compressed
+        self.compression_filter = compression_filter
+        self.compression_level = compression_level
+        self.compression_cmd = compression_command(compression_filter,
+                                                   compression_level)
+        self.compression_adaptive = compression_adaptive
+        self.in_memory = in_memory
+        self.incremental = incremental
+        self.backup_id = backup_id
+        self.dedup = dedup
+        self.stats = stats if stats is not None else {}
+        #: (staged manifest, local manifest path) of each image, to save
+        #: after the backup is complete
+        self.manifests = []
+        # chunk digest -> (pack, offset in the pack), for deduplication
+        self.dedup_index = {}
+        #: files being produced, in the backup order
+        self.files = deque()
+        self.file_index = 0
+        self.abort = threading.Event()
+        # set when the images before the next file are staged for
+        # deduplicated backup - see stage()
+        self.dedup_staged = threading.Event()
+        self.dedup_staged.set()
+
+        # Compress in worker threads (split into independently compressed
+        # blocks), if the filter supports it and the output of compression
+        # can be encrypted in-process
+        self.compress_pool = None
+        self.compress_workers = 0
+        if compressed and compression_filter in inprocess_compressors and \
+                (not encrypted or BackupEncryptor.supported(crypto_algorithm)):
+            self.compress_workers = cpu_count()
+            self.compress_pool = ThreadPool(self.compress_workers)
+
+    def start_file(self, fileinfo):
+        """Start producing the data of *fileinfo*, in a new thread"""
+        producer = {"file": fileinfo,
+                    "pipe": os.path.join(self.tmpdir, "backup_pipe.%d" %
+                                         self.file_index),
+                    "output": ThreadQueue(), "head": threading.Event(),
+                    "dedup_previous": self.dedup_staged,
+                    # staged files to remove once sent
+                    "staged": [], "uncompressed_files": 0}
+        if self.dedup and fileinfo.get("image"):
+            self.dedup_staged = threading.Event()
+        producer["dedup_staged"] = self.dedup_staged
+        if not self.files:
+            producer["head"].set()
+        self.file_index += 1
+        # Tar with tape length does not deals well with stdout (close
+        # stdout between two tapes)
+        # For this reason, we will use named pipes instead
+        if BACKUP_DEBUG:
+            print "Creating pipe in:", producer["pipe"]
+        os.mkfifo(producer["pipe"])
+        producer["thread"] = threading.Thread(target=self.run,
+                                              args=(producer,))
+        producer["thread"].daemon = True
+        producer["thread"].start()
+        self.files.append(producer)
+        return producer
+
+    def next_file(self):
+        """Clean up after the first file, which data was consumed - the next
+        one is sent now"""
+        producer = self.files.popleft()
+        producer["thread"].join()
+        os.unlink(producer["pipe"])
+        for staged_path in producer["staged"]:
+            os.unlink(staged_path)
+        if producer["uncompressed_files"]:
+            self.stats['uncompressed-files'] = \
+                self.stats.get('uncompressed-files', 0) + \
+                producer["uncompressed_files"]
+        if self.files:
+            self.files[0]["head"].set()
+            self.budget.wakeup()
+
+    def stop(self):
+        """Stop producing the data, on error or when canceled"""
+        self.abort.set()
+        for proc in list(self.operation.processes_to_kill_on_cancel):
+            if proc is self.vmproc:
+                continue
+            try:
+                proc.terminate()
+            except:
+                pass
+        for producer in self.files:
+            # unblock the producer, if still waiting for the writer to open
+            # the pipe
+            try:
+                os.close(os.open(producer["pipe"],
+                                 os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            producer["thread"].join()
+        if self.compress_pool:
+            self.compress_pool.terminate()
+
+    def close(self):
+        """Wait for the compression workers, when all the files are done"""
+        if self.compress_pool:
+            self.compress_pool.close()
+            self.compress_pool.join()
+
+    def keep_waiting(self):
+        """Check if waiting for the budget should go on, see
+        SendBudget.acquire"""
+        self.check()
+        return not self.operation.canceled and not self.abort.is_set()
+
+    def wait(self, event):
+        """Wait for *event*, unless the backup is stopped"""
+        while not event.wait(1):
+            if self.operation.canceled or self.abort.is_set():
+                raise BackupCanceledError("Backup canceled")
+
+    def run(self, producer):
+        try:
+            self.produce(producer)
+        except Exception as e:
+            # handled by the consumer of the output
+            producer["output"].put(e)
+
+    def stage(self, producer):
+        """
+        Stage the file of *producer* for incremental or deduplicated backup,
+        if needed.
+
+        :return: list of files to back up in place of producer["file"]
+        """
+        fileinfo = producer["file"]
+        files = [fileinfo]
+        if self.incremental and fileinfo.get("image"):
+            (files, unchanged_size, manifest) = stage_incremental_file(
+                fileinfo,
+                os.path.join(self.tmpdir, 'increments', fileinfo["subdir"]),
+                self.backup_id)
+            self.manifests.append(manifest)
+            # unchanged data counts as done
+            self.progress_callback(unchanged_size, self.total_size)
+        if producer["dedup_staged"] is producer["dedup_previous"]:
+            return files
+        # the same image data may be in the previous images
+        self.wait(producer["dedup_previous"])
+        dedup_files = []
+        for fileinfo in files:
+            if not fileinfo.get("image"):
+                dedup_files.append(fileinfo)
+                continue
+            (staged_files, duplicated_size) = stage_dedup_file(
+                fileinfo,
+                os.path.join(self.tmpdir, 'dedup-recipes', fileinfo["subdir"]),
+                self.dedup_index, self.stats)
+            # duplicated data counts as done
+            self.progress_callback(duplicated_size, self.total_size)
+            dedup_files.extend(staged_files)
+        producer["dedup_staged"].set()
+        return dedup_files
+
+    def produce(self, producer):
+        """Write the backup data of the file of *producer*, staged first if
+        needed, into chunks - unless it is kept from the interrupted
+        backup"""
+        fileinfo = producer["file"]
+        file_stat = None
+        if not fileinfo.get("image") and os.path.isfile(fileinfo["path"]):
+            file_stat = os.stat(fileinfo["path"])
+            if self.resumed.file_in_backup(fileinfo["path"], file_stat):
+                # the chunks before it must be consumed first, to know if
+                # the backup is still the same up to this file
+                self.wait(producer["head"])
+                if self.resumed.skip_file(
+                        fileinfo["subdir"] +
+                        os.path.basename(fileinfo["path"]),
+                        fileinfo["path"], file_stat):
+                    if BACKUP_DEBUG:
+                        print "Kept from the interrupted backup:", \
+                            fileinfo["path"]
+                    self.progress_callback(fileinfo["size"], self.total_size)
+                    producer["output"].put(None)
+                    return
+
+        for filename in self.stage(producer):
+            if BACKUP_DEBUG:
+                print "Backing up", filename
+
+            # Ensure the temporary directory exists
+            makedirs(os.path.join(self.tmpdir, filename["subdir"]))
+
+            file_compressed = should_compress(filename, self.compressed,
+                                              self.compression_adaptive)
+            if self.compressed and not file_compressed:
+                if BACKUP_DEBUG:
+                    print "Not compressing", filename["path"]
+                producer["uncompressed_files"] += 1
+
+            if filename.get("staged"):
+                producer["staged"].append(filename["path"])
+            self.produce_chunks(producer, filename, file_compressed)
+        if file_stat:
+            producer["output"].put({"path": fileinfo["path"],
+                                    "size": file_stat.st_size,
+                                    "mtime": file_stat.st_mtime})
+        producer["output"].put(None)
+
+    def produce_chunks(self, producer, filename, file_compressed):
+        """Write the backup data of *filename* (one of the files of
+        *producer*) into chunks"""
+        file_pipe = producer["pipe"]
+        operation = self.operation
+        backup_tempfile = os.path.join(self.tmpdir,
+                                       filename["subdir"],
+                                       os.path.basename(filename["path"]))
+        if BACKUP_DEBUG:
+            print "Using temporary location:", backup_tempfile
+        file_compress_pool = self.compress_pool if file_compressed else None
+
+        # Pipe: tar-sparse | [compressor | ] [encryptor | ] chunks [+ hmac] |
+        #   tar | backup_target
+        # Compression, encryption and HMAC are done in-process, unless the
+        # algorithm is not supported there - then the compression program
+        # and openssl enc are run as separate processes
+        # close_fds everywhere: do not hold the write end of a pipe of
+        # another file (e.g. opened by DedupPackWriter thread)
+        if "dedup_chunks" in filename:
+            # pack of deduplicated chunks, not a file to archive with tar
+            tar_sparse = DedupPackWriter(
+                file_pipe,
+                filename["subdir"] + os.path.basename(filename["path"]),
+                filename["dedup_source"], filename["dedup_chunks"])
+            tar_sparse.start()
+        else:
+            # The first tar cmd can use any complex feature as we want. Files
+            # will be verified before untaring this.
+            # Prefix the path in archive with filename["subdir"] to have it
+            # verified during untar
+            tar_cmdline = (["tar", "-Pc", '--sparse',
+                           "-f", file_pipe,
+                           '-C', os.path.dirname(filename["path"])] +
+                           (['--dereference']
+                            if filename["subdir"] != "dom0-home/" else []) +
+                           ['--xform', 's:^%s:%s\\0:' % (
+                               os.path.basename(filename["path"]),
+                               filename["subdir"]),
+                           os.path.basename(filename["path"])
+                           ])
+
+            if BACKUP_DEBUG:
+                print " ".join(tar_cmdline)
+
+            tar_sparse = subprocess.Popen(tar_cmdline, stdin=subprocess.PIPE,
+                                          stderr=(open(os.devnull, 'w')
+                                                  if not BACKUP_DEBUG
+                                                  else None),
+                                          close_fds=True)
+        operation.processes_to_kill_on_cancel.append(tar_sparse)
+
+        # Wait for compressor (tar) process to finish or for any error of other
+        # subprocesses
+        i = 0
+        run_error = "paused"
+        encryptor = None
+        encryptor_proc = None
+        compressor_proc = None
+        if file_compressed and not self.compress_pool:
+            # not by tar --use-compress-program: writing to a pipe, tar
+            # pads the compressed data with zeros, which some decompressors
+            # (zstd, lz4) don't accept
+            compressor_proc = subprocess.Popen(self.compression_cmd,
+                                               stdin=open(file_pipe, 'rb'),
+                                               stdout=subprocess.PIPE,
+                                               close_fds=True)
+            operation.processes_to_kill_on_cancel.append(compressor_proc)
+            pipe = compressor_proc.stdout
+        else:
+            pipe = open(file_pipe, 'rb')
+        if self.encrypted:
+            salt = None
+            # the same salt (so key and IV) for the same data, to continue
+            # the interrupted backup in the middle of a file; not used with
+            # stream cipher modes, where that would be unsafe if the data
+            # has changed
+            if self.crypto_algorithm.lower().endswith('-cbc'):
+                salt = self.resumed.salt(
+                    os.path.relpath(backup_tempfile + ".000", self.tmpdir))
+            encryptor = BackupEncryptor.create(self.crypto_algorithm,
+                                               self.passphrase, salt)
+            if encryptor is None:
+                # Start encrypt
+                # If no cipher is provided, the data is forwarded
+                # unencrypted !!!
+                encryptor_proc = subprocess.Popen(
+                    ["openssl", "enc",
+                     "-e", "-" + self.crypto_algorithm,
+                     "-pass", "pass:" + self.passphrase],
+                    stdin=pipe,
+                    stdout=subprocess.PIPE, close_fds=True)
+                pipe.close()
+                pipe = encryptor_proc.stdout
+        if file_compress_pool:
+            stream = BackupStreamReader(
+                ParallelCompressor(pipe, self.compression_filter,
+                                   file_compress_pool,
+                                   2 * self.compress_workers,
+                                   self.compression_level),
+                encryptor)
+        else:
+            stream = BackupStreamReader(pipe, encryptor)
+        while run_error == "paused":
+
+            hmac = BackupHmac(self.hmac_algorithm, self.passphrase)
+
+            # Prepare a first chunk - the space for it (and its HMAC) is
+            # reserved before writing, and the unused part returned when the
+            # size is known
+            chunkfile = backup_tempfile + "." + "%03d" % i
+            i += 1
+            self.budget.acquire(CHUNK_SIZE + HMAC_FILE_MAX_SIZE,
+                                self.keep_waiting,
+                                lambda: not producer["head"].is_set())
+            if self.in_memory:
+                chunkfile_p = StringIO()
+            else:
+                chunkfile_p = open(chunkfile, 'w+b')
+
+            run_error = write_backup_chunk(
+                stream=stream, backup_target=chunkfile_p, hmac=hmac,
+                total_backup_sz=self.total_size,
+                progress_callback=self.progress_callback,
+                streamproc=encryptor_proc, vmproc=self.vmproc,
+                addproc=tar_sparse,
+                size_limit=CHUNK_SIZE)
+            if self.in_memory:
+                chunk_data = chunkfile_p.getvalue()
+                chunk_size = len(chunk_data)
+            else:
+                chunk_data = None
+                # not tell(): the data may be written by splice(); flush
+                # what was written by write()
+                chunkfile_p.flush()
+                chunk_size = os.fstat(chunkfile_p.fileno()).st_size
+            chunkfile_p.close()
+            if run_error == "" and compressor_proc and \
+                    compressor_proc.wait() != 0:
+                run_error = "compressor"
+
+            if BACKUP_DEBUG:
+                print "write_backup_chunk returned:", run_error
+
+            if operation.canceled or self.abort.is_set() or \
+                    run_error not in ("", "size_limit"):
+                try:
+                    tar_sparse.terminate()
+                except:
+                    pass
+                hmac.abort()
+                # unblock the writer, if waiting for the reader
+                pipe.close()
+                tar_sparse.wait()
+                self.budget.release(CHUNK_SIZE + HMAC_FILE_MAX_SIZE)
+                if not self.in_memory:
+                    os.unlink(chunkfile)
+                if operation.canceled or self.abort.is_set():
+                    raise BackupCanceledError("Backup canceled")
+                if run_error == "VM" and self.vmproc:
+                    raise QubesException(
+                        "Failed to write the backup, VM output:\n" +
+                        self.vmproc.stderr.read(MAX_STDERR_BYTES))
+                else:
+                    raise QubesException(
+                        "Failed to perform backup: error in " + run_error)
+
+            self.budget.release(CHUNK_SIZE + HMAC_FILE_MAX_SIZE - chunk_size -
+                                len(hmac.content()))
+            producer["output"].put((os.path.relpath(chunkfile, self.tmpdir),
+                                    chunk_data, chunk_size, hmac))
+            del chunk_data
+
+            if run_error == "size_limit":
+                run_error = "paused"
+            else:
+                # all the data read, wait for tar to exit
+                tar_sparse.wait()
+                operation.processes_to_kill_on_cancel.remove(tar_sparse)
+                if compressor_proc:
+                    operation.processes_to_kill_on_cancel.remove(
+                        compressor_proc)
+                if BACKUP_DEBUG:
+                    print "Finished tar sparse with exit code", tar_sparse \
+                        .poll()
+        pipe.close()
+
+
 def prepare_backup_header(target_directory, passphrase, compressed=False,
                           encrypted=False,
                           hmac_algorithm=DEFAULT_HMAC_ALGORITHM,
                           crypto_algorithm=DEFAULT_CRYPTO_ALGORITHM,
-                          compression_filter=None):
+                          compression_filter=None, backup_id=None,
+                          base_backup_id=None, dedup=False,
+                          compression_adaptive=False):
     header_file_path = os.path.join(target_directory, HEADER_FILENAME)
     with open(header_file_path, "w") as f:
-        f.write(str("%s=%s\n" % (BackupHeader.version,
-                                 CURRENT_BACKUP_FORMAT_VERSION)))
+        if backup_id or dedup or compression_adaptive:
+            f.write(str("%s=%s\n" % (BackupHeader.version,
+                                     EXTENDED_BACKUP_FORMAT_VERSION)))
+        else:
+            f.write(str("%s=%s\n" % (BackupHeader.version,
+                                     CURRENT_BACKUP_FORMAT_VERSION)))
         f.write(str("%s=%s\n" % (BackupHeader.hmac_algorithm, hmac_algorithm)))
         f.write(str("%s=%s\n" % (BackupHeader.crypto_algorithm,
                                  crypto_algorithm)))
@@ -436,13 +2383,20 @@ def prepare_backup_header(target_directory, passphrase, compressed=False,
         if compressed:
             f.write(str("%s=%s\n" % (BackupHeader.compression_filter,
                                      str(compression_filter))))
-
-    hmac = subprocess.Popen(["openssl", "dgst",
-                             "-" + hmac_algorithm, "-hmac", passphrase],
-                            stdin=open(header_file_path, "r"),
-                            stdout=open(header_file_path + ".hmac", "w"))
-    if hmac.wait() != 0:
-        raise QubesException("Failed to compute hmac of header file")
+        if backup_id:
+            f.write(str("%s=%s\n" % (BackupHeader.backup_id, backup_id)))
+        if base_backup_id:
+            f.write(str("%s=%s\n" % (BackupHeader.base_backup_id,
+                                     base_backup_id)))
+        if dedup:
+            f.write(str("%s=%s\n" % (BackupHeader.dedup, str(dedup))))
+        if compression_adaptive:
+            f.write(str("%s=%s\n" % (BackupHeader.compression_adaptive,
+                                     str(compression_adaptive))))
+
+    hmac = BackupHmac(hmac_algorithm, passphrase)
+    hmac.update_from_file(header_file_path)
+    hmac.write(header_file_path + ".hmac")
     return HEADER_FILENAME, HEADER_FILENAME + ".hmac"
 
 
@@ -450,18 +2404,63 @@ def backup_do(base_backup_dir, files_to_backup, passphrase,
               progress_callback=None, encrypted=False, appvm=None,
               compressed=False, hmac_algorithm=DEFAULT_HMAC_ALGORITHM,
               crypto_algorithm=DEFAULT_CRYPTO_ALGORITHM,
-              tmpdir=None):
+              tmpdir=None, incremental=False, dedup=False, resume=False,
+              compression_adaptive=False, inflight_limit=DEFAULT_INFLIGHT_LIMIT,
+              in_memory=False, parallel=1):
+    """
+    Write the backup of *files_to_backup* (as returned by backup_prepare).
+
+    *compressed* is either a bool, or the compression program, optionally
+    with the compression level ("program:level", see
+    parse_compression_filter). With *compression_adaptive*, files which do
+    not compress well (judged from samples of their data) are stored
+    uncompressed.
+
+    With *incremental*, images are backed up as blocks changed since the
+    previous incremental backup (if any) plus manifests of all their blocks.
+    Restore of such backup needs all the previous backups, up to the last
+    non-incremental one.
+
+    With *dedup*, images are split into content-defined chunks and each
+    distinct chunk is stored once in the backup.
+
+    Progress of a backup to a local file is recorded in a journal next to
+    it. With *resume*, an interrupted backup (*base_backup_dir* is either
+    the backup file, or the directory with it) is continued: the backup
+    data is produced again (with the same options and files), but chunks
+    already in the backup file are not written again, as long as they match
+    their HMACs. Only files other than images, complete in the backup and
+    not modified since (by size and modification time), are not read
+    again.
+
+    At most *inflight_limit* bytes of backup data are written to chunks,
+    but not sent to the backup target yet - reading the data waits for the
+    target if needed. The chunks are staged in the temporary directory, or
+    with *in_memory* kept in memory. Time spent waiting is reported in the
+    statistics.
+
+    With *parallel* > 1, that many files are read at once: while the chunks
+    of one file are sent, the following files are written to chunks ahead
+    (within *inflight_limit*). The backup is the same as when the files are
+    read one by one - the chunks are sent in the same order.
+
+    :return: dict of backup statistics
+    """
     global running_backup_operation
 
+    def check_send_proc(proc, vmproc):
+        if not proc.is_alive():
+            if vmproc:
+                message = ("Failed to write the backup, VM output:\n" +
+                           vmproc.stderr.read(MAX_STDERR_BYTES))
+            else:
+                message = "Failed to write the backup. Out of disk space?"
+            raise QubesException(message)
+        # stop waiting for the budget when canceled
+        return not running_backup_operation.canceled
+
     def queue_put_with_check(proc, vmproc, queue, element):
-        if queue.full():
-            if not proc.is_alive():
-                if vmproc:
-                    message = ("Failed to write the backup, VM output:\n" +
-                               vmproc.stderr.read())
-                else:
-                    message = "Failed to write the backup. Out of disk space?"
-                raise QubesException(message)
+        check_send_proc(proc, vmproc)
         queue.put(element)
 
     total_backup_sz = 0
@@ -469,15 +2468,27 @@ def backup_do(base_backup_dir, files_to_backup, passphrase,
     for f in files_to_backup:
         total_backup_sz += f["size"]
 
-    if isinstance(compressed, str):
-        compression_filter = compressed
+    if isinstance(compressed, basestring):
+        try:
+            (compression_filter, compression_level) = \
+                parse_compression_filter(compressed)
+        except ValueError as e:
+            raise QubesException(str(e))
     else:
         compression_filter = DEFAULT_COMPRESSION_FILTER
+        compression_level = None
 
     running_backup_operation = BackupOperationInfo()
     vmproc = None
     tar_sparse = None
+    journal = None
+    resumed_header = None
+    # nothing to skip, unless resuming
+    resumed = ResumedBackup()
     if appvm is not None:
+        if resume:
+            raise QubesException(
+                "Only a backup to a local file can be resumed")
         # Prepare the backup target (Qubes service call)
         backup_target = "QUBESRPC qubes.Backup dom0"
 
@@ -488,6 +2499,14 @@ def backup_do(base_backup_dir, files_to_backup, passphrase,
                            replace("\r", "").replace("\n", "") + "\n")
         backup_stdout = vmproc.stdin
         running_backup_operation.processes_to_kill_on_cancel.append(vmproc)
+    elif resume:
+        backup_target = get_resumable_backup(base_backup_dir)
+        journal, resumed_header, chunks = backup_resume_prepare(
+            backup_target, passphrase)
+        backup_stdout = open(backup_target, 'r+b')
+        backup_stdout.seek(journal.entries[-1][1] if journal.entries else 0)
+        backup_stdout.truncate()
+        resumed = ResumedBackup(backup_stdout, journal, chunks)
     else:
         # Prepare the backup target (local file)
         if os.path.isdir(base_backup_dir):
@@ -504,6 +2523,9 @@ def backup_do(base_backup_dir, files_to_backup, passphrase,
 
         # If not APPVM, STDOUT is a local file
         backup_stdout = open(backup_target, 'wb')
+        if stat.S_ISREG(os.fstat(backup_stdout.fileno()).st_mode):
+            journal = BackupJournal.create(
+                backup_target + BACKUP_JOURNAL_SUFFIX)
 
     global blocks_backedup
     blocks_backedup = 0
@@ -514,195 +2536,158 @@ def backup_do(base_backup_dir, files_to_backup, passphrase,
     backup_tmpdir = tempfile.mkdtemp(prefix="backup_", dir=tmpdir)
     running_backup_operation.tmpdir_to_remove = backup_tmpdir
 
-    # Tar with tape length does not deals well with stdout (close stdout between
-    # two tapes)
-    # For this reason, we will use named pipes instead
     if BACKUP_DEBUG:
         print "Working in", backup_tmpdir
 
-    backup_pipe = os.path.join(backup_tmpdir, "backup_pipe")
-    if BACKUP_DEBUG:
-        print "Creating pipe in:", backup_pipe
-    os.mkfifo(backup_pipe)
-
     if BACKUP_DEBUG:
         print "Will backup:", files_to_backup
 
+    backup_id = None
+    base_backup_id = None
+    if incremental:
+        if resumed_header:
+            backup_id = resumed_header.get(BackupHeader.backup_id)
+        else:
+            backup_id = uuid.uuid4().hex
+        base_backup_id = get_last_backup_id()
+
     header_files = prepare_backup_header(backup_tmpdir, passphrase,
                                          compressed=bool(compressed),
                                          encrypted=encrypted,
                                          hmac_algorithm=hmac_algorithm,
                                          crypto_algorithm=crypto_algorithm,
-                                         compression_filter=compression_filter)
+                                         compression_filter=compression_filter,
+                                         backup_id=backup_id,
+                                         base_backup_id=base_backup_id,
+                                         dedup=dedup,
+                                         compression_adaptive=bool(
+                                             compressed and
+                                             compression_adaptive))
+    if resumed_header:
+        with open(os.path.join(backup_tmpdir, HEADER_FILENAME)) as f:
+            if f.read() != resumed_header[HEADER_FILENAME]:
+                shutil.rmtree(backup_tmpdir)
+                raise QubesException(
+                    "Cannot resume the backup: options differ from the "
+                    "interrupted backup")
 
     # Setup worker to send encrypted data chunks to the backup_target
+    progress_lock = threading.Lock()
+
     def compute_progress(new_size, total_backup_size):
         global blocks_backedup
-        blocks_backedup += new_size
-        if callable(progress_callback):
-            this_progress = blocks_backedup / float(total_backup_size)
-            progress_callback(int(round(this_progress * 100, 2)))
-
-    to_send = Queue(10)
-    send_proc = SendWorker(to_send, backup_tmpdir, backup_stdout)
+        # called by producers of several files at once
+        with progress_lock:
+            blocks_backedup += new_size
+            if callable(progress_callback):
+                this_progress = blocks_backedup / float(total_backup_size)
+                progress_callback(int(round(this_progress * 100, 2)))
+
+    # the amount of queued data is limited by send_budget
+    to_send = Queue()
+    send_budget = SendBudget(inflight_limit)
+    send_proc = SendWorker(to_send, backup_tmpdir, backup_stdout, journal,
+                           send_budget)
     send_proc.start()
 
-    for f in header_files:
-        to_send.put(f)
-
-    for filename in files_to_backup:
-        if BACKUP_DEBUG:
-            print "Backing up", filename
-
-        backup_tempfile = os.path.join(backup_tmpdir,
-                                       filename["subdir"],
-                                       os.path.basename(filename["path"]))
-        if BACKUP_DEBUG:
-            print "Using temporary location:", backup_tempfile
-
-        # Ensure the temporary directory exists
-        if not os.path.isdir(os.path.dirname(backup_tempfile)):
-            os.makedirs(os.path.dirname(backup_tempfile))
-
-        # The first tar cmd can use any complex feature as we want. Files will
-        # be verified before untaring this.
-        # Prefix the path in archive with filename["subdir"] to have it
-        # verified during untar
-        tar_cmdline = (["tar", "-Pc", '--sparse',
-                       "-f", backup_pipe,
-                       '-C', os.path.dirname(filename["path"])] +
-                       (['--dereference'] if filename["subdir"] != "dom0-home/"
-                       else []) +
-                       ['--xform', 's:^%s:%s\\0:' % (
-                           os.path.basename(filename["path"]),
-                           filename["subdir"]),
-                       os.path.basename(filename["path"])
-                       ])
-        if compressed:
-            tar_cmdline.insert(-1,
-                               "--use-compress-program=%s" % compression_filter)
-
-        if BACKUP_DEBUG:
-            print " ".join(tar_cmdline)
-
-        # Tips: Popen(bufsize=0)
-        # Pipe: tar-sparse | encryptor [| hmac] | tar | backup_target
-        # Pipe: tar-sparse [| hmac] | tar | backup_target
-        tar_sparse = subprocess.Popen(tar_cmdline, stdin=subprocess.PIPE,
-                                      stderr=(open(os.devnull, 'w')
-                                              if not BACKUP_DEBUG
-                                              else None))
-        running_backup_operation.processes_to_kill_on_cancel.append(tar_sparse)
-
-        # Wait for compressor (tar) process to finish or for any error of other
-        # subprocesses
-        i = 0
-        run_error = "paused"
-        encryptor = None
-        if encrypted:
-            # Start encrypt
-            # If no cipher is provided, the data is forwarded unencrypted !!!
-            encryptor = subprocess.Popen(["openssl", "enc",
-                                          "-e", "-" + crypto_algorithm,
-                                          "-pass", "pass:" + passphrase],
-                                         stdin=open(backup_pipe, 'rb'),
-                                         stdout=subprocess.PIPE)
-            pipe = encryptor.stdout
-        else:
-            pipe = open(backup_pipe, 'rb')
-        while run_error == "paused":
-
-            # Start HMAC
-            hmac = subprocess.Popen(["openssl", "dgst",
-                                     "-" + hmac_algorithm, "-hmac", passphrase],
-                                    stdin=subprocess.PIPE,
-                                    stdout=subprocess.PIPE)
-
-            # Prepare a first chunk
-            chunkfile = backup_tempfile + "." + "%03d" % i
-            i += 1
-            chunkfile_p = open(chunkfile, 'wb')
-
-            common_args = {
-                'backup_target': chunkfile_p,
-                'total_backup_sz': total_backup_sz,
-                'hmac': hmac,
-                'vmproc': vmproc,
-                'addproc': tar_sparse,
-                'progress_callback': compute_progress,
-                'size_limit': 100 * 1024 * 1024,
-            }
-            run_error = wait_backup_feedback(
-                in_stream=pipe, streamproc=encryptor,
-                **common_args)
-            chunkfile_p.close()
-
-            if BACKUP_DEBUG:
-                print "Wait_backup_feedback returned:", run_error
+    with open(os.path.join(backup_tmpdir, header_files[1])) as f:
+        header_digest = load_hmac(f.read())
+    if not resumed.chunk_in_backup(header_files[0], header_digest):
+        for f in header_files:
+            send_budget.acquire(os.path.getsize(os.path.join(backup_tmpdir, f)))
+            queue_put_with_check(send_proc, vmproc, to_send, f)
+
+    backup_stats = {}
+    producer = BackupProducer(backup_tmpdir, passphrase, send_budget,
+                              lambda: check_send_proc(send_proc, vmproc),
+                              running_backup_operation, total_backup_sz,
+                              compute_progress, vmproc=vmproc,
+                              resumed=resumed, encrypted=encrypted,
+                              crypto_algorithm=crypto_algorithm,
+                              hmac_algorithm=hmac_algorithm,
+                              compressed=bool(compressed),
+                              compression_filter=compression_filter,
+                              compression_level=compression_level,
+                              compression_adaptive=compression_adaptive,
+                              in_memory=in_memory, incremental=incremental,
+                              backup_id=backup_id, dedup=dedup,
+                              stats=backup_stats)
+
+    # Files are read by up to *parallel* threads at once: the one of the
+    # file being sent, and the following ones producing their chunks ahead
+    files = iter(files_to_backup)
+    while True:
+        while len(producer.files) < parallel:
+            fileinfo = next(files, None)
+            if fileinfo is None:
+                break
+            producer.start_file(fileinfo)
+        if not producer.files:
+            break
 
+        chunk_sent = False
+        for chunk in iter(producer.files[0]["output"].get, None):
             if running_backup_operation.canceled:
-                try:
-                    tar_sparse.terminate()
-                except:
-                    pass
-                try:
-                    hmac.terminate()
-                except:
-                    pass
-                tar_sparse.wait()
-                hmac.wait()
+                producer.stop()
                 to_send.put("ERROR")
                 send_proc.join()
                 shutil.rmtree(backup_tmpdir)
                 running_backup_operation = None
                 raise BackupCanceledError("Backup canceled")
-            if run_error and run_error != "size_limit":
+            if isinstance(chunk, Exception):
+                producer.stop()
                 send_proc.terminate()
-                if run_error == "VM" and vmproc:
-                    raise QubesException(
-                        "Failed to write the backup, VM output:\n" +
-                        vmproc.stderr.read(MAX_STDERR_BYTES))
-                else:
-                    raise QubesException("Failed to perform backup: error in " +
-                                         run_error)
+                raise chunk
+            if isinstance(chunk, dict):
+                # the file is complete in the backup - unless its chunks were
+                # all kept from the interrupted backup, then it is recorded
+                # already
+                if journal and chunk_sent:
+                    queue_put_with_check(send_proc, vmproc, to_send, chunk)
+                continue
 
-            # Send the chunk to the backup target
-            queue_put_with_check(
-                send_proc, vmproc, to_send,
-                os.path.relpath(chunkfile, backup_tmpdir))
+            (chunkname, chunk_data, chunk_size, hmac) = chunk
+            chunkfile = os.path.join(backup_tmpdir, chunkname)
+            if resumed.chunk_in_backup(chunkname, hmac.hexdigest()):
+                # already written before the backup was interrupted
+                send_budget.release(chunk_size + len(hmac.content()))
+                if not in_memory:
+                    os.unlink(chunkfile)
+                chunk_sent = False
+            else:
+                chunk_sent = True
+                # Send the chunk to the backup target
+                queue_put_with_check(
+                    send_proc, vmproc, to_send,
+                    (chunkname, chunk_data) if in_memory else chunkname)
+
+                # Send the HMAC to the backup target
+                if in_memory:
+                    queue_put_with_check(send_proc, vmproc, to_send,
+                                         (chunkname + ".hmac",
+                                          hmac.content()))
+                else:
+                    # Write HMAC data next to the chunk file
+                    if BACKUP_DEBUG:
+                        print "Writing hmac to", chunkfile + ".hmac"
+                    hmac.write(chunkfile + ".hmac")
+                    queue_put_with_check(send_proc, vmproc, to_send,
+                                         chunkname + ".hmac")
+            del chunk, chunk_data
 
-            # Close HMAC
-            hmac.stdin.close()
-            hmac.wait()
-            if BACKUP_DEBUG:
-                print "HMAC proc return code:", hmac.poll()
+        producer.next_file()
+    producer.close()
 
-            # Write HMAC data next to the chunk file
-            hmac_data = hmac.stdout.read()
-            if BACKUP_DEBUG:
-                print "Writing hmac to", chunkfile + ".hmac"
-            hmac_file = open(chunkfile + ".hmac", 'w')
-            hmac_file.write(hmac_data)
-            hmac_file.flush()
-            hmac_file.close()
-
-            # Send the HMAC to the backup target
-            queue_put_with_check(
-                send_proc, vmproc, to_send,
-                os.path.relpath(chunkfile, backup_tmpdir) + ".hmac")
-
-            if tar_sparse.poll() is None or run_error == "size_limit":
-                run_error = "paused"
-            else:
-                running_backup_operation.processes_to_kill_on_cancel.remove(
-                    tar_sparse)
-                if BACKUP_DEBUG:
-                    print "Finished tar sparse with exit code", tar_sparse \
-                        .poll()
-        pipe.close()
+    resumed.finish()
 
     queue_put_with_check(send_proc, vmproc, to_send, "FINISHED")
     send_proc.join()
+    backup_stats.update(send_budget.stats())
+    if not running_backup_operation.canceled and send_proc.exitcode == 0:
+        if incremental:
+            install_backup_manifests(producer.manifests, backup_id)
+        if journal:
+            journal.remove()
     shutil.rmtree(backup_tmpdir)
 
     if running_backup_operation.canceled:
@@ -734,6 +2719,84 @@ def backup_do(base_backup_dir, files_to_backup, passphrase,
     qvm_collection.save()
     qvm_collection.unlock_db()
 
+    return backup_stats
+
+
+def write_backup_chunk(progress_callback, stream, backup_target,
+                       total_backup_sz, hmac, size_limit, streamproc=None,
+                       vmproc=None, addproc=None):
+    """
+    Copy a single chunk of backup data from *stream* (BackupStreamReader) to
+    *backup_target*, updating *hmac* with it. Monitor the processes
+    (streamproc, vmproc, addproc) for errors. If the data doesn't need
+    processing in Python and *backup_target* is a file, it is moved with
+    splice() and HMAC is computed from the chunk file mapped into memory
+    (*backup_target* must be opened for reading too).
+
+    :return: "size_limit" if the chunk is full, "" at the end of data,
+    otherwise name of the failed process
+    """
+    splice_fd = None
+    if hasattr(backup_target, 'fileno'):
+        splice_fd = stream.splice_fd()
+    if splice_fd is not None:
+        backup_target.flush()
+
+    bytes_copied = 0
+    run_error = "size_limit"
+    while bytes_copied < size_limit:
+        size = min(BUFFER_SIZE, size_limit - bytes_copied)
+        buf = None
+        try:
+            if splice_fd is not None:
+                count = splice(splice_fd, backup_target.fileno(), size)
+            else:
+                buf = stream.read(size)
+                count = len(buf)
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                return "target"
+            else:
+                raise
+        if not count:
+            if streamproc and streamproc.wait() != 0:
+                return "streamproc"
+            run_error = ""
+            break
+        progress_callback(count, total_backup_sz)
+
+        if addproc:
+            retcode = addproc.poll()
+            if retcode is not None and retcode != 0:
+                return "addproc"
+
+        if vmproc:
+            retcode = vmproc.poll()
+            if retcode is not None and retcode != 0:
+                if BACKUP_DEBUG:
+                    print vmproc.stdout.read()
+                return "VM"
+
+        if streamproc:
+            retcode = streamproc.poll()
+            if retcode is not None and retcode != 0:
+                return "streamproc"
+
+        if buf is not None:
+            try:
+                backup_target.write(buf)
+            except IOError as e:
+                if e.errno == errno.EPIPE:
+                    return "target"
+                else:
+                    raise
+            hmac.update(buf)
+        bytes_copied += count
+
+    if splice_fd is not None:
+        hmac.update_from_fd(backup_target.fileno(), bytes_copied)
+    return run_error
+
 
 '''
 ' Wait for backup chunk to finish
@@ -758,6 +2821,24 @@ def wait_backup_feedback(progress_callback, in_stream, streamproc,
                          size_limit=None):
     buffer_size = 409600
 
+    # move the data with splice() if possible - when nothing needs to see
+    # it (no hmac) and one of the ends is a pipe
+    splice_fds = None
+    if splice_present and hmac is None:
+        try:
+            in_fd = in_stream.fileno()
+            out_fd = backup_target.fileno()
+        except AttributeError:
+            pass
+        else:
+            if is_pipe(in_fd) or is_pipe(out_fd):
+                for fd in (in_fd, out_fd):
+                    if is_pipe(fd):
+                        set_pipe_size(fd)
+                splice_fds = (in_fd, out_fd)
+                buffer_size = BUFFER_SIZE
+                backup_target.flush()
+
     run_error = None
     run_count = 1
     bytes_copied = 0
@@ -765,9 +2846,20 @@ def wait_backup_feedback(progress_callback, in_stream, streamproc,
 
         if size_limit and bytes_copied + buffer_size > size_limit:
             return "size_limit"
-        buf = in_stream.read(buffer_size)
-        progress_callback(len(buf), total_backup_sz)
-        bytes_copied += len(buf)
+        if splice_fds:
+            buf = None
+            try:
+                count = splice(splice_fds[0], splice_fds[1], buffer_size)
+            except IOError as e:
+                if e.errno == errno.EPIPE:
+                    return "target"
+                else:
+                    raise
+        else:
+            buf = in_stream.read(buffer_size)
+            count = len(buf)
+        progress_callback(count, total_backup_sz)
+        bytes_copied += count
 
         run_count = 0
         if hmac:
@@ -803,14 +2895,18 @@ def wait_backup_feedback(progress_callback, in_stream, streamproc,
                 if retcode != 0:
                     run_error = "streamproc"
                     break
-                elif retcode == 0 and len(buf) <= 0:
+                elif retcode == 0 and count <= 0:
                     return ""
             run_count += 1
 
         else:
-            if len(buf) <= 0:
+            if count <= 0:
                 return ""
 
+        if buf is None:
+            # already written by splice()
+            continue
+
         try:
             backup_target.write(buf)
         except IOError as e:
@@ -822,6 +2918,10 @@ def wait_backup_feedback(progress_callback, in_stream, streamproc,
         if hmac:
             hmac.stdin.write(buf)
 
+    if run_error is None:
+        # all the processes exited successfully before the end of data
+        # (e.g. tar stops reading at the end of archive, before the padding)
+        return ""
     return run_error
 
 
@@ -834,30 +2934,24 @@ def verify_hmac(filename, hmacfile, passphrase, algorithm):
             "ERROR: expected hmac for {}, but got {}".
             format(filename, hmacfile))
 
-    hmac_proc = subprocess.Popen(["openssl", "dgst", "-" + algorithm,
-                                  "-hmac", passphrase],
-                                 stdin=open(filename, 'rb'),
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    hmac_stdout, hmac_stderr = hmac_proc.communicate()
+    hmac_computed = BackupHmac(algorithm, passphrase)
+    hmac_computed.update_from_file(filename)
+    hmac_computed = hmac_computed.hexdigest()
 
-    if len(hmac_stderr) > 0:
-        raise QubesException(
-            "ERROR: verify file {0}: {1}".format(filename, hmac_stderr))
-    else:
-        if BACKUP_DEBUG:
-            print "Loading hmac for file " + filename
-        hmac = load_hmac(open(hmacfile, 'r').read())
+    if BACKUP_DEBUG:
+        print "Loading hmac for file " + filename
+    hmac = load_hmac(open(hmacfile, 'r').read())
 
-        if len(hmac) > 0 and load_hmac(hmac_stdout) == hmac:
-            os.unlink(hmacfile)
-            if BACKUP_DEBUG:
-                print "File verification OK -> Sending file " + filename
-            return True
-        else:
-            raise QubesException(
-                "ERROR: invalid hmac for file {0}: {1}. "
-                "Is the passphrase correct?".
-                format(filename, load_hmac(hmac_stdout)))
+    if len(hmac) > 0 and hmac_computed == hmac:
+        os.unlink(hmacfile)
+        if BACKUP_DEBUG:
+            print "File verification OK -> Sending file " + filename
+        return True
+    else:
+        raise QubesException(
+            "ERROR: invalid hmac for file {0}: {1}. "
+            "Is the passphrase correct?".
+            format(filename, hmac_computed))
     # Not reachable
     return False
 
@@ -1289,6 +3383,14 @@ def parse_backup_header(filename):
     return header_data
 
 
+def get_decompression_filter(header_data):
+    """Decompression program for data of the backup with *header_data*"""
+    if header_data.get(BackupHeader.compression_adaptive):
+        return ADAPTIVE_DECOMPRESSION_FILTER
+    return header_data.get(BackupHeader.compression_filter,
+                           DEFAULT_COMPRESSION_FILTER)
+
+
 def restore_vm_dirs(backup_source, restore_tmpdir, passphrase, vms_dirs, vms,
                     vms_size, print_callback=None, error_callback=None,
                     progress_callback=None, encrypted=False, appvm=None,
@@ -1296,7 +3398,14 @@ def restore_vm_dirs(backup_source, restore_tmpdir, passphrase, vms_dirs, vms,
                     crypto_algorithm=DEFAULT_CRYPTO_ALGORITHM,
                     verify_only=False,
                     format_version=CURRENT_BACKUP_FORMAT_VERSION,
-                    compression_filter=None):
+                    compression_filter=None, extra_archives=0,
+                    allow_missing=False):
+    """
+    Extract *vms_dirs* from the backup into *restore_tmpdir*.
+    *extra_archives* is the number of archives to extract outside of
+    *vms_dirs* (packs of deduplicated chunks). With *allow_missing*, it is
+    not an error if some of *vms_dirs* are not in the backup.
+    """
     global running_backup_operation
 
     if callable(print_callback):
@@ -1347,8 +3456,8 @@ def restore_vm_dirs(backup_source, restore_tmpdir, passphrase, vms_dirs, vms,
         # chunks. Additionally each file have own hmac file. So assume upper
         # limit as 2*(10*COUNT_OF_VMS+TOTAL_SIZE/100MB)
         tar1_env['UPDATES_MAX_FILES'] = str(2 * (10 * len(vms_dirs) +
-                                                 int(vms_size /
-                                                     (100 * 1024 * 1024))))
+                                                 extra_archives +
+                                                 int(vms_size / CHUNK_SIZE)))
     if BACKUP_DEBUG and callable(print_callback):
         print_callback("Run command" + unicode(tar1_command))
     command = subprocess.Popen(
@@ -1371,7 +3480,8 @@ def restore_vm_dirs(backup_source, restore_tmpdir, passphrase, vms_dirs, vms,
     else:
         filelist_pipe = command.stdout
 
-    expect_tar_error = False
+    # tar exits with an error if any of requested files is not found
+    expect_tar_error = allow_missing
 
     to_extract = Queue()
     nextfile = None
@@ -1426,8 +3536,7 @@ def restore_vm_dirs(backup_source, restore_tmpdir, passphrase, vms_dirs, vms,
             if BackupHeader.encrypted in header_data:
                 encrypted = header_data[BackupHeader.encrypted]
             if BackupHeader.compression_filter in header_data:
-                compression_filter = header_data[
-                    BackupHeader.compression_filter]
+                compression_filter = get_decompression_filter(header_data)
             os.unlink(filename)
         else:
             # if no header found, create one with guessed HMAC algo
@@ -1458,7 +3567,7 @@ def restore_vm_dirs(backup_source, restore_tmpdir, passphrase, vms_dirs, vms,
     }
     if format_version == 2:
         extract_proc = ExtractWorker2(**extractor_params)
-    elif format_version == 3:
+    elif format_version in [3, 4]:
         extractor_params['compression_filter'] = compression_filter
         extract_proc = ExtractWorker3(**extractor_params)
     else:
@@ -1576,6 +3685,8 @@ def backup_restore_set_defaults(options):
         options['verify-only'] = False
     if 'rename-conflicting' not in options:
         options['rename-conflicting'] = False
+    if 'base-backups' not in options:
+        options['base-backups'] = []
 
     return options
 
@@ -1643,6 +3754,56 @@ def backup_restore_header(source, passphrase,
     return (restore_tmpdir, os.path.join(restore_tmpdir, "qubes.xml"),
             header_data)
 
+def backup_restore_chain_prepare(base_locations, base_backup_id, passphrase,
+                                 appvm=None, print_callback=print_stdout,
+                                 error_callback=print_stderr):
+    """
+    Read headers of the base backups of an incremental backup and check that
+    they form a complete chain: a full backup, followed by incremental ones,
+    the last being *base_backup_id*.
+
+    :param base_locations: locations of base backups, the oldest first
+    :return: list of restore parameters of the base backups, the oldest first
+    """
+    if not base_locations:
+        raise QubesException(
+            "This is an incremental backup, to restore it give also all the "
+            "previous backups, starting from the full one")
+    base_backups = []
+    expected_base_id = ''
+    for location in base_locations:
+        (tmpdir, _, header_data) = backup_restore_header(
+            location, passphrase, appvm=appvm,
+            print_callback=print_callback, error_callback=error_callback)
+        shutil.rmtree(tmpdir)
+        if not header_data or BackupHeader.backup_id not in header_data:
+            raise QubesException(
+                "Backup {0} was not created as incremental backup".format(
+                    location))
+        backup_base_id = header_data.get(BackupHeader.base_backup_id, '')
+        if backup_base_id != expected_base_id:
+            raise QubesException(
+                "Backup {0} is based on backup '{1}', but previous backup "
+                "given is '{2}'".format(location, backup_base_id,
+                                        expected_base_id))
+        expected_base_id = header_data[BackupHeader.backup_id]
+        base_backups.append({
+            'location': location,
+            'encrypted': header_data[BackupHeader.encrypted],
+            'compressed': header_data[BackupHeader.compressed],
+            'compression_filter': get_decompression_filter(header_data),
+            'hmac_algorithm': header_data[BackupHeader.hmac_algorithm],
+            'crypto_algorithm': header_data[BackupHeader.crypto_algorithm],
+            'format_version': header_data[BackupHeader.version],
+            'dedup': header_data.get(BackupHeader.dedup, False),
+        })
+    if expected_base_id != base_backup_id:
+        raise QubesException(
+            "The backup is based on backup '{0}', but the last base backup "
+            "given is '{1}'".format(base_backup_id, expected_base_id))
+    return base_backups
+
+
 def generate_new_name_for_conflicting_vm(orig_name, host_collection,
                                          restore_info):
     number = 1
@@ -1770,6 +3931,7 @@ def backup_restore_prepare(backup_location, passphrase, options=None,
     # Options introduced in backup format 3+, which always have a header,
     # so no need for fallback in function parameter
     compression_filter = DEFAULT_COMPRESSION_FILTER
+    dedup = False
 
     # Private functions begin
     def is_vm_included_in_backup_v1(backup_dir, check_vm):
@@ -1814,7 +3976,7 @@ def backup_restore_prepare(backup_location, passphrase, options=None,
 
     if format_version == 1:
         is_vm_included_in_backup = is_vm_included_in_backup_v1
-    elif format_version in [2, 3]:
+    elif format_version in [2, 3, 4]:
         is_vm_included_in_backup = is_vm_included_in_backup_v2
         if not appvm:
             if not os.path.isfile(backup_location):
@@ -1849,7 +4011,19 @@ def backup_restore_prepare(backup_location, passphrase, options=None,
         if BackupHeader.encrypted in header_data:
             encrypted = header_data[BackupHeader.encrypted]
         if BackupHeader.compression_filter in header_data:
-            compression_filter = header_data[BackupHeader.compression_filter]
+            compression_filter = get_decompression_filter(header_data)
+        if BackupHeader.dedup in header_data:
+            dedup = header_data[BackupHeader.dedup]
+
+    base_backups = []
+    if header_data and header_data.get(BackupHeader.base_backup_id):
+        base_backups = backup_restore_chain_prepare(
+            options['base-backups'], header_data[BackupHeader.base_backup_id],
+            passphrase, appvm=appvm, print_callback=print_callback,
+            error_callback=error_callback)
+    elif options['base-backups']:
+        raise QubesException("Base backups given, but this is not an "
+                             "incremental backup (or it is the first one)")
 
     if BACKUP_DEBUG:
         print "Loading file", qubes_xml
@@ -1907,6 +4081,14 @@ def backup_restore_prepare(backup_location, passphrase, options=None,
     options['crypto_algorithm'] = crypto_algorithm
     options['appvm'] = appvm
     options['format_version'] = format_version
+    options['base_backups'] = base_backups
+    options['dedup'] = dedup
+    # deduplicated chunks of all the VMs are extracted, regardless of VMs
+    # selected for restore
+    options['backup_size'] = sum(vm.backup_size for vm in backup_vms_list
+                                 if vm.backup_content)
+    options['backup_vms_count'] = len([vm for vm in backup_vms_list
+                                       if vm.backup_content])
     vms_to_restore['$OPTIONS$'] = options
 
     vms_to_restore = restore_info_verify(vms_to_restore, host_collection)
@@ -2076,11 +4258,6 @@ def backup_restore_do(restore_info,
     backup_location = options['location']
     restore_tmpdir = options['restore_tmpdir']
     passphrase = options['passphrase']
-    encrypted = options['encrypted']
-    compressed = options['compressed']
-    compression_filter = options['compression_filter']
-    hmac_algorithm = options['hmac_algorithm']
-    crypto_algorithm = options['crypto_algorithm']
     verify_only = options['verify-only']
     appvm = options['appvm']
     format_version = options['format_version']
@@ -2117,33 +4294,100 @@ def backup_restore_do(restore_info,
             vms_dirs.append(os.path.dirname(restore_info['dom0']['subdir']))
             vms_size += restore_info['dom0']['size']
 
-        try:
-            restore_vm_dirs(backup_location,
-                            restore_tmpdir,
-                            passphrase=passphrase,
-                            vms_dirs=vms_dirs,
-                            vms=vms,
-                            vms_size=vms_size,
-                            format_version=format_version,
-                            hmac_algorithm=hmac_algorithm,
-                            crypto_algorithm=crypto_algorithm,
-                            verify_only=verify_only,
-                            print_callback=print_callback,
-                            error_callback=error_callback,
-                            progress_callback=progress_callback,
-                            encrypted=encrypted,
-                            compressed=compressed,
-                            compression_filter=compression_filter,
-                            appvm=appvm)
-        except QubesException:
+        # Incremental backup: extract the full backup first, then each
+        # increment to a separate directory and merge it
+        # VM sizes are not known for base backups, use the current ones. Base
+        # backups may not contain some of the VMs, and backups with
+        # deduplicated images the packs (if no new chunks)
+        backup_chain = options.get('base_backups', []) + [options]
+        # VMs with data lost on the way - skip them in later increments
+        failed_vms_dirs = set()
+        for (chain_index, backup_params) in enumerate(backup_chain):
+            extract_dir = restore_tmpdir
+            if chain_index > 0:
+                extract_dir = tempfile.mkdtemp(prefix="increment_",
+                                               dir=restore_tmpdir)
+            extract_dirs = vms_dirs
+            extract_size = vms_size
+            extra_archives = 0
+            if backup_params.get('dedup'):
+                # a pack for each image (at most 2 per VM)
+                extract_dirs = vms_dirs + [DEDUP_DIR]
+                extract_size = vms_size + options.get('backup_size', 0)
+                extra_archives = 2 * options.get('backup_vms_count', 0)
+            try:
+                restore_vm_dirs(backup_params['location'],
+                                extract_dir,
+                                passphrase=passphrase,
+                                vms_dirs=extract_dirs,
+                                vms=vms,
+                                vms_size=extract_size,
+                                format_version=backup_params['format_version'],
+                                hmac_algorithm=backup_params['hmac_algorithm'],
+                                crypto_algorithm=backup_params[
+                                    'crypto_algorithm'],
+                                verify_only=verify_only,
+                                print_callback=print_callback,
+                                error_callback=error_callback,
+                                progress_callback=progress_callback,
+                                encrypted=backup_params['encrypted'],
+                                compressed=backup_params['compressed'],
+                                compression_filter=backup_params[
+                                    'compression_filter'],
+                                extra_archives=extra_archives,
+                                allow_missing=(
+                                    chain_index < len(backup_chain) - 1 or
+                                    backup_params.get('dedup')),
+                                appvm=appvm)
+            except QubesException:
+                if verify_only:
+                    raise
+                else:
+                    if callable(print_callback):
+                        print_callback(
+                            "Some errors occurred during data extraction, "
+                            "continuing anyway to restore at least some "
+                            "VMs")
             if verify_only:
-                raise
-            else:
-                if callable(print_callback):
-                    print_callback(
-                        "Some errors occurred during data extraction, "
-                        "continuing anyway to restore at least some "
-                        "VMs")
+                continue
+            for vm_dir in vms_dirs:
+                if not os.path.isdir(os.path.join(extract_dir, vm_dir)):
+                    continue
+                if vm_dir in failed_vms_dirs:
+                    shutil.rmtree(os.path.join(extract_dir, vm_dir))
+                    continue
+                try:
+                    if backup_params.get('dedup'):
+                        restore_deduplicated_images(extract_dir, vm_dir)
+                    if extract_dir != restore_tmpdir:
+                        merge_backup_increment(
+                            os.path.join(extract_dir, vm_dir),
+                            os.path.join(restore_tmpdir, vm_dir))
+                except (QubesException, EnvironmentError) as err:
+                    error_callback("ERROR: {0}".format(err))
+                    error_callback("*** VM data in {0} not restored".format(
+                        vm_dir))
+                    failed_vms_dirs.add(vm_dir)
+                    shutil.rmtree(os.path.join(restore_tmpdir, vm_dir),
+                                  ignore_errors=True)
+            if backup_params.get('dedup'):
+                shutil.rmtree(os.path.join(extract_dir, DEDUP_DIR),
+                              ignore_errors=True)
+            if extract_dir != restore_tmpdir:
+                shutil.rmtree(extract_dir)
+
+        if format_version >= 4 and not verify_only:
+            for vm_dir in vms_dirs:
+                if not os.path.isdir(os.path.join(restore_tmpdir, vm_dir)):
+                    continue
+                try:
+                    verify_restored_images(os.path.join(restore_tmpdir,
+                                                        vm_dir))
+                except (QubesException, EnvironmentError) as err:
+                    error_callback("ERROR: {0}".format(err))
+                    error_callback("*** VM data in {0} not restored".format(
+                        vm_dir))
+                    shutil.rmtree(os.path.join(restore_tmpdir, vm_dir))
     else:
         if verify_only:
             if callable(print_callback):
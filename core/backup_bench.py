@@ -0,0 +1,148 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+# Benchmark of backup data path: copying a disk image into backup chunks
+# (with HMAC) and from chunk files into a pipe (restore), using either the
+# read/write loop or splice(). Does not need any VM:
+#   python2 -m qubes.backup_bench [-s SIZE] [image]
+
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import backup
+
+MB = 1024 * 1024
+
+
+def create_image(path, size):
+    """Create image of *size* bytes with not compressible content"""
+    block = os.urandom(MB)
+    with open(path, 'wb') as f:
+        for _ in range(size / MB):
+            f.write(block)
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(func, *args):
+    """
+    Run func(*args)
+
+    :return: tuple (wall time, cpu time of this process)
+    """
+    start = time.time()
+    start_cpu = cpu_time()
+    func(*args)
+    return time.time() - start, cpu_time() - start_cpu
+
+
+def no_progress(count, total):
+    pass
+
+
+def run_backup(image, workdir):
+    """Write the image into chunks, like backup_do() does with tar output"""
+    proc = subprocess.Popen(['cat', image], stdout=subprocess.PIPE)
+    stream = backup.BackupStreamReader(proc.stdout)
+    i = 0
+    run_error = "size_limit"
+    while run_error == "size_limit":
+        chunkfile = os.path.join(workdir, "chunk.%03d" % i)
+        i += 1
+        hmac = backup.BackupHmac(backup.DEFAULT_HMAC_ALGORITHM, 'bench')
+        with open(chunkfile, 'w+b') as chunkfile_p:
+            run_error = backup.write_backup_chunk(
+                progress_callback=no_progress, stream=stream,
+                backup_target=chunkfile_p, total_backup_sz=0, hmac=hmac,
+                size_limit=backup.CHUNK_SIZE, addproc=proc)
+        hmac.hexdigest()
+        os.unlink(chunkfile)
+    proc.wait()
+    if run_error:
+        raise RuntimeError("Backup failed: error in " + run_error)
+
+
+def run_restore(image, workdir):
+    """Send the image to a process, like ExtractWorker3 does with chunks"""
+    proc = subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                            stdout=open(os.devnull, 'w'))
+    with open(image, 'rb') as in_stream:
+        run_error = backup.wait_backup_feedback(
+            progress_callback=no_progress, in_stream=in_stream,
+            streamproc=None, backup_target=proc.stdin, total_backup_sz=0,
+            addproc=proc)
+    proc.stdin.close()
+    proc.wait()
+    if run_error:
+        raise RuntimeError("Restore failed: error in " + run_error)
+
+
+def main():
+    usage = "usage: %prog [options] [image]"
+    parser = OptionParser(usage)
+    parser.add_option("-s", "--size", dest="size", type="int", default=2048,
+                      help="Size (in MB) of test image, when no image given")
+    parser.add_option("-d", "--dir", dest="dir", default="/var/tmp",
+                      help="Directory for temporary files")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="Number of runs of each test, the best is reported")
+    (options, args) = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="backup-bench-", dir=options.dir)
+    try:
+        if args:
+            image = args[0]
+        else:
+            image = os.path.join(workdir, "private.img")
+            create_image(image, options.size * MB)
+        size = os.path.getsize(image)
+        # read the image once, so all the tests start with it in page cache
+        subprocess.check_call(['cat', image], stdout=open(os.devnull, 'w'))
+
+        print "image: {0} ({1} MB), splice {2}available".format(
+            image, size / MB, "" if backup.splice_present else "not ")
+        print "{0:<8} {1:<7} {2:>9} {3:>6}".format('path', 'method', 'MB/s',
+                                                   'CPU%')
+        splice_present = backup.splice_present
+        for name, func in [('backup', run_backup), ('restore', run_restore)]:
+            for method, use_splice in [('loop', False), ('splice', True)]:
+                if use_splice and not splice_present:
+                    continue
+                backup.splice_present = use_splice
+                results = [measure(func, image, workdir)
+                           for _ in range(options.repeat)]
+                wall, cpu = min(results)
+                print "{0:<8} {1:<7} {2:>9.1f} {3:>5.0f}%".format(
+                    name, method, size / MB / wall, cpu / wall * 100)
+        backup.splice_present = splice_present
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    sys.exit(main())
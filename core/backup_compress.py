@@ -0,0 +1,159 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+# Compression programs known to backup. Run as a program, decompresses data
+# of a backup with adaptive compression, where each file may be compressed
+# with a different program or not at all - the program is selected by the
+# data format. Called by tar during restore (as its compression program):
+#   python2 -m qubes.backup_compress -d
+
+import errno
+import os
+import shlex
+import signal
+import subprocess
+import sys
+
+# program -> range of compression levels, option for number of threads (if
+# supported), magic bytes at the start of compressed data
+COMPRESSION_PROGRAMS = {
+    'gzip': {'levels': (1, 9), 'threads': None, 'magic': b'\x1f\x8b'},
+    'bzip2': {'levels': (1, 9), 'threads': None, 'magic': b'BZh'},
+    'xz': {'levels': (0, 9), 'threads': '-T{0}', 'magic': b'\xfd7zXZ\x00'},
+    'zstd': {'levels': (1, 19), 'threads': '-T{0}',
+             'magic': b'\x28\xb5\x2f\xfd'},
+    'lz4': {'levels': (1, 12), 'threads': None,
+            'magic': b'\x04\x22\x4d\x18'},
+}
+
+# enough to recognize uncompressed tar archive (magic at offset 257)
+DETECT_SIZE = 512
+BUFFER_SIZE = 1024 * 1024
+
+
+def parse_compression_filter(value):
+    """
+    Parse compression filter given as "program[:level]"; the level is
+    allowed only for programs in COMPRESSION_PROGRAMS.
+
+    :return: tuple (program, level or None)
+    :raise ValueError: on invalid level
+    """
+    (program, _, level) = value.partition(':')
+    if not level:
+        return program, None
+    if program not in COMPRESSION_PROGRAMS:
+        raise ValueError("Compression level not supported by {0}".format(
+            program))
+    (min_level, max_level) = COMPRESSION_PROGRAMS[program]['levels']
+    if not level.isdigit() or not min_level <= int(level) <= max_level:
+        raise ValueError("Compression level of {0} must be {1}-{2}".format(
+            program, min_level, max_level))
+    return program, int(level)
+
+
+def compression_command(program, level=None, threads=0):
+    """
+    Command line to compress data with *program* at *level* (if given),
+    using *threads* threads (0 means one per CPU) if the program supports
+    it. Other programs than those in COMPRESSION_PROGRAMS are given as a
+    command line (like tar --use-compress-program), possibly with their own
+    options.
+    """
+    params = COMPRESSION_PROGRAMS.get(program)
+    if params is None:
+        return shlex.split(program)
+    command = [program]
+    if level is not None:
+        command.append('-%d' % level)
+    if params['threads']:
+        command.append(params['threads'].format(threads))
+    return command
+
+
+def detect_compression(data):
+    """
+    Detect format of a backed up file data, from its start (DETECT_SIZE
+    bytes).
+
+    :return: name of the program which compressed the data, None if the
+    data is an uncompressed tar archive
+    :raise ValueError: on unknown format
+    """
+    if data[257:262] == b'ustar':
+        return None
+    for program, params in COMPRESSION_PROGRAMS.items():
+        if data.startswith(params['magic']):
+            return program
+    raise ValueError("Unknown format of backup data")
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def decompress(in_fd, out_fd):
+    """
+    Decompress data from *in_fd* to *out_fd* with the program detected from
+    the data, or copy it if not compressed.
+
+    :return: exit code
+    """
+    data = b''
+    while len(data) < DETECT_SIZE:
+        buf = os.read(in_fd, DETECT_SIZE - len(data))
+        if not buf:
+            break
+        data += buf
+    program = detect_compression(data)
+    proc = None
+    if program is not None:
+        proc = subprocess.Popen([program, '-d'], stdin=subprocess.PIPE,
+                                stdout=out_fd)
+        out_fd = proc.stdin.fileno()
+    try:
+        while data:
+            write_all(out_fd, data)
+            data = os.read(in_fd, BUFFER_SIZE)
+    except OSError as e:
+        # decompressor failed, its exit code is returned below
+        if proc is None or e.errno != errno.EPIPE:
+            raise
+    if proc is not None:
+        proc.stdin.close()
+        return proc.wait()
+    return 0
+
+
+def main():
+    if sys.argv[1:] != ['-d']:
+        print >> sys.stderr, "usage: {0} -d".format(sys.argv[0])
+        return 2
+    # behave like other decompression programs when the reader exits early
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    try:
+        return decompress(sys.stdin.fileno(), sys.stdout.fileno())
+    except ValueError as e:
+        print >> sys.stderr, "ERROR: {0}".format(e)
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
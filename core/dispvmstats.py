@@ -0,0 +1,161 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+
+import fcntl
+import json
+import math
+import os
+import time
+
+STATS_FILE = '/var/run/qubes/dispvm-stats'
+#: when the stats file grows over this size, only the newest half of records
+#: is kept
+MAX_STATS_FILE_SIZE = 1024*1024
+
+#: DispVM startup phases, in order
+PHASES = ['unpack', 'load', 'create', 'restore', 'qubesdb', 'qrexec', 'guid',
+          'firewall']
+#: savefile_hit - savefile was up to date, savefile_miss - savefile had to be
+#: regenerated on the request path
+COUNTERS = ['savefile_hit', 'savefile_miss']
+
+
+class DispVMStats(object):
+    """
+    Timings of a single DispVM startup. Phases may overlap (e.g. unpacking
+    saved-cows.tar is done in background) and the same phase can be entered
+    multiple times - time spent in each is summed.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.success = False
+        self._running = {}
+
+    def begin(self, phase):
+        self._running[phase] = time.time()
+
+    def end(self, phase):
+        if phase not in self._running:
+            return
+        duration = time.time() - self._running.pop(phase)
+        self.phases[phase] = self.phases.get(phase, 0) + duration
+
+    def count(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def save(self, stats_file=STATS_FILE):
+        """
+        Append this record to the stats file. Errors are ignored - stats must
+        never break DispVM startup.
+        """
+        record = {
+            'time': self.started,
+            'total': time.time() - self.started,
+            'success': self.success,
+            'phases': self.phases,
+            'counters': self.counters,
+        }
+        try:
+            with open(stats_file, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != '\n':
+                        # previous write was cut off - do not append this
+                        # record to its partial line
+                        f.seek(0, os.SEEK_END)
+                        f.write('\n')
+                f.seek(0, os.SEEK_END)
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                if os.fstat(f.fileno()).st_size > MAX_STATS_FILE_SIZE:
+                    f.seek(0)
+                    lines = f.readlines()
+                    f.truncate(0)
+                    f.writelines(lines[len(lines)/2:])
+        except (IOError, OSError):
+            pass
+
+
+def load_stats(stats_file=STATS_FILE):
+    records = []
+    if not os.path.exists(stats_file):
+        return records
+    with open(stats_file, 'r') as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        for line in f.readlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # partially written line
+                continue
+    return records
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a list of values: the smallest value, which
+    is greater than or equal to *pct* percent of the values. None for an
+    empty list.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(pct * len(values) / 100.0)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def summarize(records):
+    """
+    Compute per-phase statistics of successful DispVM startups, and total
+    counter values.
+
+    :return: tuple (phase_stats, counters), where phase_stats is a list of
+        (phase, count, mean, p50, p95, p99) tuples, ordered as PHASES (plus
+        'total' at the end)
+    """
+    samples = {}
+    counters = {'failed': 0}
+    for record in records:
+        for counter, value in record.get('counters', {}).items():
+            counters[counter] = counters.get(counter, 0) + value
+        if not record.get('success', False):
+            counters['failed'] += 1
+            continue
+        for phase, duration in record.get('phases', {}).items():
+            samples.setdefault(phase, []).append(duration)
+        samples.setdefault('total', []).append(record['total'])
+
+    phase_stats = []
+    for phase in PHASES + sorted(set(samples.keys()) - set(PHASES) -
+            set(['total'])) + ['total']:
+        values = samples.get(phase, [])
+        if not values:
+            continue
+        phase_stats.append((phase, len(values), sum(values) / len(values),
+                            percentile(values, 50),
+                            percentile(values, 95),
+                            percentile(values, 99)))
+    return phase_stats, counters
@@ -45,6 +45,9 @@ import xen.lowlevel.xc
 import xen.lowlevel.xs
 
 BLKSIZE = 512
+# lseek() whence values, not exposed by python2 os module
+SEEK_DATA = 3
+SEEK_HOLE = 4
 
 # all frontends, prefer xvdi
 # TODO: get this from libvirt driver?
@@ -121,6 +124,41 @@ def get_disk_usage(path):
 
     return ret
 
+def get_file_extents(path):
+    """
+    Data extents of a (sparse) file, found with lseek(SEEK_DATA/SEEK_HOLE)
+    without reading the data. If the filesystem does not support it, the
+    whole file is a single extent.
+
+    :return: list of (offset, length) tuples
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        extents = []
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # only a hole up to the end of file
+                    break
+                elif e.errno == errno.EINVAL and offset == 0:
+                    # not supported
+                    return [(0, size)]
+                raise
+            end = os.lseek(fd, start, SEEK_HOLE)
+            extents.append((start, end - start))
+            offset = end
+        return extents
+    finally:
+        os.close(fd)
+
+def get_data_size(path):
+    """Size of data in a (sparse) file, excluding holes"""
+    return sum(length for (offset, length) in get_file_extents(path))
+
 def print_stdout(text):
     print (text)
 
@@ -0,0 +1,121 @@
+#!/usr/bin/python -O
+
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import qubes.dispvmstats
+
+
+class TestCasePercentile(unittest.TestCase):
+    def test_00_empty(self):
+        self.assertIsNone(qubes.dispvmstats.percentile([], 50))
+
+    def test_01_single(self):
+        for pct in (0, 50, 99, 100):
+            self.assertEqual(qubes.dispvmstats.percentile([7], pct), 7)
+
+    def test_02_nearest_rank(self):
+        values = [4, 2, 1, 3]
+        self.assertEqual(qubes.dispvmstats.percentile(values, 25), 1)
+        self.assertEqual(qubes.dispvmstats.percentile(values, 50), 2)
+        self.assertEqual(qubes.dispvmstats.percentile(values, 51), 3)
+        self.assertEqual(qubes.dispvmstats.percentile(values, 75), 3)
+        self.assertEqual(qubes.dispvmstats.percentile(values, 100), 4)
+
+    def test_03_hundred_values(self):
+        values = range(1, 101)
+        for pct in range(1, 101):
+            self.assertEqual(qubes.dispvmstats.percentile(values, pct), pct)
+
+
+class TestCaseSummarize(unittest.TestCase):
+    def record(self, total, phases, success=True, counters=None):
+        return {'time': 0, 'total': total, 'success': success,
+                'phases': phases, 'counters': counters or {}}
+
+    def test_00_empty(self):
+        self.assertEqual(qubes.dispvmstats.summarize([]),
+                         ([], {'failed': 0}))
+
+    def test_01_phases(self):
+        records = [
+            self.record(3.0, {'restore': 1.0, 'unpack': 0.5, 'extra': 0.1},
+                        counters={'savefile_hit': 1}),
+            self.record(5.0, {'restore': 3.0, 'unpack': 1.5},
+                        counters={'savefile_miss': 1}),
+            self.record(9.0, {'restore': 8.0}, success=False,
+                        counters={'savefile_hit': 1}),
+        ]
+        phase_stats, counters = qubes.dispvmstats.summarize(records)
+        # known phases in their order, then unknown ones, then total;
+        # failed startups counted, but not included in the timings
+        self.assertEqual(phase_stats, [
+            ('unpack', 2, 1.0, 0.5, 1.5, 1.5),
+            ('restore', 2, 2.0, 1.0, 3.0, 3.0),
+            ('extra', 1, 0.1, 0.1, 0.1, 0.1),
+            ('total', 2, 4.0, 3.0, 5.0, 5.0),
+        ])
+        self.assertEqual(counters, {'failed': 1, 'savefile_hit': 2,
+                                    'savefile_miss': 1})
+
+
+class TestCaseStatsFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.stats_file = os.path.join(self.tmpdir, 'dispvm-stats')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_00_save_load(self):
+        self.assertEqual(qubes.dispvmstats.load_stats(self.stats_file), [])
+        stats = qubes.dispvmstats.DispVMStats()
+        stats.begin('restore')
+        stats.end('restore')
+        # not started - ignored
+        stats.end('guid')
+        stats.count('savefile_hit')
+        stats.success = True
+        stats.save(self.stats_file)
+        with open(self.stats_file, 'a') as f:
+            # partially written record
+            f.write('{"time": ')
+        records = qubes.dispvmstats.load_stats(self.stats_file)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['phases'].keys(), ['restore'])
+        self.assertEqual(records[0]['counters'], {'savefile_hit': 1})
+        self.assertTrue(records[0]['success'])
+
+    def test_01_save_after_partial(self):
+        with open(self.stats_file, 'w') as f:
+            # partially written record
+            f.write('{"time": ')
+        stats = qubes.dispvmstats.DispVMStats()
+        stats.success = True
+        stats.save(self.stats_file)
+        stats.save(self.stats_file)
+        # the partial line still skipped, but not the records after it
+        self.assertEqual(len(qubes.dispvmstats.load_stats(self.stats_file)),
+                         2)
+        with open(self.stats_file) as f:
+            self.assertEqual(f.readline(), '{"time": \n')
@@ -20,7 +20,10 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #
 
+import os
+import shutil
 import subprocess
+import tempfile
 import unittest
 
 import qubes.qubesutils
@@ -43,6 +46,28 @@ class TestCaseFunctionsAndConstants(unittest.TestCase):
         self.assertEqual(qubes.qubesutils.get_disk_usage('.'),
             self.check_output_int(['du', '-s', '--block-size=1', '.']))
 
+    def test_03_get_file_extents(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'sparse.img')
+            with open(path, 'w') as f:
+                f.truncate(16 * 1024 * 1024)
+                f.seek(4 * 1024 * 1024)
+                f.write('x' * 8192)
+            extents = qubes.qubesutils.get_file_extents(path)
+            # filesystems without SEEK_DATA report the whole file
+            if extents != [(0, 16 * 1024 * 1024)]:
+                self.assertEqual(len(extents), 1)
+                (offset, length) = extents[0]
+                self.assertLessEqual(offset, 4 * 1024 * 1024)
+                self.assertGreaterEqual(offset + length,
+                                        4 * 1024 * 1024 + 8192)
+                self.assertLess(length, 1024 * 1024)
+            self.assertEqual(qubes.qubesutils.get_data_size(path),
+                             sum(length for (_, length) in extents))
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -74,13 +74,16 @@ fstype=`df --output=fstype $VMDIR | tail -n 1`
 if [ "$fstype" = "tmpfs" ]; then
     # bsdtar doesn't work on tmpfs because FS_IOC_FIEMAP ioctl isn't supported
     # there
-    tar -cSf saved-cows.tar volatile.img || exit 1
+    tar -cSf saved-cows.tar.new volatile.img || exit 1
 else
-    errors=`bsdtar -cSf saved-cows.tar volatile.img 2>&1`
+    errors=`bsdtar -cSf saved-cows.tar.new volatile.img 2>&1`
     if [ -n "$errors" ]; then
         echo "Failed to create saved-cows.tar: $errors" >&2
-        rm -f saved-cows.tar
+        rm -f saved-cows.tar.new
         exit 1
     fi
 fi
+# DispVMs may be started from the old savefile in the meantime, replace the
+# archive atomically
+mv -f saved-cows.tar.new saved-cows.tar || exit 1
 echo "DVM savefile created successfully."
@@ -21,20 +21,28 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #
 #
-import xen.lowlevel.xc
-import xen.lowlevel.xs
+import collections
 import string
-import time
 import qmemman_algo
 import os
-from notify import notify_error_qubes_manager, clear_error_qubes_manager
+from qmemman_client import REASON_NO_MEMORY, REASON_BALLOON_FAILED
 
 import logging
 
 no_progress_msg="VM refused to give back requested memory"
 slow_memset_react_msg="VM didn't give back all requested memory"
 
-class DomainState:
+# xenstore entries (relative to domain home) with memory QoS settings: weight,
+# guaranteed memory (in KiB) and tier; written by dom0, not writable by the
+# domain itself
+QOS_KEYS = ['qmemman/weight', 'qmemman/min-memory', 'qmemman/tier']
+
+class DomainState(object):
+    __slots__ = ('meminfo', 'memory_current', 'memory_actual',
+                 'memory_maximum', 'mem_used', 'id', 'last_target',
+                 'no_progress', 'slow_memset_react', 'static_max_cached',
+                 'name', 'weight', 'mem_min', 'tier', 'qos_cached')
+
     def __init__(self, id):
         self.meminfo = None		#dictionary of memory info read from client
         self.memory_current = 0     # the current memory size
@@ -46,52 +54,130 @@ class DomainState:
         self.last_target = 0		#the last memset target
         self.no_progress = False    #no react to memset
         self.slow_memset_react = False #slow react to memset (after few tries still above target)
+        # static-max and name do not change during domain lifetime, so are
+        # read once, when domain is introduced
+        self.static_max_cached = False #memory_maximum read from static-max
+        self.name = None            #domain name, for error notifications
+        # memory QoS settings, see qmemman_algo
+        self.weight = qmemman_algo.DEFAULT_WEIGHT #share of free memory
+        self.mem_min = 0            #guaranteed memory
+        self.tier = qmemman_algo.DEFAULT_TIER #priority when low on memory
+        self.qos_cached = False     #QoS settings read from xenstore
 
     def __repr__(self):
-        return self.__dict__.__repr__()
+        return dict((attr, getattr(self, attr))
+                    for attr in self.__slots__).__repr__()
+
+    def assigned_but_unused(self):
+        """Memory assigned to the domain (memset), but not allocated yet"""
+        return max(0, self.last_target - self.memory_current)
+
+class MemoryRequest(object):
+    """
+    Request for memory for a new domain. When satisfied, the memory stays
+    reserved (not counted as free, so not redistributed) until the
+    reservation is released, which happens after the domain is created.
+    """
+    __slots__ = ('amount', 'result', 'reason')
+
+    def __init__(self, amount):
+        self.amount = amount
+        #: None - not processed yet, True - memory reserved, False - rejected
+        self.result = None
+        #: reason of rejection, one of qmemman_client.REASON_*
+        self.reason = None
+
+    def __repr__(self):
+        return 'MemoryRequest({!r}, result={!r}, reason={!r})'.format(
+            self.amount, self.result, self.reason)
 
 class SystemState(object):
-    def __init__(self):
+    def __init__(self, backend=None):
+        """
+        :param backend: HypervisorBackend instance, Xen by default
+        """
         self.log = logging.getLogger('qmemman.systemstate')
         self.log.debug('SystemState()')
 
+        if backend is None:
+            from qmemman_backend import XenBackend
+            backend = XenBackend()
+        self.backend = backend
+
         self.domdict = {}
-        self.xc = xen.lowlevel.xc.xc()
-        self.xs = xen.lowlevel.xs.xs()
+        # sum of DomainState.assigned_but_unused() over all domains, updated
+        # every time last_target or memory_current of some domain changes
+        self.assigned_but_unused = 0
+        # satisfied MemoryRequest objects, with memory not claimed yet
+        self.reservations = set()
+        # sum of memory reserved by the above requests
+        self.reserved_memory = 0
+        # number of satisfied memory requests
+        self.requests_satisfied = 0
+        # number of memory requests satisfied from free memory, without
+        # ballooning (included in requests_satisfied)
+        self.requests_fast = 0
+        # number of rejected memory requests, by reason
+        self.requests_failed = {}
+        # number of balance passes which changed memory assignment
+        self.balance_count = 0
+        # number of balloon passes (memory requests handling)
+        self.balloon_count = 0
+        #: (time, memsize, duration, result) of recent balloon passes
+        self.balloon_history = collections.deque(maxlen=100)
+        self.memory_watch_active = False
+        self.watched_domains = []
+        # interval of sending memset requests to domains and maximum interval
+        # of checking for memory released by them
         self.BALOON_DELAY = 0.1
+        # minimal interval of checking for released memory, used as long as
+        # donors are making progress
+        self.BALOON_MIN_DELAY = 0.01
         self.XEN_FREE_MEM_LEFT = 50*1024*1024
+        # Predictive headroom: keep additional free Xen memory, to satisfy
+        # new domain requests without ballooning. The headroom is the
+        # biggest request seen in last HEADROOM_WINDOW seconds, but at most
+        # HEADROOM_MAX (0 disables the feature). When there were no requests
+        # recently, the memory is given back to domains.
+        self.HEADROOM_MAX = 0
+        self.HEADROOM_WINDOW = 300
+        #: (time, amount) of recent memory requests
+        self.request_history = collections.deque()
         self.XEN_FREE_MEM_MIN = 25*1024*1024
         # Overhead of per-page Xen structures, taken from OpenStack nova/virt/xenapi/driver.py
         # see https://wiki.openstack.org/wiki/XenServer/Overhead
         # we divide total and free physical memory by this to get "assignable" memory
         self.MEM_OVERHEAD_FACTOR = 1.0 / 1.00781
-        self.ALL_PHYS_MEM = int(self.xc.physinfo()['total_memory']*1024 * self.MEM_OVERHEAD_FACTOR)
+        self.ALL_PHYS_MEM = int(self.backend.physinfo()['total_memory']*1024 * self.MEM_OVERHEAD_FACTOR)
 
     def add_domain(self, id):
         self.log.debug('add_domain(id={!r})'.format(id))
         self.domdict[id] = DomainState(id)
         # TODO: move to DomainState.__init__
-        target_str = self.xs.read('', '/local/domain/' + id + '/memory/target')
+        values = self.backend.read_domain_keys(id,
+            ['memory/target', 'memory/static-max', 'name'] + QOS_KEYS)
+        target_str, static_max_str, self.domdict[id].name = values[:3]
         if target_str:
             self.domdict[id].last_target = int(target_str) * 1024
+        self.set_static_max(self.domdict[id], static_max_str)
+        if values[3:] != [None] * len(QOS_KEYS):
+            self.set_qos(self.domdict[id], values[3:])
+        self.assigned_but_unused += self.domdict[id].assigned_but_unused()
 
     def del_domain(self, id):
         self.log.debug('del_domain(id={!r})'.format(id))
-        self.domdict.pop(id)
+        dom = self.domdict.pop(id)
+        self.assigned_but_unused -= dom.assigned_but_unused()
 
     def get_free_xen_memory(self):
-        xen_free = int(self.xc.physinfo()['free_memory']*1024 *
+        xen_free = int(self.backend.physinfo()['free_memory']*1024 *
                        self.MEM_OVERHEAD_FACTOR)
         # now check for domains which have assigned more memory than really
         # used - do not count it as "free", because domain is free to use it
         # at any time
         # assumption: self.refresh_memactual was called before
         # (so domdict[id].memory_actual is up to date)
-        assigned_but_unused = reduce(
-            lambda acc, dom: acc + max(0, dom.last_target-dom.memory_current),
-            self.domdict.values(),
-            0
-        )
+        assigned_but_unused = self.assigned_but_unused
         # If, at any time, Xen have less memory than XEN_FREE_MEM_MIN,
         # it is a failure of qmemman. Collect as much data as possible to
         # debug it
@@ -103,61 +189,96 @@ class SystemState(object):
             self.log.error("Xen free = {!r} too small for satisfy assignments! "
                            "assigned_but_unused={!r}, domdict={!r}".format(
                 xen_free, assigned_but_unused, self.domdict))
-        return xen_free - assigned_but_unused
+        # memory reserved for domains being created is not free either; it
+        # may be counted twice between domain creation and releasing the
+        # reservation, which only makes balancing more conservative for
+        # that time
+        return xen_free - assigned_but_unused - self.reserved_memory
 
 #refresh information on memory assigned to all domains
     def refresh_memactual(self):
-        for domain in self.xc.domain_getinfo():
+        for domain in self.backend.domain_getinfo():
             id = str(domain['domid'])
             if self.domdict.has_key(id):
                 # real memory usage
+                self.assigned_but_unused -= \
+                    self.domdict[id].assigned_but_unused()
                 self.domdict[id].memory_current = domain['mem_kb']*1024
+                self.assigned_but_unused += \
+                    self.domdict[id].assigned_but_unused()
                 # what VM is using or can use
                 self.domdict[id].memory_actual = max(
                     self.domdict[id].memory_current,
                     self.domdict[id].last_target
                 )
-                self.domdict[id].memory_maximum = self.xs.read('', '/local/domain/%s/memory/static-max' % str(id))
-                if self.domdict[id].memory_maximum:
-                    self.domdict[id].memory_maximum = int(self.domdict[id].memory_maximum)*1024
-                else:
-                    self.domdict[id].memory_maximum = self.ALL_PHYS_MEM
+                if not self.domdict[id].static_max_cached:
+                    self.set_static_max(self.domdict[id],
+                        self.backend.read_domain_key(id, 'memory/static-max'))
+
+    def set_static_max(self, dom, static_max_str):
+        if static_max_str:
+            dom.memory_maximum = int(static_max_str)*1024
+            dom.static_max_cached = True
+        else:
+            dom.memory_maximum = self.ALL_PHYS_MEM
 # the previous line used to be
 #                    self.domdict[id].memory_maximum = domain['maxmem_kb']*1024
 # but domain['maxmem_kb'] changes in self.mem_set as well, and this results in
 # the memory never increasing
 # in fact, the only possible case of nonexisting memory/static-max is dom0
-# see #307
+# see #307; for other domains it may be just not written yet, so read it again
+# on next refresh
+            dom.static_max_cached = (dom.id == '0')
+
+    def set_qos(self, dom, qos_values):
+        """
+        Set domain memory QoS settings, read from QOS_KEYS xenstore
+        entries. Those are written by dom0 when the domain is started, so
+        once they are read (or the domain started reporting its memory
+        usage, which happens later), they are not read again.
+        """
+        weight_str, min_str, tier_str = qos_values
+        try:
+            if weight_str:
+                dom.weight = max(0, int(weight_str))
+            if min_str:
+                dom.mem_min = max(0, int(min_str)) * 1024
+            if tier_str:
+                dom.tier = int(tier_str)
+        except ValueError:
+            self.log.warning('invalid QoS settings for domain {}: {!r}'.format(
+                dom.id, qos_values))
+        dom.qos_cached = True
+
+    def get_domain_name(self, id):
+        if self.domdict[id].name is None:
+            self.domdict[id].name = self.backend.read_domain_key(id, 'name')
+        return self.domdict[id].name
 
     def clear_outdated_error_markers(self):
         # Clear outdated errors
         for i in self.domdict.keys():
             if self.domdict[i].slow_memset_react and \
                     self.domdict[i].memory_actual <= self.domdict[i].last_target + self.XEN_FREE_MEM_LEFT/4:
-                dom_name = self.xs.read('', '/local/domain/%s/name' % str(i))
+                dom_name = self.get_domain_name(i)
                 if dom_name is not None:
-                    clear_error_qubes_manager(dom_name, slow_memset_react_msg)
+                    self.backend.clear_error(dom_name, slow_memset_react_msg)
                 self.domdict[i].slow_memset_react = False
 
             if self.domdict[i].no_progress and \
                     self.domdict[i].memory_actual <= self.domdict[i].last_target + self.XEN_FREE_MEM_LEFT/4:
-                dom_name = self.xs.read('', '/local/domain/%s/name' % str(i))
+                dom_name = self.get_domain_name(i)
                 if dom_name is not None:
-                    clear_error_qubes_manager(dom_name, no_progress_msg)
+                    self.backend.clear_error(dom_name, no_progress_msg)
                 self.domdict[i].no_progress = False
 
 #the below works (and is fast), but then 'xm list' shows unchanged memory value
     def mem_set(self, id, val):
         self.log.info('mem-set domain {} to {}'.format(id, val))
+        self.assigned_but_unused -= self.domdict[id].assigned_but_unused()
         self.domdict[id].last_target = val
-#can happen in the middle of domain shutdown
-#apparently xc.lowlevel throws exceptions too
-        try:
-            self.xc.domain_setmaxmem(int(id), int(val/1024) + 1024) # LIBXL_MAXMEM_CONSTANT=1024
-            self.xc.domain_set_target_mem(int(id), int(val/1024))
-        except:
-            pass
-        self.xs.write('', '/local/domain/' + id + '/memory/target', str(int(val/1024)))
+        self.assigned_but_unused += self.domdict[id].assigned_but_unused()
+        self.backend.set_domain_memory(id, int(val/1024))
 
 # this is called at the end of ballooning, when we have Xen free mem already
 # make sure that past mem_set will not decrease Xen free mem
@@ -170,68 +291,255 @@ class SystemState(object):
                     'Preventing balloon up to {}'.format(dom.last_target))
                 self.mem_set(i, dom.memory_actual)
 
-#perform memory ballooning, across all domains, to add "memsize" to Xen free memory
+    def start_memory_watch(self):
+        """
+        Watch for events which may mean that some memory was released:
+        domain destroyed, or domain reported its memory usage. There is no
+        notification of domain memory allocation changes, so this only
+        shortens waiting in the ballooning loops, which still poll
+        domain_getinfo periodically.
+        """
+        if self.memory_watch_active:
+            return
+        self.watched_domains = self.domdict.keys()
+        self.backend.start_memory_watch(self.watched_domains)
+        self.memory_watch_active = True
+
+    def stop_memory_watch(self):
+        if not self.memory_watch_active:
+            return
+        self.backend.stop_memory_watch(self.watched_domains)
+        self.memory_watch_active = False
+
+    def wait_for_memory_change(self, timeout):
+        """
+        Wait at most *timeout* seconds for some domain releasing memory.
+
+        :return: True if woken up by an event, False on timeout
+        """
+        self.start_memory_watch()
+        return self.backend.wait_for_memory_change(timeout)
+
+    def can_satisfy(self, memsize):
+        """
+        Check if *memsize* of memory can be obtained at all - from Xen free
+        memory and by squeezing all the donors down to their preferred
+        memory size. Requests failing this check are rejected without
+        ballooning.
+        """
+        self.refresh_memactual()
+        xenfree = self.get_free_xen_memory()
+        if xenfree >= memsize + self.XEN_FREE_MEM_MIN:
+            return True
+        available = qmemman_algo.available_memory(self.domdict)
+        return memsize + self.XEN_FREE_MEM_LEFT - xenfree <= available
+
+    def admit_from_free_memory(self, requests):
+        """
+        Fast path of memory requests handling: if Xen has enough free
+        memory, reserve it for *requests* without refreshing state of all
+        the domains and without touching them.
+
+        Assigned-but-unused memory comes from the aggregate cached at the
+        last refresh; it only shrinks as domains allocate memory (and Xen
+        free memory shrinks the same), so the check is conservative.
+        XEN_FREE_MEM_LEFT margin is kept for the rare case of a domain
+        releasing memory below its target on its own.
+
+        :return: True if all the requests were satisfied
+        """
+        total = sum(rq.amount for rq in requests)
+        xen_free = int(self.backend.physinfo()['free_memory']*1024 *
+                       self.MEM_OVERHEAD_FACTOR)
+        free = xen_free - self.assigned_but_unused - self.reserved_memory
+        if free < total + self.XEN_FREE_MEM_LEFT:
+            return False
+        for rq in requests:
+            rq.result = True
+            self.reserve_memory(rq)
+        self.requests_fast += len(requests)
+        return True
+
+    def reserve_memory(self, request):
+        self.reservations.add(request)
+        self.reserved_memory += request.amount
+
+    def release_memory(self, request):
+        """
+        Release reservation of memory - called after the domain was
+        created (so the memory is not free anymore anyway), or when
+        creating it failed.
+        """
+        if request not in self.reservations:
+            return
+        self.reservations.remove(request)
+        self.reserved_memory -= request.amount
+
+    def do_balloon_requests(self, requests):
+        """
+        Handle multiple memory requests at once: check if all of them can
+        be satisfied and get memory for all of them with a single
+        ballooning pass. If that is not possible, handle requests one by
+        one, in order. Memory of satisfied requests is reserved, see
+        :py:class:`MemoryRequest`.
+
+        :param requests: list of MemoryRequest objects, result is set on
+        each of them
+        """
+        self.log.info('do_balloon_requests(requests={!r})'.format(requests))
+        if self.HEADROOM_MAX:
+            now = self.backend.time()
+            self.prune_request_history()
+            for rq in requests:
+                self.request_history.append((now, rq.amount))
+        total = sum(rq.amount for rq in requests)
+        if self.admit_from_free_memory(requests):
+            self.log.info('requests satisfied from free memory')
+        elif len(requests) > 1 and \
+                self.can_satisfy(total) and self.do_balloon(total):
+            for rq in requests:
+                rq.result = True
+                self.reserve_memory(rq)
+        else:
+            for rq in requests:
+                if not self.can_satisfy(rq.amount):
+                    rq.result = False
+                    rq.reason = REASON_NO_MEMORY
+                elif not self.do_balloon(rq.amount):
+                    rq.result = False
+                    rq.reason = REASON_BALLOON_FAILED
+                else:
+                    rq.result = True
+                    self.reserve_memory(rq)
+                    continue
+                self.log.info('request {!r} rejected'.format(rq))
+        for rq in requests:
+            if rq.result:
+                self.requests_satisfied += 1
+            else:
+                self.requests_failed[rq.reason] = \
+                    self.requests_failed.get(rq.reason, 0) + 1
+
+    def get_headroom(self):
+        """
+        Amount of free Xen memory to keep for expected domain starts, see
+        HEADROOM_MAX.
+        """
+        if not self.HEADROOM_MAX:
+            return 0
+        self.prune_request_history()
+        if not self.request_history:
+            return 0
+        return min(self.HEADROOM_MAX,
+                   max(amount for _, amount in self.request_history))
+
+    def prune_request_history(self):
+        """Forget requests older than HEADROOM_WINDOW"""
+        since = self.backend.time() - self.HEADROOM_WINDOW
+        while self.request_history and self.request_history[0][0] < since:
+            self.request_history.popleft()
+
     def do_balloon(self, memsize):
+        start = self.backend.time()
+        result = self.do_balloon_loop(memsize)
+        self.balloon_count += 1
+        self.balloon_history.append(
+            (start, memsize, self.backend.time() - start, result))
+        return result
+
+#perform memory ballooning, across all domains, to add "memsize" to Xen free memory
+    def do_balloon_loop(self, memsize):
         self.log.info('do_balloon(memsize={!r})'.format(memsize))
         CHECK_PERIOD_S = 3
         CHECK_MB_S = 100
 
         niter = 0
         prev_memory_actual = None
+        prev_xenfree = None
 
         for i in self.domdict.keys():
             self.domdict[i].no_progress = False
 
-        #: number of loop iterations for CHECK_PERIOD_S seconds
-        check_period = max(1, int((CHECK_PERIOD_S + 0.0) / self.BALOON_DELAY))
         #: number of free memory bytes expected to get during CHECK_PERIOD_S
         #: seconds
         check_delta = CHECK_PERIOD_S * CHECK_MB_S * 1024 * 1024
-        #: helper array for holding free memory size, CHECK_PERIOD_S seconds
-        #: ago, at every loop iteration
-        xenfree_ring = [0] * check_period
-
-        while True:
-            self.log.debug('niter={:2d}'.format(niter))
-            self.refresh_memactual()
-            xenfree = self.get_free_xen_memory()
-            self.log.info('xenfree={!r}'.format(xenfree))
-            if xenfree >= memsize + self.XEN_FREE_MEM_MIN:
-                self.inhibit_balloon_up()
-                return True
-            # fail the request if over past CHECK_PERIOD_S seconds,
-            # we got less than CHECK_MB_S MB/s on average
-            ring_slot = niter % check_period
-            if niter >= check_period and xenfree < xenfree_ring[ring_slot] + check_delta:
-                return False
-            xenfree_ring[ring_slot] = xenfree
-            if prev_memory_actual is not None:
-                for i in prev_memory_actual.keys():
-                    if prev_memory_actual[i] == self.domdict[i].memory_actual:
-                        #domain not responding to memset requests, remove it from donors
-                        self.domdict[i].no_progress = True
-                        self.log.info('domain {} stuck at {}'.format(i, self.domdict[i].memory_actual))
-            memset_reqs = qmemman_algo.balloon(memsize + self.XEN_FREE_MEM_LEFT - xenfree, self.domdict)
-            self.log.info('memset_reqs={!r}'.format(memset_reqs))
-            if len(memset_reqs) == 0:
-                return False
-            prev_memory_actual = {}
-            for i in memset_reqs:
-                dom, mem = i
-                self.mem_set(dom, mem)
-                prev_memory_actual[dom] = self.domdict[dom].memory_actual
-            self.log.debug('sleeping for {} s'.format(self.BALOON_DELAY))
-            time.sleep(self.BALOON_DELAY)
-            niter = niter + 1
+        #: (time, free memory size) pairs, covering last CHECK_PERIOD_S seconds
+        xenfree_history = collections.deque()
+        #: when to (re)send memset requests
+        next_memset_time = self.backend.time()
+        delay = self.BALOON_MIN_DELAY
+
+        try:
+            while True:
+                self.log.debug('niter={:2d}'.format(niter))
+                now = self.backend.time()
+                self.refresh_memactual()
+                xenfree = self.get_free_xen_memory()
+                self.log.info('xenfree={!r}'.format(xenfree))
+                if xenfree >= memsize + self.XEN_FREE_MEM_MIN:
+                    self.inhibit_balloon_up()
+                    return True
+                # fail the request if over past CHECK_PERIOD_S seconds,
+                # we got less than CHECK_MB_S MB/s on average
+                while len(xenfree_history) > 1 and \
+                        xenfree_history[1][0] <= now - CHECK_PERIOD_S:
+                    xenfree_history.popleft()
+                if xenfree_history and \
+                        xenfree_history[0][0] <= now - CHECK_PERIOD_S and \
+                        xenfree < xenfree_history[0][1] + check_delta:
+                    return False
+                xenfree_history.append((now, xenfree))
+
+                if now >= next_memset_time:
+                    if prev_memory_actual is not None:
+                        for i in prev_memory_actual.keys():
+                            if prev_memory_actual[i] == self.domdict[i].memory_actual:
+                                #domain not responding to memset requests, remove it from donors
+                                self.domdict[i].no_progress = True
+                                self.log.info('domain {} stuck at {}'.format(i, self.domdict[i].memory_actual))
+                    memset_reqs = qmemman_algo.balloon(memsize + self.XEN_FREE_MEM_LEFT - xenfree, self.domdict)
+                    self.log.info('memset_reqs={!r}'.format(memset_reqs))
+                    if len(memset_reqs) == 0:
+                        return False
+                    prev_memory_actual = {}
+                    for i in memset_reqs:
+                        dom, mem = i
+                        self.mem_set(dom, mem)
+                        prev_memory_actual[dom] = self.domdict[dom].memory_actual
+                    next_memset_time = now + self.BALOON_DELAY
+
+                # check again soon while donors are releasing memory, back off
+                # to BALOON_DELAY otherwise
+                if prev_xenfree is not None and xenfree > prev_xenfree:
+                    delay = self.BALOON_MIN_DELAY
+                else:
+                    delay = min(delay * 2, self.BALOON_DELAY)
+                prev_xenfree = xenfree
+                timeout = min(delay, next_memset_time - self.backend.time())
+                self.log.debug('waiting for {} s'.format(timeout))
+                self.wait_for_memory_change(timeout)
+                niter = niter + 1
+        finally:
+            self.stop_memory_watch()
 
     def refresh_meminfo(self, domid, untrusted_meminfo_key):
         self.log.debug(
             'refresh_meminfo(domid={}, untrusted_meminfo_key={!r})'.format(
                 domid, untrusted_meminfo_key))
 
+        self.update_meminfo(domid, untrusted_meminfo_key)
+        self.do_balance()
+
+    def update_meminfo(self, domid, untrusted_meminfo_key):
+        """
+        Update domain meminfo, without redistributing memory. Caller
+        should call do_balance() afterwards.
+        """
+        if not self.domdict[domid].qos_cached:
+            self.set_qos(self.domdict[domid],
+                self.backend.read_domain_keys(domid, QOS_KEYS))
         qmemman_algo.refresh_meminfo_for_domain(
             self.domdict[domid], untrusted_meminfo_key)
-        self.do_balance()
 
 #is the computed balance request big enough ?
 #so that we do not trash with small adjustments
@@ -276,6 +584,45 @@ class SystemState(object):
         self.log.info('stat: xenfree={} memset_reqs={}'.format(xenfree, memset_reqs))
 
 
+    def get_stats(self):
+        """
+        Snapshot of the current state, for debugging. Safe to call without
+        holding the global lock - every domain is copied before being
+        looked at, so the result may be slightly out of date, but each
+        domain is consistent.
+        """
+        domains = {}
+        for id, dom in self.domdict.items():
+            snapshot = DomainState(id)
+            for attr in DomainState.__slots__:
+                setattr(snapshot, attr, getattr(dom, attr))
+            domains[id] = {
+                'name': snapshot.name,
+                'actual': snapshot.memory_actual,
+                'current': snapshot.memory_current,
+                'target': snapshot.last_target,
+                'maximum': snapshot.memory_maximum,
+                'pref': int(qmemman_algo.prefmem(snapshot))
+                    if snapshot.mem_used is not None else None,
+                'no_progress': snapshot.no_progress,
+                'slow_memset_react': snapshot.slow_memset_react,
+                'weight': snapshot.weight,
+                'min': snapshot.mem_min,
+                'tier': snapshot.tier,
+            }
+        return {
+            'domains': domains,
+            'assigned_but_unused': self.assigned_but_unused,
+            'reserved_memory': self.reserved_memory,
+            'reservations': len(self.reservations),
+            'balances': self.balance_count,
+            'balloons': self.balloon_count,
+            'balloon_history': list(self.balloon_history),
+            'requests_satisfied': self.requests_satisfied,
+            'requests_fast': self.requests_fast,
+            'requests_failed': dict(self.requests_failed),
+        }
+
     def do_balance(self):
         self.log.debug('do_balance()')
         if os.path.isfile('/var/run/qubes/do-not-membalance'):
@@ -284,30 +631,41 @@ class SystemState(object):
 
         self.refresh_memactual()
         self.clear_outdated_error_markers()
-        xenfree = self.get_free_xen_memory()
+        headroom = self.get_headroom()
+        # do not distribute memory kept as headroom
+        xenfree = self.get_free_xen_memory() - headroom
         memset_reqs = qmemman_algo.balance(xenfree - self.XEN_FREE_MEM_LEFT, self.domdict)
         if not self.is_balance_req_significant(memset_reqs, xenfree):
             return
 
         self.print_stats(xenfree, memset_reqs)
+        self.balance_count += 1
 
         prev_memactual = {}
         for i in self.domdict.keys():
             prev_memactual[i] = self.domdict[i].memory_actual
+        try:
+            self.do_balance_memset(memset_reqs, prev_memactual, headroom)
+        finally:
+            self.stop_memory_watch()
+
+    def do_balance_memset(self, memset_reqs, prev_memactual, headroom):
         for rq in memset_reqs:
             dom, mem = rq
             # Force to always have at least 0.9*self.XEN_FREE_MEM_LEFT (some
             # margin for rounding errors). Before giving memory to
             # domain, ensure that others have gived it back.
-            # If not - wait a little.
-            ntries = 5
-            while self.get_free_xen_memory() - (mem - self.domdict[dom].memory_actual) < 0.9*self.XEN_FREE_MEM_LEFT:
-                self.log.debug('do_balance dom={!r} sleeping ntries={}'.format(
-                    dom, ntries))
-                time.sleep(self.BALOON_DELAY)
+            # If not - wait a little (at most 5*BALOON_DELAY in total).
+            deadline = self.backend.time() + 5 * self.BALOON_DELAY
+            delay = self.BALOON_MIN_DELAY
+            while self.get_free_xen_memory() - headroom - (mem - self.domdict[dom].memory_actual) < 0.9*self.XEN_FREE_MEM_LEFT:
+                timeout = min(delay, deadline - self.backend.time())
+                self.log.debug('do_balance dom={!r} waiting for {} s'.format(
+                    dom, timeout))
+                self.wait_for_memory_change(timeout)
+                delay = min(delay * 2, self.BALOON_DELAY)
                 self.refresh_memactual()
-                ntries -= 1
-                if ntries <= 0:
+                if self.backend.time() >= deadline:
                     # Waiting haven't helped; Find which domain get stuck and
                     # abort balance (after distributing what we have)
                     for rq2 in memset_reqs:
@@ -326,9 +684,9 @@ class SystemState(object):
                                             self.domdict[dom2].memory_actual,
                                             mem2))
                                 self.domdict[dom2].no_progress = True
-                                dom_name = self.xs.read('', '/local/domain/%s/name' % str(dom2))
+                                dom_name = self.get_domain_name(dom2)
                                 if dom_name is not None:
-                                    notify_error_qubes_manager(str(dom_name), no_progress_msg)
+                                    self.backend.notify_error(str(dom_name), no_progress_msg)
                             else:
                                 self.log.warning('dom {!r} still hold more'
                                     ' memory than have assigned ({} > {})'
@@ -336,10 +694,10 @@ class SystemState(object):
                                             self.domdict[dom2].memory_actual,
                                             mem2))
                                 self.domdict[dom2].slow_memset_react = True
-                                dom_name = self.xs.read('', '/local/domain/%s/name' % str(dom2))
+                                dom_name = self.get_domain_name(dom2)
                                 if dom_name is not None:
-                                    notify_error_qubes_manager(str(dom_name), slow_memset_react_msg)
-                    self.mem_set(dom, self.get_free_xen_memory() + self.domdict[dom].memory_actual - self.XEN_FREE_MEM_LEFT)
+                                    self.backend.notify_error(str(dom_name), slow_memset_react_msg)
+                    self.mem_set(dom, self.get_free_xen_memory() - headroom + self.domdict[dom].memory_actual - self.XEN_FREE_MEM_LEFT)
                     return
 
             self.mem_set(dom, mem)
@@ -30,6 +30,10 @@ CACHE_FACTOR = 1.3
 MIN_PREFMEM = 200*1024*1024
 DOM0_MEM_BOOST = 350*1024*1024
 
+# Memory QoS defaults, for domains without own settings
+DEFAULT_WEIGHT = 100
+DEFAULT_TIER = 1
+
 
 log = logging.getLogger('qmemman.daemon.algo')
 
@@ -97,8 +101,13 @@ def refresh_meminfo_for_domain(domain, untrusted_xenstore_key):
 def prefmem(domain):
 #dom0 is special, as it must have large cache, for vbds. Thus, give it a special boost
     if domain.id == '0':
-        return min(domain.mem_used*CACHE_FACTOR + DOM0_MEM_BOOST, domain.memory_maximum)
-    return max(min(domain.mem_used*CACHE_FACTOR, domain.memory_maximum), MIN_PREFMEM)
+        pref = min(domain.mem_used*CACHE_FACTOR + DOM0_MEM_BOOST, domain.memory_maximum)
+    else:
+        pref = max(min(domain.mem_used*CACHE_FACTOR, domain.memory_maximum), MIN_PREFMEM)
+#memory guaranteed to the domain - it is never squeezed below it
+    if domain.mem_min > pref:
+        return min(domain.mem_min, domain.memory_maximum)
+    return pref
 
 def memory_needed(domain):
 #do not change
@@ -106,6 +115,53 @@ def memory_needed(domain):
     ret = prefmem(domain) - domain.memory_actual
     return ret
     
+#collect parameters of domains taking part in memory balancing (having meminfo
+#and reacting to memset) into parallel lists, so prefmem() is computed only once
+#per domain; returns (ids, memory_actual, pref, memory_maximum, share, tier)
+#tuple, where share is prefmem scaled by the domain weight - memory is
+#distributed proportionally to it
+def domains_params(domain_dictionary):
+    ids = []
+    actual = []
+    pref = []
+    maximum = []
+    share = []
+    tier = []
+    for i, dom in domain_dictionary.iteritems():
+        if dom.meminfo is None:
+            continue
+        if dom.no_progress:
+            continue
+        ids.append(i)
+        actual.append(dom.memory_actual)
+        pref.append(prefmem(dom))
+        maximum.append(dom.memory_maximum)
+        share.append(pref[-1] * (float(dom.weight) / DEFAULT_WEIGHT))
+        tier.append(dom.tier)
+    return ids, actual, pref, maximum, share, tier
+
+#weights for splitting memory between domains *indices*: their shares, or
+#(when all of them have weight 0) their not weighted prefmem; returns (weights,
+#total) tuple
+def split_weights(indices, pref, share):
+    total = sum(share[k] for k in indices)
+    if total > 0:
+        return share, total
+    return pref, sum(pref[k] for k in indices)
+
+#upper bound of memory which balloon() can obtain from domains, by squeezing
+#all donors to their prefmem; domains marked as no_progress are counted too,
+#because do_balloon() clears that flag before ballooning
+def available_memory(domain_dictionary):
+    available = 0
+    for dom in domain_dictionary.itervalues():
+        if dom.meminfo is None:
+            continue
+        need = memory_needed(dom)
+        if need < 0:
+            available -= need
+    return available
+
 #prepare list of (domain, memory_target) pairs that need to be passed
 #to "xm memset" equivalent in order to obtain "memsize" of memory
 #return empty list when the request cannot be satisfied
@@ -113,127 +169,154 @@ def balloon(memsize, domain_dictionary):
     log.debug('balloon(memsize={!r}, domain_dictionary={!r})'.format(
         memsize, domain_dictionary))
     REQ_SAFETY_NET_FACTOR = 1.05
+    ids, actual, pref, maximum, share, tier = domains_params(domain_dictionary)
     donors = list()
     request = list()
     available = 0
-    for i in domain_dictionary.keys():
-        if domain_dictionary[i].meminfo is None:
-            continue
-        if domain_dictionary[i].no_progress:
-            continue
-        need = memory_needed(domain_dictionary[i])
+    for k in xrange(len(ids)):
+        #memory_needed()
+        need = pref[k] - actual[k]
         if need < 0:
-            log.info('balloon: dom {} has actual memory {}'.format(i,
-                domain_dictionary[i].memory_actual))
-            donors.append((i,-need))
-            available-=need   
+            log.info('balloon: dom {} has actual memory {}'.format(ids[k],
+                actual[k]))
+            donors.append((k,-need))
+            available-=need
 
-    log.info('req={} avail={} donors={!r}'.format(memsize, available, donors))
+    log.info('req={} avail={} donors={!r}'.format(memsize, available,
+        [(ids[k], mem) for k, mem in donors]))
 
     if available<memsize:
         return ()
     scale = 1.0*memsize/available
     for donors_iter in donors:
-        id, mem = donors_iter
+        k, mem = donors_iter
         memborrowed = mem*scale*REQ_SAFETY_NET_FACTOR
-        log.info('borrow {} from {}'.format(memborrowed, id))
-        memtarget = int(domain_dictionary[id].memory_actual - memborrowed)
-        request.append((id, memtarget))
+        log.info('borrow {} from {}'.format(memborrowed, ids[k]))
+        memtarget = int(actual[k] - memborrowed)
+        request.append((ids[k], memtarget))
     return request
 # REQ_SAFETY_NET_FACTOR is a bit greater that 1. So that if the domain yields a bit less than requested, due
 # to e.g. rounding errors, we will not get stuck. The surplus will return to the VM during "balance" call.
 
 
 #redistribute positive "total_available_memory" of memory between domains, proportionally to prefmem
-def balance_when_enough_memory(domain_dictionary,
-        xen_free_memory, total_mem_pref, total_available_memory):
+#(scaled by domain weight)
+def balance_when_enough_memory(params,
+        xen_free_memory, total_mem_share, total_available_memory):
     log.info('balance_when_enough_memory(xen_free_memory={!r}, '
-        'total_mem_pref={!r}, total_available_memory={!r})'.format(
-            xen_free_memory, total_mem_pref, total_available_memory))
+        'total_mem_share={!r}, total_available_memory={!r})'.format(
+            xen_free_memory, total_mem_share, total_available_memory))
 
-    target_memory = {}
+    ids, actual, pref, maximum, share, tier = params
+    if total_mem_share == 0:
+        share, total_mem_share = split_weights(xrange(len(ids)), pref, share)
+    target_memory = [0] * len(ids)
     # memory not assigned because of static max
     left_memory = 0
     acceptors_count = 0
-    for i in domain_dictionary.keys():
-        if domain_dictionary[i].meminfo is None:
-            continue
-        if domain_dictionary[i].no_progress:
-            continue
+    for k in xrange(len(ids)):
 #distribute total_available_memory proportionally to mempref
-        scale = 1.0*prefmem(domain_dictionary[i])/total_mem_pref
-        target_nonint = prefmem(domain_dictionary[i]) + scale*total_available_memory
+        scale = 1.0*share[k]/total_mem_share
+        target_nonint = pref[k] + scale*total_available_memory
 #prevent rounding errors
         target = int(0.999*target_nonint)
 #do not try to give more memory than static max
-        if target > domain_dictionary[i].memory_maximum:
-            left_memory += target-domain_dictionary[i].memory_maximum
-            target = domain_dictionary[i].memory_maximum
+        if target > maximum[k]:
+            left_memory += target-maximum[k]
+            target = maximum[k]
         else:
 # count domains which can accept more memory
             acceptors_count += 1
-        target_memory[i] = target
-# distribute left memory across all acceptors
+        target_memory[k] = target
+# distribute left memory across all acceptors: in each round every domain
+# below static max gets the same bonus; domains which would go over static max
+# are capped and the excess is distributed in the next round. Instead of
+# iterating over all domains in each round, process domains ordered by their
+# headroom to static max - in each round cap those whose headroom is covered by
+# the sum of bonuses so far
+    waiting = sorted((maximum[k]-target_memory[k], k)
+                     for k in xrange(len(ids))
+                     if target_memory[k] < maximum[k])
+    capped_count = 0
+    total_bonus = 0
     while left_memory > 0 and acceptors_count > 0:
         log.info('left_memory={} acceptors_count={}'.format(
             left_memory, acceptors_count))
 
+        memory_bonus = int(0.999*(left_memory/acceptors_count))
+        total_bonus += memory_bonus
         new_left_memory = 0
         new_acceptors_count = acceptors_count
-        for i in target_memory.keys():
-            target = target_memory[i]
-            if target < domain_dictionary[i].memory_maximum:
-                memory_bonus = int(0.999*(left_memory/acceptors_count))
-                if target+memory_bonus >= domain_dictionary[i].memory_maximum:
-                    new_left_memory += target+memory_bonus - domain_dictionary[i].memory_maximum
-                    target = domain_dictionary[i].memory_maximum
-                    new_acceptors_count -= 1
-                else:
-                    target += memory_bonus
-            target_memory[i] = target
+        while capped_count < len(waiting) and \
+                waiting[capped_count][0] <= total_bonus:
+            headroom, k = waiting[capped_count]
+            new_left_memory += total_bonus - headroom
+            target_memory[k] = maximum[k]
+            new_acceptors_count -= 1
+            capped_count += 1
         left_memory = new_left_memory
         acceptors_count = new_acceptors_count
-# split target_memory dictionary to donors and acceptors
+    for headroom, k in waiting[capped_count:]:
+        target_memory[k] += total_bonus
+# split target_memory to donors and acceptors
 #  this is needed to first get memory from donors and only then give it to acceptors
     donors_rq = list()
     acceptors_rq = list()
-    for i in target_memory.keys():
-        target = target_memory[i]
-        if (target < domain_dictionary[i].memory_actual):
-            donors_rq.append((i, target))
+    for k in xrange(len(ids)):
+        target = target_memory[k]
+        if (target < actual[k]):
+            donors_rq.append((ids[k], target))
         else:
-            acceptors_rq.append((i, target))
+            acceptors_rq.append((ids[k], target))
 
 #    print 'balance(enough): xen_free_memory=', xen_free_memory, 'requests:', donors_rq + acceptors_rq
     return donors_rq + acceptors_rq
 
 
 #when not enough mem to make everyone be above prefmem, make donors be at prefmem, and 
-#redistribute anything left between acceptors
-def balance_when_low_on_memory(domain_dictionary,
-        xen_free_memory, total_mem_pref_acceptors, donors, acceptors):
+#redistribute anything left between acceptors - first to acceptors in the
+#highest tier, then (if all of them can get their prefmem) to lower tiers
+def balance_when_low_on_memory(params,
+        xen_free_memory, donors, acceptors):
+    ids, actual, pref, maximum, share, tier = params
     log.debug('balance_when_low_on_memory(xen_free_memory={!r}, '
-        'total_mem_pref_acceptors={!r}, donors={!r}, acceptors={!r})'.format(
-            xen_free_memory, total_mem_pref_acceptors, donors, acceptors))
+        'donors={!r}, acceptors={!r})'.format(
+            xen_free_memory,
+            [ids[k] for k in donors], [ids[k] for k in acceptors]))
     donors_rq = list()
     acceptors_rq = list()
     squeezed_mem = xen_free_memory
-    for i in donors:
-        avail = -memory_needed(domain_dictionary[i])
+    for k in donors:
+        #-memory_needed()
+        avail = -(pref[k] - actual[k])
         if avail < 10*1024*1024:
             #probably we have already tried making it exactly at prefmem, give up
             continue
         squeezed_mem -= avail
-        donors_rq.append((i, prefmem(domain_dictionary[i])))
+        donors_rq.append((ids[k], pref[k]))
 #the below can happen if initially xen free memory is below 50M
     if squeezed_mem < 0:
         return donors_rq
-    for i in acceptors:
-        scale = 1.0*prefmem(domain_dictionary[i])/total_mem_pref_acceptors
-        target_nonint = domain_dictionary[i].memory_actual + scale*squeezed_mem
+    tiers = sorted(set(tier[k] for k in acceptors), reverse=True)
+    for t in tiers:
+        tier_acceptors = [k for k in acceptors if tier[k] == t]
+        tier_need = sum(pref[k] - actual[k] for k in tier_acceptors)
+        if t != tiers[-1] and squeezed_mem >= tier_need:
+#enough memory for the whole tier, the rest goes to lower tiers
+            for k in tier_acceptors:
+                acceptors_rq.append((ids[k], min(int(pref[k]), maximum[k])))
+            squeezed_mem -= tier_need
+            continue
+        tier_share, total_mem_share_acceptors = split_weights(tier_acceptors,
+                                                              pref, share)
+        for k in tier_acceptors:
+            scale = 1.0*tier_share[k]/total_mem_share_acceptors
+            target_nonint = actual[k] + scale*squeezed_mem
 #do not try to give more memory than static max
-        target = min(int(0.999*target_nonint), domain_dictionary[i].memory_maximum)
-        acceptors_rq.append((i, target))
+            target = min(int(0.999*target_nonint), maximum[k])
+            acceptors_rq.append((ids[k], target))
+#nothing left for lower tiers
+        break
 #    print 'balance(low): xen_free_memory=', xen_free_memory, 'requests:', donors_rq + acceptors_rq
     return donors_rq + acceptors_rq
 
@@ -246,38 +329,33 @@ def balance(xen_free_memory, domain_dictionary):
     log.debug('balance(xen_free_memory={!r}, domain_dictionary={!r})'.format(
         xen_free_memory, domain_dictionary))
 
+    params = domains_params(domain_dictionary)
+    ids, actual, pref, maximum, share, tier = params
+
 #sum of all memory requirements - in other words, the difference between
 #memory required to be added to domains (acceptors) to make them be at their 
 #preferred memory, and memory that can be taken from domains (donors) that
 #can provide memory. So, it can be negative when plenty of memory.
     total_memory_needed = 0
 
-#sum of memory preferences of all domains
-    total_mem_pref = 0
-
-#sum of memory preferences of all domains that require more memory
-    total_mem_pref_acceptors = 0
+#sum of memory preferences (scaled by weight) of all domains
+    total_mem_share = 0
     
     donors = list()	# domains that can yield memory
     acceptors = list()  # domains that require more memory
 #pass 1: compute the above "total" values
-    for i in domain_dictionary.keys():
-        if domain_dictionary[i].meminfo is None:
-            continue
-        if domain_dictionary[i].no_progress:
-            continue
-        need = memory_needed(domain_dictionary[i])
-#        print 'domain' , i, 'act/pref', domain_dictionary[i].memory_actual, prefmem(domain_dictionary[i]), 'need=', need
-        if need < 0 or domain_dictionary[i].memory_actual >= domain_dictionary[i].memory_maximum:
-            donors.append(i)
+    for k in xrange(len(ids)):
+        #memory_needed()
+        need = pref[k] - actual[k]
+        if need < 0 or actual[k] >= maximum[k]:
+            donors.append(k)
         else:
-            acceptors.append(i)
-            total_mem_pref_acceptors += prefmem(domain_dictionary[i])
+            acceptors.append(k)
         total_memory_needed += need
-        total_mem_pref += prefmem(domain_dictionary[i])
+        total_mem_share += share[k]
 
     total_available_memory = xen_free_memory - total_memory_needed  
     if total_available_memory > 0:
-        return balance_when_enough_memory(domain_dictionary, xen_free_memory, total_mem_pref, total_available_memory)
+        return balance_when_enough_memory(params, xen_free_memory, total_mem_share, total_available_memory)
     else:
-        return balance_when_low_on_memory(domain_dictionary, xen_free_memory, total_mem_pref_acceptors, donors, acceptors)
+        return balance_when_low_on_memory(params, xen_free_memory, donors, acceptors)
@@ -0,0 +1,168 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+import select
+import time
+
+
+class HypervisorBackend(object):
+    """
+    Interface between qmemman SystemState and the hypervisor. All the
+    memory sizes are in KiB, as reported by Xen; domain ids are strings.
+    """
+
+    def time(self):
+        """Current time, in seconds"""
+        raise NotImplementedError
+
+    def physinfo(self):
+        """
+        :return: dict with 'total_memory' and 'free_memory' keys
+        """
+        raise NotImplementedError
+
+    def domain_getinfo(self):
+        """
+        :return: list of dicts with 'domid' (int) and 'mem_kb' keys, for all
+        the running domains
+        """
+        raise NotImplementedError
+
+    def read_domain_keys(self, id, keys):
+        """
+        Read domain properties (xenstore keys relative to domain's home,
+        like 'memory/static-max' or 'name') at once.
+
+        :return: list of values, None for not existing keys
+        """
+        raise NotImplementedError
+
+    def read_domain_key(self, id, key):
+        return self.read_domain_keys(id, [key])[0]
+
+    def set_domain_memory(self, id, target_kb):
+        """
+        Set domain memory target (balloon driver target) and maximum
+        allocation
+        """
+        raise NotImplementedError
+
+    def start_memory_watch(self, ids):
+        """
+        Start watching for events which may mean that some memory was
+        released: domain destroyed, or domain *ids* reported its memory usage
+        """
+        raise NotImplementedError
+
+    def stop_memory_watch(self, ids):
+        raise NotImplementedError
+
+    def wait_for_memory_change(self, timeout):
+        """
+        Wait at most *timeout* seconds for an event registered by
+        start_memory_watch.
+
+        :return: True if woken up by an event, False on timeout
+        """
+        raise NotImplementedError
+
+    def notify_error(self, name, message):
+        """Report a problem with domain *name* to the user"""
+        raise NotImplementedError
+
+    def clear_error(self, name, message):
+        raise NotImplementedError
+
+
+class XenBackend(HypervisorBackend):
+    def __init__(self):
+        import xen.lowlevel.xc
+        import xen.lowlevel.xs
+        self.xc = xen.lowlevel.xc.xc()
+        self.xs = xen.lowlevel.xs.xs()
+        # separate handle for watches used to wake up ballooning loops, to not
+        # mix watch events with replies to other requests
+        self.xs_watch = xen.lowlevel.xs.xs()
+
+    def time(self):
+        return time.time()
+
+    def physinfo(self):
+        return self.xc.physinfo()
+
+    def domain_getinfo(self):
+        return self.xc.domain_getinfo()
+
+    def read_domain_keys(self, id, keys):
+        if len(keys) == 1:
+            return [self.xs.read('', '/local/domain/%s/%s' % (id, keys[0]))]
+        # read all the entries in one transaction
+        th = self.xs.transaction_start()
+        try:
+            return [self.xs.read(th, '/local/domain/%s/%s' % (id, key))
+                    for key in keys]
+        finally:
+            # read-only transaction, nothing to commit
+            self.xs.transaction_end(th, True)
+
+    def set_domain_memory(self, id, target_kb):
+#can happen in the middle of domain shutdown
+#apparently xc.lowlevel throws exceptions too
+        try:
+            self.xc.domain_setmaxmem(int(id), target_kb + 1024) # LIBXL_MAXMEM_CONSTANT=1024
+            self.xc.domain_set_target_mem(int(id), target_kb)
+        except:
+            pass
+        self.xs.write('', '/local/domain/' + id + '/memory/target',
+                      str(target_kb))
+
+    def start_memory_watch(self, ids):
+        self.xs_watch.watch('@releaseDomain', '@releaseDomain')
+        for i in ids:
+            self.xs_watch.watch('/local/domain/%s/memory/meminfo' % i, i)
+        # every watch fires once just after registration, discard those events
+        self.drain_memory_watch()
+
+    def stop_memory_watch(self, ids):
+        self.xs_watch.unwatch('@releaseDomain', '@releaseDomain')
+        for i in ids:
+            self.xs_watch.unwatch('/local/domain/%s/memory/meminfo' % i, i)
+        self.drain_memory_watch()
+
+    def drain_memory_watch(self):
+        fd = self.xs_watch.fileno()
+        while select.select([fd], [], [], 0)[0]:
+            self.xs_watch.read_watch()
+
+    def wait_for_memory_change(self, timeout):
+        if timeout <= 0:
+            return False
+        if select.select([self.xs_watch.fileno()], [], [], timeout)[0]:
+            self.drain_memory_watch()
+            return True
+        return False
+
+    def notify_error(self, name, message):
+        from notify import notify_error_qubes_manager
+        notify_error_qubes_manager(name, message)
+
+    def clear_error(self, name, message):
+        from notify import clear_error_qubes_manager
+        clear_error_qubes_manager(name, message)
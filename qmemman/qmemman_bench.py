@@ -0,0 +1,236 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+# Benchmark of qmemman balancing algorithm, using simulated hypervisor. Can be
+# run on any system, without Xen:
+#   python2 qmemman_bench.py [scenario...]
+
+import logging
+import math
+import random
+import sys
+from optparse import OptionParser
+
+from qmemman_sim import Simulation, SimulatedDomain, SimulatedRequest, MB
+
+GB = 1024*MB
+
+
+def base_domains(count, rnd):
+    domains = [SimulatedDomain('0', 4*GB,
+                               meminfo_trace=[(0, 1*GB)])]
+    for i in range(1, count + 1):
+        domains.append(SimulatedDomain(str(i), 2*GB, static_max=4*GB,
+            meminfo_trace=[(0, rnd.randint(200, 800) * MB)]))
+    return domains
+
+
+def random_walk(rnd, duration, start, low, high, step=50*MB, interval=5):
+    trace = []
+    used = start
+    t = 0
+    while t < duration:
+        trace.append((t, used))
+        used = max(low, min(high, used + rnd.randint(-2, 2) * step))
+        t += rnd.randint(1, interval)
+    return trace
+
+
+def scenario_idle(rnd):
+    """Domains with constant memory usage - no memory should be moved after
+    the initial balance (only init-MB)"""
+    return Simulation(20*GB, base_domains(6, rnd), duration=60)
+
+
+def scenario_fluctuating(rnd):
+    """Domains with memory usage changing every few seconds"""
+    domains = base_domains(0, rnd)
+    for i in range(1, 9):
+        domains.append(SimulatedDomain(str(i), 1*GB, static_max=4*GB,
+            meminfo_trace=random_walk(rnd, 300, 500*MB, 200*MB, 3*GB)))
+    return Simulation(16*GB, domains, duration=300)
+
+
+def scenario_start_burst(rnd):
+    """Many VMs started at once, all initial memory assigned to running
+    ones"""
+    requests = [SimulatedRequest(10 + i * 0.5, 400*MB, static_max=4*GB,
+                                 lifetime=60)
+                for i in range(10)]
+    return Simulation(16*GB, base_domains(5, rnd), requests, duration=120)
+
+
+def scenario_dispvm(rnd):
+    """DispVMs started one after another, each running for a short time"""
+    requests = [SimulatedRequest(10 + i * 15, 1*GB, static_max=4*GB,
+                                 lifetime=10)
+                for i in range(10)]
+    return Simulation(16*GB, base_domains(5, rnd), requests, duration=180)
+
+
+def scenario_slow_donor(rnd):
+    """Request which needs memory from a domain releasing it slowly"""
+    domains = base_domains(2, rnd)
+    domains.append(SimulatedDomain('3', 2*GB, static_max=8*GB,
+                                   meminfo_trace=[(0, 300*MB)],
+                                   balloon_rate=150*MB))
+    requests = [SimulatedRequest(10, 4*GB, static_max=4*GB)]
+    return Simulation(12*GB, domains, requests, duration=60)
+
+
+def scenario_stuck_donor(rnd):
+    """Request while one of the donors does not react to memset at all"""
+    domains = base_domains(2, rnd)
+    domains.append(SimulatedDomain('3', 2*GB, static_max=8*GB,
+                                   meminfo_trace=[(0, 300*MB)],
+                                   balloon_rate=0))
+    requests = [SimulatedRequest(10, 4*GB, static_max=4*GB)]
+    return Simulation(12*GB, domains, requests, duration=60)
+
+
+def scenario_qos(rnd):
+    """Background VM (tier 0) with growing memory usage next to interactive
+    VMs (tier 2, weight 200, 1GB guaranteed)"""
+    domains = base_domains(0, rnd)
+    domains.append(SimulatedDomain('1', 2*GB, static_max=8*GB,
+        meminfo_trace=random_walk(rnd, 120, 1*GB, 500*MB, 6*GB,
+                                  step=200*MB),
+        qos=(100, 0, 0)))
+    for i in range(2, 5):
+        domains.append(SimulatedDomain(str(i), 1*GB, static_max=4*GB,
+            meminfo_trace=random_walk(rnd, 120, 500*MB, 200*MB, 2*GB),
+            qos=(200, 1*GB, 2)))
+    return Simulation(10*GB, domains, duration=120)
+
+
+def scenario_many_vms(rnd):
+    """Many small VMs and plenty of free memory, VMs started every
+    second"""
+    # dom0 limited to 4GB, as by default in Qubes
+    domains = [SimulatedDomain('0', 4*GB, static_max=4*GB,
+                               meminfo_trace=[(0, 1*GB)])]
+    for i in range(1, 41):
+        domains.append(SimulatedDomain(str(i), 1*GB, static_max=1*GB,
+            meminfo_trace=random_walk(rnd, 300, 400*MB, 200*MB, 800*MB)))
+    requests = [SimulatedRequest(5 + i, 400*MB, static_max=1*GB,
+                                 lifetime=20)
+                for i in range(200)]
+    return Simulation(96*GB, domains, requests, duration=220)
+
+
+SCENARIOS = [
+    ('idle', scenario_idle),
+    ('fluctuating', scenario_fluctuating),
+    ('start-burst', scenario_start_burst),
+    ('dispvm', scenario_dispvm),
+    ('slow-donor', scenario_slow_donor),
+    ('stuck-donor', scenario_stuck_donor),
+    ('qos', scenario_qos),
+    ('many-vms', scenario_many_vms),
+]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of values, 0 for an empty list"""
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = int(math.ceil(pct * len(values) / 100.0)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def run_scenario(name, seed=0):
+    """
+    Run a scenario and collect its metrics.
+
+    :return: dict of metrics
+    """
+    rnd = random.Random('{}-{}'.format(name, seed))
+    simulation = dict(SCENARIOS)[name](rnd).run()
+    backend = simulation.backend
+    latencies = [rq.latency for rq in simulation.requests
+                 if rq.satisfied]
+    cpu_times = [rq.cpu_time for rq in simulation.requests]
+    return {
+        'requests': len(simulation.requests),
+        'failed': len([rq for rq in simulation.requests
+                       if not rq.satisfied]),
+        'latency_avg': sum(latencies) / len(latencies) if latencies else 0,
+        'latency_max': max(latencies) if latencies else 0,
+        'latency_p99': percentile(latencies, 99),
+        'cpu_p99': percentile(cpu_times, 99),
+        'scans_per_request': float(sum(rq.scans for rq in
+            simulation.requests)) / max(1, len(simulation.requests)),
+        'transferred_initial': simulation.initial_transferred,
+        'transferred': backend.transferred - simulation.initial_transferred,
+        'memsets': backend.memsets,
+        'oscillations': backend.oscillations(),
+        'min_free': backend.min_free,
+        'errors': len(backend.errors),
+    }
+
+
+def main():
+    usage = "usage: %prog [options] [scenario...]"
+    parser = OptionParser(usage)
+    parser.add_option("-s", "--seed", dest="seed", type="int", default=0,
+                      help="Seed of random memory usage traces")
+    parser.add_option("-l", "--list", dest="list", action="store_true",
+                      default=False, help="List available scenarios")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true",
+                      default=False, help="Show qmemman log")
+    (options, args) = parser.parse_args()
+
+    if options.list:
+        for name, scenario in SCENARIOS:
+            print "{:<12} {}".format(name,
+                ' '.join(scenario.__doc__.split()))
+        return
+
+    logging.basicConfig(
+        level=logging.INFO if options.verbose else logging.CRITICAL)
+
+    names = args or [name for name, _ in SCENARIOS]
+    for name in names:
+        if name not in dict(SCENARIOS):
+            parser.error("Unknown scenario: {}".format(name))
+
+    # latency is simulated time (waiting for domains to give back memory),
+    # cpu is real time spent in qmemman handling a request; memory moved in
+    # the initial balance (first Simulation.SETTLE_TIME seconds) is shown
+    # as init-MB, the rest as moved-MB
+    print "{:<12} {:>5} {:>6} {:>8} {:>8} {:>8} {:>8} {:>6} {:>8} {:>10} " \
+          "{:>7} {:>5} {:>8} {:>6}".format('scenario', 'reqs', 'failed',
+              'lat-avg', 'lat-p99', 'lat-max', 'cpu-p99', 'scans',
+              'init-MB', 'moved-MB', 'memsets', 'osc', 'minfree', 'errors')
+    for name in names:
+        result = run_scenario(name, options.seed)
+        print "{:<12} {requests:>5} {failed:>6} {latency_avg:>7.2f}s " \
+              "{latency_p99:>7.2f}s {latency_max:>7.2f}s {cpu_ms:>6.2f}ms " \
+              "{scans_per_request:>6.1f} {moved_initial:>8} {moved:>10} " \
+              "{memsets:>7} {oscillations:>5} {min_free_mb:>6}MB " \
+              "{errors:>6}".format(
+                  name, moved_initial=result['transferred_initial'] / MB,
+                  moved=result['transferred'] / MB,
+                  cpu_ms=result['cpu_p99'] * 1000,
+                  min_free_mb=result['min_free'] / MB, **result)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,24 +20,150 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #
 #
+import json
 import socket
 import fcntl
+
+# qmemman protocol, version 2
+#
+# Every message is a single line. The client starts with "HELLO <version>",
+# the server responds with "HELLO <version>" - the version it will use. Then
+# the client sends requests, each prefixed with request id chosen by the
+# client (without spaces):
+#   <id> RESERVE <amount> - get <amount> bytes of free memory for a new
+#                           domain; the memory stays reserved until released
+#                           or the connection is closed
+#   <id> RELEASE <reserve-id> - release memory reserved by the given request
+#   <id> QUERY            - get free memory info
+#   <id> STATS            - get qmemman statistics
+# The server responds to each request, in order, with one of:
+#   <id> OK [<json data>]
+#   <id> FAIL <reason>
+# The client doesn't need to wait for a response before sending the next
+# request; multiple RESERVE requests sent at once are handled together.
+#
+# Version 1 (still supported by the server): the client sends bare amount,
+# the server responds "OK" or "FAIL".
+
+SOCK_PATH = "/var/run/qubes/qmemman.sock"
+PROTOCOL_VERSION = 2
+
+# reasons of failed requests
+#: not enough memory, even after taking all the memory VMs do not use
+REASON_NO_MEMORY = 'no-memory'
+#: VMs did not give back memory in time
+REASON_BALLOON_FAILED = 'balloon-failed'
+REASON_BAD_REQUEST = 'bad-request'
+REASON_UNKNOWN_COMMAND = 'unknown-command'
+REASON_UNKNOWN_RESERVATION = 'unknown-reservation'
+#: request not handled because of an error in qmemman
+REASON_INTERNAL_ERROR = 'internal-error'
+
 class QMemmanClient:
+    def __init__(self):
+        self.sock = None
+        self.buffer = ''
+        self.next_id = 1
+        #: responses already received, but not yet returned by wait()
+        self.responses = {}
+        #: reason of the last failed request_memory() call
+        self.fail_reason = None
 
-    def request_memory(self, amount):
+    def connect(self):
+        if self.sock is not None:
+            return
         self.sock = socket.socket(socket.AF_UNIX)
 
         flags = fcntl.fcntl(self.sock.fileno(), fcntl.F_GETFD)
         flags |= fcntl.FD_CLOEXEC
         fcntl.fcntl(self.sock.fileno(), fcntl.F_SETFD, flags)
 
-        self.sock.connect("/var/run/qubes/qmemman.sock")
-        self.sock.send(str(amount)+"\n")
-        self.received = self.sock.recv(1024).strip()
-        if self.received == 'OK':
-            return True
-        else:
-            return False
+        try:
+            self.sock.connect(SOCK_PATH)
+            self.sock.sendall("HELLO %d\n" % PROTOCOL_VERSION)
+            # version 1 server disconnects here
+            hello = self.read_line().split()
+            if len(hello) != 2 or hello[0] != 'HELLO' or \
+                    hello[1] != str(PROTOCOL_VERSION):
+                raise IOError("qmemman: unsupported protocol: %r" % hello)
+        except:
+            self.close()
+            raise
+
+    def read_line(self):
+        while '\n' not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise IOError("qmemman: connection closed")
+            self.buffer += data
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line
+
+    def send(self, command, *args):
+        """
+        Send a request without waiting for the response.
+
+        :return: request id, to be passed to wait()
+        """
+        self.connect()
+        rq_id = str(self.next_id)
+        self.next_id += 1
+        self.sock.sendall(' '.join([rq_id, command] + map(str, args)) + '\n')
+        return rq_id
+
+    def wait(self, rq_id):
+        """
+        Wait for response to the request *rq_id*.
+
+        :return: tuple (True, data) on success, (False, reason) on failure
+        """
+        while rq_id not in self.responses:
+            untrusted_words = self.read_line().split(' ', 2)
+            if len(untrusted_words) < 2:
+                raise IOError("qmemman: invalid response")
+            data = untrusted_words[2] if len(untrusted_words) > 2 else ''
+            if untrusted_words[1] == 'OK':
+                self.responses[untrusted_words[0]] = (True, data)
+            else:
+                self.responses[untrusted_words[0]] = \
+                    (False, data.split(' ', 1)[0])
+        return self.responses.pop(rq_id)
+
+    def reserve(self, amount):
+        """
+        Request *amount* bytes of memory, without waiting for the
+        response.
+
+        :return: request id
+        """
+        return self.send('RESERVE', amount)
+
+    def release(self, rq_id):
+        """Release memory reserved with request *rq_id*"""
+        return self.wait(self.send('RELEASE', rq_id))[0]
+
+    def request_memory(self, amount):
+        success, data = self.wait(self.reserve(amount))
+        self.fail_reason = None if success else data
+        return success
+
+    def query(self):
+        success, data = self.wait(self.send('QUERY'))
+        if not success:
+            raise IOError("qmemman: QUERY failed: %s" % data)
+        return json.loads(data)
+
+    def stats(self):
+        success, data = self.wait(self.send('STATS'))
+        if not success:
+            raise IOError("qmemman: STATS failed: %s" % data)
+        return json.loads(data)
 
     def close(self):
-        self.sock.close()
+        # memory not released explicitly is released when the connection is
+        # closed
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.buffer = ''
+        self.responses = {}
@@ -21,13 +21,17 @@
 #
 #
 import SocketServer
+import json
+import select
 import thread
 import time
 import xen.lowlevel.xs
 import sys
 import os
 import socket
-from qmemman import SystemState
+from qmemman import SystemState, MemoryRequest
+from qmemman_client import PROTOCOL_VERSION, REASON_BAD_REQUEST, \
+    REASON_UNKNOWN_COMMAND, REASON_UNKNOWN_RESERVATION, REASON_INTERNAL_ERROR
 import qmemman_algo
 from ConfigParser import SafeConfigParser
 from optparse import OptionParser
@@ -40,7 +44,16 @@ config_path = '/etc/qubes/qmemman.conf'
 SOCK_PATH='/var/run/qubes/qmemman.sock'
 LOG_PATH='/var/log/qubes/qmemman.log'
 
-system_state = SystemState()
+# meminfo updates arriving within MEMINFO_COALESCE_DELAY seconds from each other
+# are handled with a single balance pass, but balance is never delayed more
+# than MEMINFO_MAX_DELAY seconds after the first not yet handled update
+MEMINFO_COALESCE_DELAY = 0.2
+MEMINFO_MAX_DELAY = 1.0
+# how often log meminfo coalescing statistics
+STATS_LOG_INTERVAL = 60
+
+# SystemState instance, created by QMemmanServer.main()
+system_state = None
 global_lock = thread.allocate_lock()
 # If XS_Watcher will
 # handle meminfo event before @introduceDomain, it will use
@@ -51,6 +64,8 @@ global_lock = thread.allocate_lock()
 # memory for a new VM, before releasing the lock. Then XS_Watcher will check
 # this flag before processing other event.
 force_refresh_domain_list = False
+# XS_Watcher instance, for statistics
+xs_watcher = None
 
 def only_in_first_list(l1, l2):
     ret=[]
@@ -69,17 +84,34 @@ class WatchType:
         self.param = param
 
 class XS_Watcher:
-    def __init__(self):
+    def __init__(self, handle=None):
+        """
+        :param handle: xenstore handle, a new connection by default
+        """
         self.log = logging.getLogger('qmemman.daemon.xswatcher')
         self.log.debug('XS_Watcher()')
 
-        self.handle = xen.lowlevel.xs.xs()
+        if handle is None:
+            handle = xen.lowlevel.xs.xs()
+        self.handle = handle
         self.handle.watch('@introduceDomain', WatchType(
             XS_Watcher.domain_list_changed, False))
         self.handle.watch('@releaseDomain', WatchType(
             XS_Watcher.domain_list_changed, False))
         self.watch_token_dict = {}
 
+        #: time of the first meminfo update not handled by balance yet, None
+        #: if there is no such
+        self.balance_pending_since = None
+        #: time of the last meminfo update
+        self.last_meminfo_time = None
+        #: number of meminfo updates received
+        self.meminfo_events = 0
+        #: number of balance passes done in response to meminfo updates
+        self.meminfo_balances = 0
+        self.stats_since = time.time()
+        self.stats_logged = self.stats_since
+
     def domain_list_changed(self, refresh_only=False):
         """
         Check if any domain was created/destroyed. If it was, update
@@ -99,19 +131,25 @@ class XS_Watcher:
             got_lock = True
             self.log.debug('global_lock acquired')
         try:
-            curr = self.handle.ls('', '/local/domain')
-            if curr is None:
-                return
+            # read the whole domain list in one transaction
+            th = self.handle.transaction_start()
+            try:
+                curr = self.handle.ls(th, '/local/domain')
+                if curr is None:
+                    return
 
-            # check if domain is really there, it may happen that some empty
-            # directories are left in xenstore
-            curr = filter(
-                lambda x:
-                self.handle.read('',
-                                 '/local/domain/{}/domid'.format(x)
-                                 ) is not None,
-                curr
-            )
+                # check if domain is really there, it may happen that some
+                # empty directories are left in xenstore
+                curr = filter(
+                    lambda x:
+                    self.handle.read(th,
+                                     '/local/domain/{}/domid'.format(x)
+                                     ) is not None,
+                    curr
+                )
+            finally:
+                # read-only transaction, nothing to commit
+                self.handle.transaction_end(th, True)
             self.log.debug('curr={!r}'.format(curr))
 
             for i in only_in_first_list(curr, self.watch_token_dict.keys()):
@@ -136,6 +174,11 @@ class XS_Watcher:
 
 
     def meminfo_changed(self, domain_id):
+        """
+        Record new meminfo of a domain. Memory is redistributed later, by
+        balance_if_due(), so multiple updates arriving in short time are
+        handled with a single balance pass.
+        """
         self.log.debug('meminfo_changed(domain_id={!r})'.format(domain_id))
         untrusted_meminfo_key = self.handle.read('', get_domain_meminfo_key(domain_id))
         if untrusted_meminfo_key == None or untrusted_meminfo_key == '':
@@ -144,23 +187,149 @@ class XS_Watcher:
         self.log.debug('acquiring global_lock')
         global_lock.acquire()
         self.log.debug('global_lock acquired')
-        if force_refresh_domain_list:
-            self.domain_list_changed(refresh_only=True)
+        try:
+            if force_refresh_domain_list:
+                self.domain_list_changed(refresh_only=True)
 
-        system_state.refresh_meminfo(domain_id, untrusted_meminfo_key)
+            # the domain may be already gone
+            if domain_id not in system_state.domdict:
+                return
+            system_state.update_meminfo(domain_id, untrusted_meminfo_key)
+        finally:
+            global_lock.release()
+            self.log.debug('global_lock released')
 
-        global_lock.release()
-        self.log.debug('global_lock released')
+        now = time.time()
+        self.meminfo_events += 1
+        self.last_meminfo_time = now
+        if self.balance_pending_since is None:
+            self.balance_pending_since = now
 
+    def balance_due_time(self):
+        """
+        Time when pending meminfo updates should be handled, None if there
+        are none.
+        """
+        if self.balance_pending_since is None:
+            return None
+        return min(self.last_meminfo_time + MEMINFO_COALESCE_DELAY,
+                   self.balance_pending_since + MEMINFO_MAX_DELAY)
+
+    def balance_if_due(self):
+        due = self.balance_due_time()
+        if due is None or time.time() < due:
+            return
+        self.log.debug('acquiring global_lock')
+        global_lock.acquire()
+        self.log.debug('global_lock acquired')
+        try:
+            if force_refresh_domain_list:
+                self.domain_list_changed(refresh_only=True)
+            # reset before balancing, so updates arriving in the meantime
+            # will be handled by the next pass
+            self.balance_pending_since = None
+            self.meminfo_balances += 1
+            system_state.do_balance()
+        finally:
+            global_lock.release()
+            self.log.debug('global_lock released')
+
+    def get_stats(self):
+        elapsed = max(time.time() - self.stats_since, 1)
+        return {
+            'meminfo_events': self.meminfo_events,
+            'meminfo_balances': self.meminfo_balances,
+            'balances_per_second':
+                float(self.meminfo_balances) / elapsed,
+            'coalescing_ratio':
+                float(self.meminfo_events) / max(self.meminfo_balances, 1),
+        }
+
+    def log_stats_if_due(self):
+        now = time.time()
+        if now - self.stats_logged < STATS_LOG_INTERVAL:
+            return
+        self.stats_logged = now
+        self.log.info('meminfo events={meminfo_events} '
+            'balances={meminfo_balances} '
+            '({balances_per_second:.2f}/s) '
+            'coalescing ratio={coalescing_ratio:.2f}'.format(
+                **self.get_stats()))
 
     def watch_loop(self):
         self.log.debug('watch_loop()')
+        fd = self.handle.fileno()
         while True:
-            result = self.handle.read_watch()
-            self.log.debug('watch_loop result={!r}'.format(result))
-            token = result[1]
-            token.fn(self, token.param)
+            due = self.balance_due_time()
+            if due is None:
+                timeout = STATS_LOG_INTERVAL
+            else:
+                timeout = max(0, due - time.time())
+            if select.select([fd], [], [], timeout)[0]:
+                result = self.handle.read_watch()
+                self.log.debug('watch_loop result={!r}'.format(result))
+                token = result[1]
+                token.fn(self, token.param)
+            self.balance_if_due()
+            self.log_stats_if_due()
+
+
+#: memory requests waiting to be handled by do_balloon_requests
+pending_requests = []
+pending_requests_lock = thread.allocate_lock()
+
+def request_memory(requests):
+    """
+    Queue memory requests and wait until they are handled. Requests queued
+    while some other request is being handled are handled together, with a
+    single ballooning pass.
 
+    :param requests: list of MemoryRequest objects
+    """
+    with pending_requests_lock:
+        pending_requests.extend(requests)
+
+    log = logging.getLogger('qmemman.daemon.reqhandler')
+    log.debug('acquiring global_lock')
+    global_lock.acquire()
+    log.debug('global_lock acquired')
+    try:
+        # could be already handled by another thread, together with its own
+        # requests
+        if any(rq.result is None for rq in requests):
+            with pending_requests_lock:
+                queued = pending_requests[:]
+                del pending_requests[:]
+            try:
+                system_state.do_balloon_requests(queued)
+            except Exception:
+                log.exception('failed to handle memory requests')
+                # some of them may be of other threads, which will not call
+                # do_balloon_requests for them again
+                for rq in queued:
+                    if rq.result is None:
+                        rq.result = False
+                        rq.reason = REASON_INTERNAL_ERROR
+    finally:
+        global_lock.release()
+        log.debug('global_lock released')
+
+def release_memory(requests):
+    global force_refresh_domain_list
+    log = logging.getLogger('qmemman.daemon.reqhandler')
+    log.debug('acquiring global_lock')
+    global_lock.acquire()
+    log.debug('global_lock acquired')
+    try:
+        # the new domain is there now (if created), make sure it
+        # is included in the domain list before memory is
+        # redistributed
+        force_refresh_domain_list = True
+        for request in requests:
+            system_state.release_memory(request)
+    finally:
+        global_lock.release()
+        log.debug('global_lock released')
 
 class QMemmanReqHandler(SocketServer.BaseRequestHandler):
     """
@@ -168,48 +337,183 @@ class QMemmanReqHandler(SocketServer.BaseRequestHandler):
 
     It is instantiated once per connection to the server, and must
     override the handle() method to implement communication to the
-    client.
+    client. See qmemman_client for the protocol description.
+
+    Memory granted to the client stays reserved until the client
+    releases it or disconnects (after the domain is created), but
+    global_lock is held only for ballooning, so multiple requests can be
+    handled at the same time.
     """
 
-    def handle(self):
+    def setup(self):
         self.log = logging.getLogger('qmemman.daemon.reqhandler')
+        self.buffer = ''
+        #: MemoryRequest objects of memory reserved by this client, by
+        #: request id
+        self.reservations = {}
 
-        got_lock = False
-        try:
+    def read_lines(self):
+        """
+        Wait for data from the client.
+
+        :return: list of complete lines received, empty on EOF
+        """
+        while '\n' not in self.buffer:
             # self.request is the TCP socket connected to the client
+            data = self.request.recv(1024)
+            self.log.debug('data={!r}'.format(data))
+            if len(data) == 0:
+                return []
+            self.buffer += data
+        lines = self.buffer.split('\n')
+        self.buffer = lines.pop()
+        return lines
+
+    def respond(self, rq_id, data=None, reason=None):
+        if reason is None:
+            resp = '{} OK'.format(rq_id)
+            if data is not None:
+                resp += ' ' + data
+        else:
+            resp = '{} FAIL {}'.format(rq_id, reason)
+        self.log.debug('resp={!r}'.format(resp))
+        self.request.sendall(resp + '\n')
+
+    def handle(self):
+        try:
+            lines = self.read_lines()
+            if not lines:
+                self.log.info('EOF')
+                return
+            untrusted_hello = lines.pop(0).strip()
+            if untrusted_hello.isdigit():
+                self.handle_v1(int(untrusted_hello))
+                return
+            untrusted_words = untrusted_hello.split()
+            if len(untrusted_words) != 2 or untrusted_words[0] != 'HELLO' \
+                    or not untrusted_words[1].isdigit() \
+                    or int(untrusted_words[1]) < PROTOCOL_VERSION:
+                self.log.warning('Invalid hello: {!r}'.format(
+                    untrusted_hello))
+                return
+            self.request.sendall('HELLO {}\n'.format(PROTOCOL_VERSION))
+
             while True:
-                self.data = self.request.recv(1024).strip()
-                self.log.debug('data={!r}'.format(self.data))
-                if len(self.data) == 0:
+                self.handle_requests(lines)
+                lines = self.read_lines()
+                if not lines:
                     self.log.info('EOF')
-                    if got_lock:
-                        global force_refresh_domain_list
-                        force_refresh_domain_list = True
-                    return
-
-                # XXX something is wrong here: return without release?
-                if got_lock:
-                    self.log.warning('Second request over qmemman.sock?')
                     return
-
-                self.log.debug('acquiring global_lock')
-                global_lock.acquire()
-                self.log.debug('global_lock acquired')
-
-                got_lock = True
-                if system_state.do_balloon(int(self.data)):
-                    resp = "OK\n"
-                else:
-                    resp = "FAIL\n"
-                self.log.debug('resp={!r}'.format(resp))
-                self.request.send(resp)
         except BaseException as e:
             self.log.exception(
                 "exception while handling request: {!r}".format(e))
         finally:
-            if got_lock:
-                global_lock.release()
-                self.log.debug('global_lock released')
+            if self.reservations:
+                release_memory(self.reservations.values())
+
+    def handle_v1(self, amount):
+        """Old protocol - single request, answered with OK/FAIL"""
+        request = MemoryRequest(amount)
+        self.reservations[None] = request
+        request_memory([request])
+        if request.result:
+            resp = "OK\n"
+        else:
+            resp = "FAIL\n"
+        self.log.debug('resp={!r}'.format(resp))
+        self.request.send(resp)
+        # wait for the client to disconnect
+        if self.read_lines():
+            self.log.warning('Second request over qmemman.sock?')
+
+    def handle_requests(self, lines):
+        # consecutive RESERVE requests are handled together
+        reserve_batch = []
+        for untrusted_line in lines:
+            untrusted_words = untrusted_line.split()
+            if not untrusted_words:
+                continue
+            rq_id = untrusted_words[0]
+            if len(untrusted_words) < 2:
+                self.handle_reserve(reserve_batch)
+                reserve_batch = []
+                self.respond(rq_id, reason=REASON_BAD_REQUEST)
+            elif untrusted_words[1] == 'RESERVE':
+                reserve_batch.append((rq_id, untrusted_words[2:]))
+            else:
+                self.handle_reserve(reserve_batch)
+                reserve_batch = []
+                self.handle_command(rq_id, untrusted_words[1],
+                    untrusted_words[2:])
+        self.handle_reserve(reserve_batch)
+
+    def handle_reserve(self, batch):
+        # MemoryRequest for each batch entry, None for invalid ones
+        requests = []
+        for rq_id, untrusted_args in batch:
+            if len(untrusted_args) != 1 or not untrusted_args[0].isdigit() \
+                    or rq_id in self.reservations:
+                requests.append(None)
+                continue
+            request = MemoryRequest(int(untrusted_args[0]))
+            self.reservations[rq_id] = request
+            requests.append(request)
+        if any(requests):
+            request_memory(filter(None, requests))
+        for (rq_id, _), request in zip(batch, requests):
+            if request is None:
+                self.respond(rq_id, reason=REASON_BAD_REQUEST)
+            elif request.result:
+                self.respond(rq_id)
+            else:
+                del self.reservations[rq_id]
+                self.respond(rq_id,
+                             reason=request.reason or REASON_INTERNAL_ERROR)
+
+    def handle_command(self, rq_id, untrusted_command, untrusted_args):
+        if untrusted_command == 'RELEASE':
+            if len(untrusted_args) != 1:
+                self.respond(rq_id, reason=REASON_BAD_REQUEST)
+            elif untrusted_args[0] not in self.reservations:
+                self.respond(rq_id, reason=REASON_UNKNOWN_RESERVATION)
+            else:
+                release_memory([self.reservations.pop(untrusted_args[0])])
+                self.respond(rq_id)
+        elif untrusted_command == 'QUERY':
+            self.respond(rq_id, json.dumps(self.get_memory_info()))
+        elif untrusted_command == 'STATS':
+            self.respond(rq_id, json.dumps(self.get_stats()))
+        else:
+            self.respond(rq_id, reason=REASON_UNKNOWN_COMMAND)
+
+    def get_memory_info(self):
+        self.log.debug('acquiring global_lock')
+        global_lock.acquire()
+        self.log.debug('global_lock acquired')
+        try:
+            system_state.refresh_memactual()
+            free = system_state.get_free_xen_memory()
+            return {
+                'free_memory': free,
+                # what can be requested, after ballooning down all the
+                # domains to their preferred memory size
+                'available_memory': max(0, int(
+                    free - system_state.XEN_FREE_MEM_LEFT +
+                    qmemman_algo.available_memory(system_state.domdict))),
+                'reserved_memory': system_state.reserved_memory,
+                'reservations': len(system_state.reservations),
+            }
+        finally:
+            global_lock.release()
+            self.log.debug('global_lock released')
+
+    def get_stats(self):
+        # do not take global_lock - it may be held for a long time while
+        # ballooning, and stats are most useful exactly then
+        stats = system_state.get_stats()
+        if xs_watcher is not None:
+            stats['meminfo'] = xs_watcher.get_stats()
+        return stats
 
 
 def start_server(server):
@@ -218,6 +522,7 @@ def start_server(server):
 class QMemmanServer:
     @staticmethod          
     def main():
+        global system_state, xs_watcher
         # setup logging
         ha_syslog = logging.handlers.SysLogHandler('/dev/log')
         ha_syslog.setFormatter(
@@ -247,21 +552,28 @@ class QMemmanServer:
         sys.stdout.close()
         sys.stderr.close()
 
+        system_state = SystemState()
         config = SafeConfigParser({
                 'vm-min-mem': str(qmemman_algo.MIN_PREFMEM),
                 'dom0-mem-boost': str(qmemman_algo.DOM0_MEM_BOOST),
-                'cache-margin-factor': str(qmemman_algo.CACHE_FACTOR)
+                'cache-margin-factor': str(qmemman_algo.CACHE_FACTOR),
+                'headroom-max': str(system_state.HEADROOM_MAX),
+                'headroom-window': str(system_state.HEADROOM_WINDOW),
                 })
         config.read(options.config)
         if config.has_section('global'):
             qmemman_algo.MIN_PREFMEM = parse_size(config.get('global', 'vm-min-mem'))
             qmemman_algo.DOM0_MEM_BOOST = parse_size(config.get('global', 'dom0-mem-boost'))
             qmemman_algo.CACHE_FACTOR = config.getfloat('global', 'cache-margin-factor')
+            system_state.HEADROOM_MAX = parse_size(config.get('global', 'headroom-max'))
+            system_state.HEADROOM_WINDOW = config.getint('global', 'headroom-window')
 
         log.info('MIN_PREFMEM={qmemman_algo.MIN_PREFMEM}'
             ' DOM0_MEM_BOOST={qmemman_algo.DOM0_MEM_BOOST}'
-            ' CACHE_FACTOR={qmemman_algo.CACHE_FACTOR}'.format(
-                qmemman_algo=qmemman_algo))
+            ' CACHE_FACTOR={qmemman_algo.CACHE_FACTOR}'
+            ' HEADROOM_MAX={system_state.HEADROOM_MAX}'
+            ' HEADROOM_WINDOW={system_state.HEADROOM_WINDOW}'.format(
+                qmemman_algo=qmemman_algo, system_state=system_state))
 
         try:
             os.unlink(SOCK_PATH)
@@ -270,7 +582,9 @@ class QMemmanServer:
 
         log.debug('instantiating server')
         os.umask(0)
-        server = SocketServer.UnixStreamServer(SOCK_PATH, QMemmanReqHandler)
+        server = SocketServer.ThreadingUnixStreamServer(SOCK_PATH,
+            QMemmanReqHandler)
+        server.daemon_threads = True
         os.umask(077)
 
         # notify systemd
@@ -284,5 +598,6 @@ class QMemmanServer:
             s.sendall("READY=1")
             s.close()
 
+        xs_watcher = XS_Watcher()
         thread.start_new_thread(start_server, tuple([server]))
-        XS_Watcher().watch_loop()
+        xs_watcher.watch_loop()
@@ -0,0 +1,343 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+import bisect
+import time
+
+from qmemman import SystemState, MemoryRequest
+from qmemman_backend import HypervisorBackend
+
+MB = 1024*1024
+
+
+class SimulatedDomain(object):
+    """
+    Domain in the simulated system. Memory sizes are in bytes.
+
+    The domain balloon driver moves its memory allocation towards the
+    target at *balloon_rate* bytes per second, but never below memory used
+    by the domain (it refuses to give it back) and never above Xen free
+    memory. The default rate is of the order of a Linux balloon driver -
+    fast enough to give back memory within the time qmemman waits for it.
+    """
+
+    def __init__(self, id, memory, static_max=None, meminfo_trace=None,
+            balloon_rate=4096*MB, name=None, qos=None):
+        """
+        :param id: domain id (string)
+        :param memory: initial memory allocation
+        :param static_max: maximum memory, None for no limit (like dom0)
+        :param meminfo_trace: list of (time, used memory) pairs, sorted by
+        time; used memory before the first entry is the same as in it
+        :param balloon_rate: bytes per second, 0 for not reacting at all
+        :param qos: tuple (weight, guaranteed memory, tier), None for
+        defaults
+        """
+        self.id = id
+        self.name = name if name is not None else 'dom' + id
+        self.memory = memory
+        self.target = memory
+        self.static_max = static_max
+        if not meminfo_trace:
+            meminfo_trace = [(0, memory / 2)]
+        self.trace_times = [t for t, _ in meminfo_trace]
+        self.trace_values = [used for _, used in meminfo_trace]
+        self.balloon_rate = balloon_rate
+        self.qos = qos
+        #: used memory last reported to qmemman
+        self.reported_used = None
+
+    def used_memory(self, now):
+        idx = bisect.bisect_right(self.trace_times, now) - 1
+        return self.trace_values[max(idx, 0)]
+
+    def meminfo(self, now):
+        """Content of meminfo xenstore key, as written by meminfo-writer"""
+        used = self.used_memory(now)
+        swap_total = 0
+        swap_free = 0
+        if used > self.memory:
+            swap_total = used
+            swap_free = swap_total - (used - self.memory)
+        return ('MemTotal: {} kB\nMemFree: {} kB\nBuffers: 0 kB\n'
+                'Cached: 0 kB\nSwapTotal: {} kB\nSwapFree: {} kB\n'.format(
+                    self.memory / 1024,
+                    max(0, self.memory - used) / 1024,
+                    swap_total / 1024, swap_free / 1024))
+
+
+class SimulatorBackend(HypervisorBackend):
+    """
+    Deterministic hypervisor model for running qmemman outside of Xen.
+    Simulated time advances only when qmemman waits
+    (wait_for_memory_change) or the simulation driver calls advance().
+    """
+
+    def __init__(self, total_memory, domains=()):
+        self.clock = 0.0
+        self.total_memory = total_memory
+        self.domains = {}
+        for dom in domains:
+            self.domains[dom.id] = dom
+
+        #: memory moved between domains and Xen free pool
+        self.transferred = 0
+        #: number of memset requests
+        self.memsets = 0
+        #: number of domain list scans (domain_getinfo calls)
+        self.scans = 0
+        #: memset targets of each domain, used to compute oscillation
+        self.target_history = {}
+        #: lowest Xen free memory observed
+        self.min_free = self.free_memory()
+        #: (name, message) pairs of reported errors
+        self.errors = []
+
+    def free_memory(self):
+        return self.total_memory - sum(dom.memory
+                                       for dom in self.domains.itervalues())
+
+    def create_domain(self, dom):
+        if dom.memory > self.free_memory():
+            raise ValueError('not enough memory to create domain {}'.format(
+                dom.id))
+        self.domains[dom.id] = dom
+        self.min_free = min(self.min_free, self.free_memory())
+
+    def destroy_domain(self, id):
+        del self.domains[id]
+
+    def advance(self, dt):
+        """Move simulated time *dt* seconds forward"""
+        if dt <= 0:
+            return
+        self.clock += dt
+        # first release memory, then allocate, so memory freed in this step
+        # can be used immediately
+        for id in sorted(self.domains.keys()):
+            dom = self.domains[id]
+            if dom.target < dom.memory:
+                floor = max(dom.target, dom.used_memory(self.clock))
+                new_memory = max(floor,
+                                 dom.memory - int(dom.balloon_rate * dt))
+                if new_memory < dom.memory:
+                    self.transferred += dom.memory - new_memory
+                    dom.memory = new_memory
+        for id in sorted(self.domains.keys()):
+            dom = self.domains[id]
+            if dom.target > dom.memory:
+                change = min(int(dom.balloon_rate * dt),
+                             dom.target - dom.memory,
+                             max(0, self.free_memory()))
+                if change > 0:
+                    self.transferred += change
+                    dom.memory += change
+        self.min_free = min(self.min_free, self.free_memory())
+
+    def changed_meminfo(self):
+        """
+        Domains which usage changed since the last report, with their new
+        meminfo; the change is considered reported
+        """
+        changed = []
+        for id in sorted(self.domains.keys()):
+            dom = self.domains[id]
+            used = dom.used_memory(self.clock)
+            if used != dom.reported_used:
+                dom.reported_used = used
+                changed.append((id, dom.meminfo(self.clock)))
+        return changed
+
+    def time(self):
+        return self.clock
+
+    def physinfo(self):
+        return {'total_memory': self.total_memory / 1024,
+                'free_memory': self.free_memory() / 1024}
+
+    def domain_getinfo(self):
+        self.scans += 1
+        return [{'domid': int(id), 'mem_kb': dom.memory / 1024}
+                for id, dom in sorted(self.domains.iteritems())]
+
+    def read_domain_keys(self, id, keys):
+        dom = self.domains.get(id)
+        values = []
+        for key in keys:
+            if dom is None:
+                values.append(None)
+            elif key == 'memory/target':
+                values.append(str(dom.target / 1024))
+            elif key == 'memory/static-max' and dom.static_max is not None:
+                values.append(str(dom.static_max / 1024))
+            elif key == 'name':
+                values.append(dom.name)
+            elif key.startswith('qmemman/') and dom.qos is not None:
+                weight, mem_min, tier = dom.qos
+                values.append(str({'qmemman/weight': weight,
+                                   'qmemman/min-memory': mem_min / 1024,
+                                   'qmemman/tier': tier}[key]))
+            else:
+                values.append(None)
+        return values
+
+    def set_domain_memory(self, id, target_kb):
+        if id not in self.domains:
+            return
+        self.memsets += 1
+        self.domains[id].target = target_kb * 1024
+        self.target_history.setdefault(id, []).append(target_kb * 1024)
+
+    def start_memory_watch(self, ids):
+        pass
+
+    def stop_memory_watch(self, ids):
+        pass
+
+    def wait_for_memory_change(self, timeout):
+        # no events simulated, only the time passes
+        self.advance(timeout)
+        return False
+
+    def notify_error(self, name, message):
+        self.errors.append((name, message))
+
+    def clear_error(self, name, message):
+        pass
+
+    def oscillations(self):
+        """
+        Number of times memset target of some domain changed direction
+        (grow after shrink or the other way around)
+        """
+        count = 0
+        for targets in self.target_history.itervalues():
+            direction = 0
+            for prev, curr in zip(targets, targets[1:]):
+                if curr == prev:
+                    continue
+                new_direction = 1 if curr > prev else -1
+                if direction and new_direction != direction:
+                    count += 1
+                direction = new_direction
+        return count
+
+
+class SimulatedRequest(object):
+    """
+    Start of a new domain at *time*: request memory, then create the domain
+    with *memory* of memory (if the request was satisfied), running for
+    *lifetime* seconds (None - until the end of simulation).
+    """
+
+    def __init__(self, time, memory, static_max=None, meminfo_trace=None,
+            lifetime=None):
+        self.time = time
+        self.memory = memory
+        self.static_max = static_max
+        self.meminfo_trace = meminfo_trace
+        self.lifetime = lifetime
+        # results
+        self.satisfied = None
+        #: simulated time of handling the request
+        self.latency = None
+        #: real (CPU) time of handling the request
+        self.cpu_time = None
+        #: domain list scans done while handling the request
+        self.scans = None
+
+
+class Simulation(object):
+    """
+    Run qmemman SystemState against SimulatorBackend, feeding it with
+    meminfo updates and memory requests, the same way qmemman server does.
+    """
+
+    #: how often domains report their memory usage
+    TICK = 0.1
+    #: time for the initial balance of the domains given at start
+    SETTLE_TIME = 5
+
+    def __init__(self, total_memory, domains, requests=(), duration=60):
+        self.backend = SimulatorBackend(total_memory, domains)
+        self.system_state = SystemState(self.backend)
+        self.requests = sorted(requests, key=lambda rq: rq.time)
+        self.duration = duration
+        self.next_domid = max(int(dom.id) for dom in domains) + 1
+        #: (time, domain id) of domains to destroy
+        self.shutdowns = []
+        #: memory moved in the first SETTLE_TIME seconds
+        self.initial_transferred = None
+        for dom in domains:
+            self.system_state.add_domain(dom.id)
+
+    def handle_meminfo(self):
+        changed = self.backend.changed_meminfo()
+        for id, meminfo in changed:
+            self.system_state.update_meminfo(id, meminfo)
+        if changed:
+            self.system_state.do_balance()
+
+    def handle_shutdowns(self):
+        for shutdown in list(self.shutdowns):
+            time, id = shutdown
+            if time <= self.backend.clock:
+                self.shutdowns.remove(shutdown)
+                self.backend.destroy_domain(id)
+                self.system_state.del_domain(id)
+
+    def handle_request(self, request):
+        mem_rq = MemoryRequest(request.memory)
+        start = self.backend.clock
+        start_scans = self.backend.scans
+        start_cpu = time.time()
+        self.system_state.do_balloon_requests([mem_rq])
+        request.cpu_time = time.time() - start_cpu
+        request.scans = self.backend.scans - start_scans
+        request.latency = self.backend.clock - start
+        request.satisfied = mem_rq.result
+        if not mem_rq.result:
+            return
+        id = str(self.next_domid)
+        self.next_domid += 1
+        self.backend.create_domain(SimulatedDomain(id, request.memory,
+            static_max=request.static_max,
+            meminfo_trace=[(t + self.backend.clock, used) for t, used in
+                           (request.meminfo_trace or
+                            [(0, request.memory / 2)])]))
+        self.system_state.add_domain(id)
+        self.system_state.release_memory(mem_rq)
+        if request.lifetime is not None:
+            self.shutdowns.append((self.backend.clock + request.lifetime, id))
+
+    def run(self):
+        pending = list(self.requests)
+        while self.backend.clock < self.duration:
+            if self.initial_transferred is None and \
+                    self.backend.clock >= self.SETTLE_TIME:
+                self.initial_transferred = self.backend.transferred
+            self.handle_shutdowns()
+            self.handle_meminfo()
+            while pending and pending[0].time <= self.backend.clock:
+                self.handle_request(pending.pop(0))
+            self.backend.advance(self.TICK)
+        if self.initial_transferred is None:
+            self.initial_transferred = self.backend.transferred
+        return self
@@ -57,6 +57,7 @@ Requires:       qubes-core-dom0-doc
 Requires:       qubes-db-dom0
 Requires:       python-lxml
 Requires:       python-psutil
+Requires:       python-cryptography
 # TODO: R: qubes-gui-dom0 >= 2.1.11
 Conflicts:      qubes-gui-dom0 < 1.1.13
 Requires:       libvirt-python
@@ -199,6 +200,15 @@ fi
 %{python_sitearch}/qubes/backup.py
 %{python_sitearch}/qubes/backup.pyc
 %{python_sitearch}/qubes/backup.pyo
+%{python_sitearch}/qubes/backup_bench.py
+%{python_sitearch}/qubes/backup_bench.pyc
+%{python_sitearch}/qubes/backup_bench.pyo
+%{python_sitearch}/qubes/backup_compress.py
+%{python_sitearch}/qubes/backup_compress.pyc
+%{python_sitearch}/qubes/backup_compress.pyo
+%{python_sitearch}/qubes/dispvmstats.py
+%{python_sitearch}/qubes/dispvmstats.pyc
+%{python_sitearch}/qubes/dispvmstats.pyo
 %{python_sitearch}/qubes/storage/*.py
 %{python_sitearch}/qubes/storage/*.pyc
 %{python_sitearch}/qubes/storage/*.pyo
@@ -213,6 +223,7 @@ fi
 /usr/lib/qubes/cleanup-dispvms
 /usr/lib/qubes/qmemman_daemon.py*
 /usr/lib/qubes/qfile-daemon-dvm*
+/usr/lib/qubes/qubes-dispvm-savefile-watcher
 /usr/lib/qubes/block-cleaner-daemon.py*
 /usr/lib/qubes/vusb-ctl.py*
 /usr/lib/qubes/xl-qvm-usb-attach.py*
@@ -261,3 +272,4 @@ fi
 %attr(2770,root,qubes) %dir /var/log/qubes
 %attr(0770,root,qubes) %dir /var/run/qubes
 /etc/xdg/autostart/qubes-guid.desktop
+/etc/xdg/autostart/qubes-dispvm-savefile-watcher.desktop
@@ -768,6 +768,7 @@ def load_tests(loader, tests, pattern):
             'qubes.tests.block',
             'qubes.tests.hardware',
             'qubes.tests.extra',
+            'qubes.tests.qmemman',
             ):
         tests.addTests(loader.loadTestsFromName(modname))
     return tests
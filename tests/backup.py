@@ -27,8 +27,17 @@
 import os
 
 import unittest
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+from distutils import spawn
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
 from qubes.qubes import QubesException, QubesTemplateVm
+import qubes.backup
+import qubes.backup_compress
 import qubes.tests
 
 class TC_00_Backup(qubes.tests.BackupTestsMixin, qubes.tests.QubesTestCase):
@@ -117,6 +126,22 @@ class TC_00_Backup(qubes.tests.BackupTestsMixin, qubes.tests.QubesTestCase):
         self.restore_backup()
         self.remove_vms(vms)
 
+    def test_006_compressed_adaptive(self):
+        vms = self.create_backup_vms()
+        self.make_backup(vms, do_kwargs={'compressed': "xz:1",
+                                         'compression_adaptive': True})
+        self.remove_vms(vms)
+        self.restore_backup()
+        self.remove_vms(vms)
+
+    def test_007_parallel(self):
+        vms = self.create_backup_vms()
+        self.make_backup(vms, do_kwargs={'parallel': 3, 'encrypted': True,
+                                         'compressed': True})
+        self.remove_vms(vms)
+        self.restore_backup()
+        self.remove_vms(vms)
+
     def test_100_backup_dom0_no_restore(self):
         self.make_backup([self.qc[0]])
         # TODO: think of some safe way to test restore...
@@ -158,6 +183,615 @@ class TC_00_Backup(qubes.tests.BackupTestsMixin, qubes.tests.QubesTestCase):
 
         self.remove_vms(vms)
 
+class TC_01_BackupCrypto(qubes.tests.QubesTestCase):
+    def test_000_hmac_openssl_compatible(self):
+        data = os.urandom(1024*1024 + 13)
+        hmac = qubes.backup.BackupHmac('SHA512', 'qubes')
+        hmac.update(data[:1000])
+        hmac.update(data[1000:])
+        p = subprocess.Popen(['openssl', 'dgst', '-SHA512', '-hmac', 'qubes'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        (openssl_hmac, _) = p.communicate(data)
+        self.assertEquals(hmac.hexdigest(),
+                          qubes.backup.load_hmac(openssl_hmac))
+
+    def test_001_encrypt_openssl_compatible(self):
+        data = os.urandom(1024*1024 + 13)
+        for algorithm in ['aes-256-cbc', 'aes-128-ctr']:
+            encryptor = qubes.backup.BackupEncryptor.create(algorithm,
+                                                            'qubes')
+            if encryptor is None:
+                self.skipTest('In-process encryption not supported')
+            encrypted = encryptor.update(data[:1000]) + \
+                encryptor.update(data[1000:]) + encryptor.finalize()
+            p = subprocess.Popen(['openssl', 'enc', '-d', '-' + algorithm,
+                                  '-pass', 'pass:qubes'],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            (decrypted, _) = p.communicate(encrypted)
+            self.assertEquals(p.returncode, 0)
+            self.assertEquals(decrypted, data,
+                              'Decryption failed for {}'.format(algorithm))
+
+    def test_002_encrypt_unsupported_algorithm(self):
+        self.assertIsNone(qubes.backup.BackupEncryptor.create('des-ede3-cbc',
+                                                              'qubes'))
+
+
+class TC_02_BackupCompression(qubes.tests.QubesTestCase):
+    def test_000_parallel_compress(self):
+        data = (os.urandom(1024) + 'a' * 3072) * 3000
+        pool = ThreadPool(2)
+        try:
+            for compression_filter in ['gzip', 'bzip2']:
+                compressor = qubes.backup.ParallelCompressor(
+                    StringIO(data), compression_filter, pool, 2)
+                compressed = ''.join(iter(compressor.read, ''))
+                self.assertLess(len(compressed), len(data))
+                p = subprocess.Popen([compression_filter, '-d'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+                (decompressed, _) = p.communicate(compressed)
+                self.assertEquals(decompressed, data,
+                                  'Decompression failed for {}'.format(
+                                      compression_filter))
+        finally:
+            pool.terminate()
+
+    def test_010_parse_compression_filter(self):
+        parse = qubes.backup_compress.parse_compression_filter
+        self.assertEquals(parse('gzip'), ('gzip', None))
+        self.assertEquals(parse('zstd:19'), ('zstd', 19))
+        self.assertEquals(parse('pigz'), ('pigz', None))
+        for value in ['zstd:20', 'xz:fast', 'gzip:0', 'pigz:3']:
+            with self.assertRaises(ValueError):
+                parse(value)
+
+    def test_011_compression_command(self):
+        command = qubes.backup_compress.compression_command
+        self.assertEquals(command('gzip'), ['gzip'])
+        self.assertEquals(command('gzip', 1), ['gzip', '-1'])
+        self.assertEquals(command('zstd', 3, threads=2), ['zstd', '-3', '-T2'])
+        self.assertEquals(command('pigz'), ['pigz'])
+        # custom filter with options
+        self.assertEquals(command('pigz -9 --rsyncable'),
+                          ['pigz', '-9', '--rsyncable'])
+        self.assertEquals(command("sh -c 'gzip -1'"),
+                          ['sh', '-c', 'gzip -1'])
+        data = 'a' * 3072
+        p = subprocess.Popen(command('gzip -1'), stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE)
+        (compressed, _) = p.communicate(data)
+        self.assertEquals(p.returncode, 0)
+        p = subprocess.Popen(['gzip', '-d'], stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE)
+        (decompressed, _) = p.communicate(compressed)
+        self.assertEquals(decompressed, data)
+
+    def test_020_detect_decompress(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            data = os.path.join(tmpdir, 'data')
+            with open(data, 'w') as f:
+                f.write('a' * 3072)
+            tar = subprocess.check_output(['tar', '-cO', '-C', tmpdir,
+                                           'data'])
+            programs = [p for p in sorted(
+                qubes.backup_compress.COMPRESSION_PROGRAMS)
+                if spawn.find_executable(p)]
+            for program in [None] + programs:
+                if program is None:
+                    compressed = tar
+                else:
+                    p = subprocess.Popen(
+                        qubes.backup_compress.compression_command(program,
+                                                                   threads=1),
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                    (compressed, _) = p.communicate(tar)
+                self.assertEquals(
+                    qubes.backup_compress.detect_compression(
+                        compressed[:qubes.backup_compress.DETECT_SIZE]),
+                    program)
+                p = subprocess.Popen(
+                    [sys.executable, '-m', 'qubes.backup_compress', '-d'],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                (decompressed, _) = p.communicate(compressed)
+                self.assertEquals(p.returncode, 0)
+                self.assertEquals(decompressed, tar,
+                                  'Decompression failed for {}'.format(
+                                      program))
+            with self.assertRaises(ValueError):
+                qubes.backup_compress.detect_compression(os.urandom(512))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_030_is_compressible(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            random_file = os.path.join(tmpdir, 'random.img')
+            with open(random_file, 'w') as f:
+                f.write(os.urandom(4 * 1024 * 1024))
+            text_file = os.path.join(tmpdir, 'text.img')
+            with open(text_file, 'w') as f:
+                f.write('qubes backup ' * 400000)
+            self.assertFalse(qubes.backup.is_compressible(random_file))
+            self.assertTrue(qubes.backup.is_compressible(text_file))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TC_03_BackupDataPath(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_03_BackupDataPath, self).setUp()
+        self.data = os.urandom(3 * 1024 * 1024 + 13)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TC_03_BackupDataPath, self).tearDown()
+
+    def test_000_write_chunks(self):
+        filename = os.path.join(self.tmpdir, 'data')
+        with open(filename, 'w') as f:
+            f.write(self.data)
+        proc = subprocess.Popen(['cat', filename], stdout=subprocess.PIPE)
+        stream = qubes.backup.BackupStreamReader(proc.stdout)
+        chunks = []
+        run_error = "size_limit"
+        while run_error == "size_limit":
+            hmac = qubes.backup.BackupHmac('SHA512', 'qubes')
+            chunkfile = os.path.join(self.tmpdir, 'chunk.%03d' % len(chunks))
+            with open(chunkfile, 'w+b') as chunkfile_p:
+                run_error = qubes.backup.write_backup_chunk(
+                    progress_callback=lambda count, total: None,
+                    stream=stream, backup_target=chunkfile_p,
+                    total_backup_sz=len(self.data), hmac=hmac,
+                    size_limit=1024 * 1024, addproc=proc)
+            with open(chunkfile) as f:
+                chunk = f.read()
+            expected_hmac = qubes.backup.BackupHmac('SHA512', 'qubes')
+            expected_hmac.update(chunk)
+            self.assertEquals(hmac.hexdigest(), expected_hmac.hexdigest())
+            chunks.append(chunk)
+        proc.wait()
+        self.assertEquals(run_error, "")
+        self.assertEquals(len(chunks), 4)
+        self.assertEquals(''.join(chunks), self.data)
+
+    def test_001_send_to_process(self):
+        filename = os.path.join(self.tmpdir, 'chunk')
+        with open(filename, 'w') as f:
+            f.write(self.data)
+        proc = subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        output = []
+        reader = threading.Thread(target=lambda: output.append(
+            proc.stdout.read()))
+        reader.start()
+        with open(filename, 'rb') as in_stream:
+            run_error = qubes.backup.wait_backup_feedback(
+                progress_callback=lambda count, total: None,
+                in_stream=in_stream, streamproc=None,
+                backup_target=proc.stdin, total_backup_sz=len(self.data),
+                addproc=proc)
+        proc.stdin.close()
+        reader.join()
+        proc.wait()
+        self.assertEquals(run_error, "")
+        self.assertEquals(output[0], self.data)
+
+    def test_010_send_budget(self):
+        budget = qubes.backup.SendBudget(100)
+        budget.acquire(60)
+        # does not fit, until the first one is released
+        waiter = threading.Thread(target=budget.acquire, args=(60,))
+        waiter.start()
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+        budget.release(60)
+        waiter.join()
+        budget.release(60)
+        # larger than the limit, but nothing else in flight
+        budget.acquire(150)
+        # waiting stopped by the check
+        budget.acquire(10, lambda: False)
+        stats = budget.stats()
+        self.assertEquals(stats['send-stalls'], 2)
+        self.assertEquals(stats['inflight-peak'], 160)
+        self.assertGreater(stats['send-stall-time'], 0)
+
+    def test_011_send_budget_ahead(self):
+        # a chunk with its HMAC
+        chunk_size = qubes.backup.CHUNK_SIZE + \
+            qubes.backup.HMAC_FILE_MAX_SIZE
+        budget = qubes.backup.SendBudget(3 * chunk_size)
+        ahead = lambda: True
+        budget.acquire(chunk_size, ahead=ahead)
+        budget.acquire(chunk_size, ahead=ahead)
+        # no space left for a chunk of the file being sent
+        self.assertFalse(budget.fits(chunk_size, ahead))
+        self.assertTrue(budget.fits(chunk_size))
+        budget.acquire(chunk_size)
+        # data ahead does not use the "nothing in flight" exception
+        budget.release(3 * chunk_size)
+        self.assertFalse(budget.fits(3 * chunk_size, ahead))
+        self.assertTrue(budget.fits(3 * chunk_size))
+
+    def test_020_send_in_memory(self):
+        os.mkdir(os.path.join(self.tmpdir, 'vm1'))
+        with open(os.path.join(self.tmpdir, 'vm1', 'file.000.hmac'),
+                  'w') as f:
+            f.write('hmac')
+        output_path = os.path.join(self.tmpdir, 'output')
+        queue = qubes.backup.Queue()
+        budget = qubes.backup.SendBudget(len(self.data))
+        budget.acquire(len(self.data) + len('hmac'))
+        with open(output_path, 'w') as output:
+            queue.put(('vm1/file.000', self.data))
+            queue.put('vm1/file.000.hmac')
+            queue.put("FINISHED")
+            send_proc = qubes.backup.SendWorker(queue, self.tmpdir, output,
+                                                budget=budget)
+            send_proc.start()
+            send_proc.join()
+        self.assertEquals(send_proc.exitcode, 0)
+        self.assertEquals(budget.in_flight.value, 0)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir, 'vm1', 'file.000.hmac')))
+        # the way restore reads it
+        output = subprocess.check_output(['tar', '-ixOf', output_path])
+        self.assertEquals(output, self.data + 'hmac')
+
+
+class TC_04_BackupIncrement(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_04_BackupIncrement, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.block_size = qubes.backup.INCREMENT_BLOCK_SIZE
+        self.data = os.urandom(4 * self.block_size + 13)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TC_04_BackupIncrement, self).tearDown()
+
+    def write_file(self, path, data):
+        with open(path, 'w') as f:
+            f.write(data)
+
+    def test_000_manifest_save_load(self):
+        image = os.path.join(self.tmpdir, 'private.img')
+        self.write_file(image, self.data)
+        manifest = qubes.backup.create_image_manifest(image, 'id1')
+        self.assertEquals(manifest.size, len(self.data))
+        self.assertEquals(len(manifest.blocks), 5)
+        self.assertEquals(manifest.changed, [])
+        manifest.save(image + '.manifest')
+        loaded = qubes.backup.ImageManifest.load(image + '.manifest')
+        self.assertEquals(loaded.backup_id, 'id1')
+        self.assertEquals(loaded.size, manifest.size)
+        self.assertEquals(loaded.blocks, manifest.blocks)
+        loaded.verify(image)
+
+    def test_010_increment_apply(self):
+        base_dir = os.path.join(self.tmpdir, 'base')
+        new_dir = os.path.join(self.tmpdir, 'new')
+        os.mkdir(base_dir)
+        os.mkdir(new_dir)
+        image = os.path.join(base_dir, 'private.img')
+        self.write_file(image, self.data)
+        base_manifest = qubes.backup.create_image_manifest(image, 'id1')
+        base_manifest.save(image + '.manifest')
+        self.write_file(os.path.join(base_dir, 'firewall.xml'), 'old')
+
+        # change the second block and grow the image
+        changed_byte = chr(ord(self.data[self.block_size]) ^ 0xff)
+        new_data = (self.data[:self.block_size] + changed_byte +
+                    self.data[self.block_size + 1:] + 'tail')
+        new_image = os.path.join(self.tmpdir, 'private.img')
+        self.write_file(new_image, new_data)
+        increment = os.path.join(new_dir, 'private.img.increment')
+        manifest = qubes.backup.create_image_manifest(
+            new_image, 'id2', base_manifest, increment)
+        self.assertEquals(manifest.base_backup_id, 'id1')
+        self.assertEquals(manifest.changed, [1, 4])
+        self.assertEquals(os.path.getsize(increment),
+                          self.block_size + 13 + 4)
+        manifest.save(os.path.join(new_dir, 'private.img.manifest'))
+        self.write_file(os.path.join(new_dir, 'firewall.xml'), 'new')
+
+        qubes.backup.merge_backup_increment(new_dir, base_dir)
+        self.assertEquals(sorted(os.listdir(base_dir)),
+                          ['firewall.xml', 'private.img',
+                           'private.img.manifest'])
+        with open(os.path.join(base_dir, 'firewall.xml')) as f:
+            self.assertEquals(f.read(), 'new')
+        qubes.backup.verify_restored_images(base_dir)
+        self.assertEquals(sorted(os.listdir(base_dir)),
+                          ['firewall.xml', 'private.img'])
+        with open(image) as f:
+            self.assertEquals(f.read(), new_data)
+
+    def test_020_increment_wrong_base(self):
+        image = os.path.join(self.tmpdir, 'private.img')
+        self.write_file(image, self.data)
+        base_manifest = qubes.backup.create_image_manifest(image, 'id1')
+        base_manifest.save(image + '.manifest')
+        manifest = qubes.backup.create_image_manifest(image, 'id3')
+        manifest.base_backup_id = 'id2'
+        increment = os.path.join(self.tmpdir, 'increment')
+        self.write_file(increment, '')
+        with self.assertRaises(QubesException):
+            qubes.backup.apply_image_increment(image, increment, manifest)
+
+    def test_030_verify_corrupted(self):
+        image = os.path.join(self.tmpdir, 'private.img')
+        self.write_file(image, self.data)
+        manifest = qubes.backup.create_image_manifest(image, 'id1')
+        with open(image, 'r+') as f:
+            f.seek(3 * self.block_size)
+            f.write(chr(ord(self.data[3 * self.block_size]) ^ 0xff))
+        with self.assertRaises(QubesException):
+            manifest.verify(image)
+
+    def test_040_sparse_image(self):
+        sparse = os.path.join(self.tmpdir, 'sparse.img')
+        with open(sparse, 'w') as f:
+            f.write(self.data[:1000])
+            f.seek(2 * self.block_size + 100)
+            f.write(self.data[:10])
+            f.truncate(6 * self.block_size + 7)
+        with open(sparse) as f:
+            content = f.read()
+        dense = os.path.join(self.tmpdir, 'dense.img')
+        self.write_file(dense, content)
+        manifest = qubes.backup.create_image_manifest(sparse, 'id1')
+        self.assertEquals(manifest.size, len(content))
+        self.assertEquals(manifest.blocks,
+                          qubes.backup.create_image_manifest(
+                              dense, 'id1').blocks)
+        manifest.verify(sparse)
+        manifest.verify(dense)
+
+
+class TC_05_BackupDedup(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_05_BackupDedup, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = os.urandom(4 * 1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TC_05_BackupDedup, self).tearDown()
+
+    def write_file(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def test_000_chunks_shifted(self):
+        path1 = self.write_file('image1', self.data)
+        # the same data, moved by a few filesystem blocks
+        path2 = self.write_file('image2', os.urandom(3 * 4096) + self.data)
+        chunks1 = list(qubes.backup.dedup_chunks(path1))
+        chunks2 = list(qubes.backup.dedup_chunks(path2))
+        self.assertEquals(sum(length for (_, length, _) in chunks1),
+                          len(self.data))
+        for (_, length, _) in chunks1[:-1]:
+            self.assertGreaterEqual(length,
+                                    qubes.backup.DEDUP_MIN_CHUNK_SIZE)
+            self.assertLessEqual(length, qubes.backup.DEDUP_MAX_CHUNK_SIZE)
+        digests1 = set(digest for (_, _, digest) in chunks1)
+        digests2 = set(digest for (_, _, digest) in chunks2)
+        # all but the first few chunks should be found again
+        self.assertGreaterEqual(len(digests1 & digests2), len(digests1) - 3)
+
+    def test_010_pack_restore(self):
+        image = self.write_file('image', self.data + '\0' * 1024 * 1024)
+        chunks = list(qubes.backup.dedup_chunks(image))
+        recipe = qubes.backup.DedupRecipe(len(self.data) + 1024 * 1024)
+        pack_chunks = []
+        pack_offset = 0
+        for (offset, length, digest) in chunks:
+            recipe.chunks.append((digest, length, 'dedup/image-0000.pack',
+                                  pack_offset))
+            pack_chunks.append((offset, length))
+            pack_offset += length
+        recipe.save(os.path.join(self.tmpdir, 'image.dedup'))
+
+        pipe = os.path.join(self.tmpdir, 'pipe')
+        os.mkfifo(pipe)
+        writer = qubes.backup.DedupPackWriter(pipe, 'dedup/image-0000.pack',
+                                              image, pack_chunks)
+        writer.start()
+        archive = os.path.join(self.tmpdir, 'archive.tar')
+        with open(pipe, 'rb') as in_stream:
+            with open(archive, 'wb') as out_stream:
+                shutil.copyfileobj(in_stream, out_stream)
+        self.assertEquals(writer.wait(), 0)
+        restore_dir = os.path.join(self.tmpdir, 'restore')
+        os.mkdir(restore_dir)
+        subprocess.check_call(['tar', '-xf', archive, '-C', restore_dir])
+
+        recipe = qubes.backup.DedupRecipe.load(
+            os.path.join(self.tmpdir, 'image.dedup'))
+        restored = os.path.join(self.tmpdir, 'restored')
+        recipe.restore(restored, restore_dir)
+        with open(restored) as f:
+            self.assertEquals(f.read(), self.data + '\0' * 1024 * 1024)
+
+        with open(os.path.join(restore_dir, 'dedup/image-0000.pack'),
+                  'r+') as f:
+            f.seek(100)
+            f.write(chr(ord(self.data[100]) ^ 0xff))
+        with self.assertRaises(QubesException):
+            recipe.restore(restored, restore_dir)
+
+    def test_020_chunks_sparse(self):
+        sparse = os.path.join(self.tmpdir, 'sparse')
+        with open(sparse, 'w') as f:
+            f.write(self.data[:100000])
+            f.seek(5 * 1024 * 1024 + 3)
+            f.write(self.data[:200000])
+            f.truncate(9 * 1024 * 1024 + 7)
+        with open(sparse) as f:
+            dense = self.write_file('dense', f.read())
+        self.assertEquals(list(qubes.backup.dedup_chunks(sparse)),
+                          list(qubes.backup.dedup_chunks(dense)))
+
+    def test_030_stage_dedup_shared(self):
+        image1 = self.write_file('image1', self.data)
+        image2 = self.write_file('image2', self.data)
+        staging_dir = os.path.join(self.tmpdir, 'staging')
+        dedup_index = {}
+        stats = {}
+        (files, duplicated) = qubes.backup.stage_dedup_file(
+            {'path': image1, 'size': len(self.data), 'subdir': 'vm1/'},
+            staging_dir, dedup_index, stats)
+        self.assertEquals(duplicated, 0)
+        self.assertEquals([f['path'] for f in files],
+                          ['image-0000.pack',
+                           os.path.join(staging_dir, 'image1.dedup')])
+        self.assertEquals(files[0]['dedup_source'], image1)
+        self.assertEquals(files[0]['dedup_chunks'], [(0, len(self.data))])
+
+        # all the chunks already in the pack of the first image
+        (files, duplicated) = qubes.backup.stage_dedup_file(
+            {'path': image2, 'size': len(self.data), 'subdir': 'vm2/'},
+            staging_dir, dedup_index, stats)
+        self.assertEquals(duplicated, len(self.data))
+        self.assertEquals([f['path'] for f in files],
+                          [os.path.join(staging_dir, 'image2.dedup')])
+        recipe = qubes.backup.DedupRecipe.load(files[0]['path'])
+        self.assertEquals(set(pack for (_, _, pack, _) in recipe.chunks),
+                          set([qubes.backup.DEDUP_DIR +
+                               '/image-0000.pack']))
+        self.assertEquals(stats['dedup-images'], 2)
+        self.assertEquals(stats['dedup-input-size'], 2 * len(self.data))
+        self.assertEquals(stats['dedup-stored-size'], len(self.data))
+
+
+class TC_06_BackupResume(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_06_BackupResume, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmpdir, 'qubes-backup')
+        self.journal = qubes.backup.BackupJournal.create(
+            self.target + qubes.backup.BACKUP_JOURNAL_SUFFIX)
+        self.files_dir = os.path.join(self.tmpdir, 'files')
+        os.makedirs(os.path.join(self.files_dir, 'vm1'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TC_06_BackupResume, self).tearDown()
+
+    def append_file(self, name, data, passphrase='qubes'):
+        """Write the file with its HMAC to the backup, as SendWorker does"""
+        path = os.path.join(self.files_dir, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        hmac = qubes.backup.BackupHmac('SHA512', passphrase)
+        hmac.update(data)
+        hmac.write(path + '.hmac')
+        for member in [name, name + '.hmac']:
+            with open(self.target, 'a') as f:
+                subprocess.check_call(['tar', '-cO', '--posix', '-C',
+                                       self.files_dir, member], stdout=f)
+            self.journal.record(member, os.path.getsize(self.target))
+
+    def test_000_resume_prepare(self):
+        self.append_file('backup-header', 'version=3\nhmac-algorithm=SHA512\n')
+        self.append_file('vm1/private.img.000', os.urandom(100000))
+        chunk1_start = os.path.getsize(self.target)
+        self.append_file('vm1/private.img.001', os.urandom(100000))
+        # interrupted while writing the next chunk
+        with open(self.target, 'a') as f:
+            f.write('\0' * 5000)
+        self.journal.record('vm1/private.img.002', 9999999)
+
+        (journal, header, chunks) = qubes.backup.backup_resume_prepare(
+            self.target, 'qubes')
+        self.assertEquals(header['hmac-algorithm'], 'SHA512')
+        self.assertEquals([name for (name, _, _, _) in chunks],
+                          ['backup-header', 'vm1/private.img.000',
+                           'vm1/private.img.001'])
+        self.assertEquals(chunks[2][1], chunk1_start)
+        self.assertEquals(len(journal.entries), 6)
+        self.assertEquals(journal.entries[-1][1],
+                          os.path.getsize(self.target) - 5000)
+
+        # damaged data of the second chunk
+        with open(self.target, 'r+') as f:
+            f.seek(chunks[2][2] + 100)
+            f.write('damaged')
+        (journal, header, chunks) = qubes.backup.backup_resume_prepare(
+            self.target, 'qubes')
+        self.assertEquals(len(chunks), 2)
+        self.assertEquals(journal.entries[-1][1], chunk1_start)
+        self.assertEquals(len(qubes.backup.BackupJournal.load(
+            self.target + qubes.backup.BACKUP_JOURNAL_SUFFIX).entries), 4)
+
+    def test_010_resume_wrong_passphrase(self):
+        self.append_file('backup-header', 'version=3\nhmac-algorithm=SHA512\n',
+                         passphrase='other')
+        with self.assertRaises(QubesException):
+            qubes.backup.backup_resume_prepare(self.target, 'qubes')
+
+    def test_020_resumed_chunks(self):
+        self.append_file('backup-header', 'version=3\nhmac-algorithm=SHA512\n')
+        self.append_file('vm1/private.img.000', os.urandom(100000))
+        chunk1_start = os.path.getsize(self.target)
+        self.append_file('vm1/private.img.001', os.urandom(100000))
+        (journal, _, chunks) = qubes.backup.backup_resume_prepare(
+            self.target, 'qubes')
+        resumed = qubes.backup.ResumedBackup(open(self.target, 'r+b'),
+                                             journal, chunks)
+        self.assertTrue(resumed.chunk_in_backup('backup-header',
+                                                chunks[0][3]))
+        self.assertTrue(resumed.chunk_in_backup('vm1/private.img.000',
+                                                chunks[1][3]))
+        # the data has changed since the backup was interrupted
+        self.assertFalse(resumed.chunk_in_backup('vm1/private.img.001',
+                                                 'other digest'))
+        self.assertFalse(resumed.chunk_in_backup('vm1/private.img.001',
+                                                 chunks[2][3]))
+        resumed.backup_file.close()
+        self.assertEquals(os.path.getsize(self.target), chunk1_start)
+        self.assertEquals(journal.entries[-1][1], chunk1_start)
+
+    def test_030_resumed_file(self):
+        path = os.path.join(self.tmpdir, 'qubes.xml')
+        with open(path, 'w') as f:
+            f.write('<xml/>')
+        file_stat = os.stat(path)
+        self.append_file('backup-header', 'version=3\nhmac-algorithm=SHA512\n')
+        self.append_file('qubes.xml.000', '<xml/>')
+        self.journal.record_file(path, file_stat.st_size, file_stat.st_mtime,
+                                 os.path.getsize(self.target))
+        self.append_file('vm1/private.img.000', os.urandom(100000))
+        (journal, _, chunks) = qubes.backup.backup_resume_prepare(
+            self.target, 'qubes')
+        self.assertEquals(journal.files[path][:2],
+                          (file_stat.st_size, file_stat.st_mtime))
+
+        resumed = qubes.backup.ResumedBackup(None, journal, chunks)
+        self.assertTrue(resumed.chunk_in_backup('backup-header',
+                                                chunks[0][3]))
+        # the file has changed since
+        os.utime(path, (0, 0))
+        self.assertFalse(resumed.skip_file('qubes.xml', path, os.stat(path)))
+        self.assertTrue(resumed.skip_file('qubes.xml', path, file_stat))
+        self.assertEquals([name for (name, _, _, _) in resumed.chunks],
+                          ['vm1/private.img.000'])
+
+        # the file record is removed with its chunk
+        with open(self.target, 'r+') as f:
+            f.seek(chunks[1][2])
+            f.write('damaged')
+        (journal, _, chunks) = qubes.backup.backup_resume_prepare(
+            self.target, 'qubes')
+        self.assertEquals(journal.files, {})
+
+
 class TC_10_BackupVMMixin(qubes.tests.BackupTestsMixin):
     def setUp(self):
         super(TC_10_BackupVMMixin, self).setUp()
@@ -0,0 +1,953 @@
+#!/usr/bin/python2 -O
+# coding=utf-8
+
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import json
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+
+import qubes.qmemman
+import qubes.qmemman_algo
+import qubes.qmemman_bench
+import qubes.qmemman_client
+import qubes.qmemman_server
+import qubes.qmemman_sim
+import qubes.tests
+
+MB = 1024*1024
+
+
+class FakeDomainState(object):
+    def __init__(self, id):
+        self.id = id
+        self.meminfo = None
+        self.memory_current = 0
+        self.memory_actual = None
+        self.memory_maximum = None
+        self.mem_used = None
+        self.last_target = 0
+        self.no_progress = False
+        self.slow_memset_react = False
+        self.weight = qubes.qmemman_algo.DEFAULT_WEIGHT
+        self.mem_min = 0
+        self.tier = qubes.qmemman_algo.DEFAULT_TIER
+
+    def __repr__(self):
+        return self.__dict__.__repr__()
+
+
+class RecordingSimulatorBackend(qubes.qmemman_sim.SimulatorBackend):
+    """Simulated hypervisor recording how long qmemman waited for events"""
+    def __init__(self, *args, **kwargs):
+        super(RecordingSimulatorBackend, self).__init__(*args, **kwargs)
+        self.waits = []
+
+    def wait_for_memory_change(self, timeout):
+        self.waits.append(timeout)
+        return super(RecordingSimulatorBackend, self).wait_for_memory_change(
+            timeout)
+
+
+# Reference implementation of the balancing algorithm, working directly on the
+# domain dictionary and distributing memory left over static max in rounds.
+# The optimized one in qmemman_algo must give exactly the same results. To
+# allow comparing results regardless of dict ordering, reference_balance
+# returns (donors_rq, acceptors_rq) tuple instead of a concatenated list.
+
+def reference_balloon(memsize, domain_dictionary):
+    prefmem = qubes.qmemman_algo.prefmem
+    memory_needed = qubes.qmemman_algo.memory_needed
+    REQ_SAFETY_NET_FACTOR = 1.05
+    donors = list()
+    request = list()
+    available = 0
+    for i in domain_dictionary.keys():
+        if domain_dictionary[i].meminfo is None:
+            continue
+        if domain_dictionary[i].no_progress:
+            continue
+        need = memory_needed(domain_dictionary[i])
+        if need < 0:
+            donors.append((i,-need))
+            available-=need
+    if available<memsize:
+        return ()
+    scale = 1.0*memsize/available
+    for donors_iter in donors:
+        id, mem = donors_iter
+        memborrowed = mem*scale*REQ_SAFETY_NET_FACTOR
+        memtarget = int(domain_dictionary[id].memory_actual - memborrowed)
+        request.append((id, memtarget))
+    return request
+
+
+def reference_balance_when_enough_memory(domain_dictionary,
+        xen_free_memory, total_mem_pref, total_available_memory):
+    prefmem = qubes.qmemman_algo.prefmem
+    target_memory = {}
+    left_memory = 0
+    acceptors_count = 0
+    for i in domain_dictionary.keys():
+        if domain_dictionary[i].meminfo is None:
+            continue
+        if domain_dictionary[i].no_progress:
+            continue
+        scale = 1.0*prefmem(domain_dictionary[i])/total_mem_pref
+        target_nonint = prefmem(domain_dictionary[i]) + scale*total_available_memory
+        target = int(0.999*target_nonint)
+        if target > domain_dictionary[i].memory_maximum:
+            left_memory += target-domain_dictionary[i].memory_maximum
+            target = domain_dictionary[i].memory_maximum
+        else:
+            acceptors_count += 1
+        target_memory[i] = target
+    while left_memory > 0 and acceptors_count > 0:
+        new_left_memory = 0
+        new_acceptors_count = acceptors_count
+        for i in target_memory.keys():
+            target = target_memory[i]
+            if target < domain_dictionary[i].memory_maximum:
+                memory_bonus = int(0.999*(left_memory/acceptors_count))
+                if target+memory_bonus >= domain_dictionary[i].memory_maximum:
+                    new_left_memory += target+memory_bonus - domain_dictionary[i].memory_maximum
+                    target = domain_dictionary[i].memory_maximum
+                    new_acceptors_count -= 1
+                else:
+                    target += memory_bonus
+            target_memory[i] = target
+        left_memory = new_left_memory
+        acceptors_count = new_acceptors_count
+    donors_rq = list()
+    acceptors_rq = list()
+    for i in target_memory.keys():
+        target = target_memory[i]
+        if (target < domain_dictionary[i].memory_actual):
+            donors_rq.append((i, target))
+        else:
+            acceptors_rq.append((i, target))
+    return donors_rq, acceptors_rq
+
+
+def reference_balance_when_low_on_memory(domain_dictionary,
+        xen_free_memory, total_mem_pref_acceptors, donors, acceptors):
+    prefmem = qubes.qmemman_algo.prefmem
+    memory_needed = qubes.qmemman_algo.memory_needed
+    donors_rq = list()
+    acceptors_rq = list()
+    squeezed_mem = xen_free_memory
+    for i in donors:
+        avail = -memory_needed(domain_dictionary[i])
+        if avail < 10*1024*1024:
+            continue
+        squeezed_mem -= avail
+        donors_rq.append((i, prefmem(domain_dictionary[i])))
+    if squeezed_mem < 0:
+        return donors_rq, []
+    for i in acceptors:
+        scale = 1.0*prefmem(domain_dictionary[i])/total_mem_pref_acceptors
+        target_nonint = domain_dictionary[i].memory_actual + scale*squeezed_mem
+        target = min(int(0.999*target_nonint), domain_dictionary[i].memory_maximum)
+        acceptors_rq.append((i, target))
+    return donors_rq, acceptors_rq
+
+
+def reference_balance(xen_free_memory, domain_dictionary):
+    prefmem = qubes.qmemman_algo.prefmem
+    memory_needed = qubes.qmemman_algo.memory_needed
+    total_memory_needed = 0
+    total_mem_pref = 0
+    total_mem_pref_acceptors = 0
+    donors = list()
+    acceptors = list()
+    for i in domain_dictionary.keys():
+        if domain_dictionary[i].meminfo is None:
+            continue
+        if domain_dictionary[i].no_progress:
+            continue
+        need = memory_needed(domain_dictionary[i])
+        if need < 0 or domain_dictionary[i].memory_actual >= domain_dictionary[i].memory_maximum:
+            donors.append(i)
+        else:
+            acceptors.append(i)
+            total_mem_pref_acceptors += prefmem(domain_dictionary[i])
+        total_memory_needed += need
+        total_mem_pref += prefmem(domain_dictionary[i])
+    total_available_memory = xen_free_memory - total_memory_needed
+    if total_available_memory > 0:
+        return reference_balance_when_enough_memory(domain_dictionary,
+            xen_free_memory, total_mem_pref, total_available_memory)
+    else:
+        return reference_balance_when_low_on_memory(domain_dictionary,
+            xen_free_memory, total_mem_pref_acceptors, donors, acceptors)
+
+
+class TC_00_QmemmanAlgo(qubes.tests.QubesTestCase):
+    #: number of random systems checked by each equivalence test
+    ITERATIONS = 2000
+
+    def setUp(self):
+        super(TC_00_QmemmanAlgo, self).setUp()
+        # make failures reproducible
+        self.random = random.Random(self._testMethodName)
+
+    def random_domain(self, id):
+        dom = FakeDomainState(str(id))
+        rnd = self.random
+        dom.memory_maximum = rnd.choice([400, 1000, 2000, 4000, 8000,
+                                         rnd.randint(300, 16000)]) * MB
+        dom.memory_current = rnd.randint(150, dom.memory_maximum / MB) * MB
+        dom.last_target = rnd.choice([0, dom.memory_current,
+            rnd.randint(150, dom.memory_maximum / MB) * MB])
+        dom.memory_actual = max(dom.memory_current, dom.last_target)
+        if rnd.random() < 0.1:
+            # domain without (valid) meminfo
+            return dom
+        dom.meminfo = {}
+        dom.mem_used = rnd.randint(50, dom.memory_actual / MB) * MB + \
+            rnd.randint(0, MB)
+        if rnd.random() < 0.05:
+            dom.no_progress = True
+        return dom
+
+    def random_system(self):
+        domains = [self.random_domain(0)]
+        domains += [self.random_domain(i)
+                    for i in self.random.sample(xrange(1, 1000),
+                                                self.random.randint(0, 60))]
+        domdict = {}
+        for dom in domains:
+            domdict[dom.id] = dom
+        return domdict
+
+    def random_xenfree(self):
+        return self.random.choice([
+            self.random.randint(-100, 100) * MB,
+            self.random.randint(0, 2000) * MB,
+            self.random.randint(0, 32000) * MB,
+        ])
+
+    def assertRequestsEqual(self, result, expected):
+        # requests for domains giving back memory must precede the others;
+        # order within each group does not matter
+        donors_rq, acceptors_rq = expected
+        self.assertEqual(sorted(result[:len(donors_rq)]), sorted(donors_rq))
+        self.assertEqual(sorted(result[len(donors_rq):]), sorted(acceptors_rq))
+
+    def test_000_balance_equivalence(self):
+        for _ in xrange(self.ITERATIONS):
+            domdict = self.random_system()
+            xenfree = self.random_xenfree()
+            self.assertRequestsEqual(
+                qubes.qmemman_algo.balance(xenfree, domdict),
+                reference_balance(xenfree, domdict))
+
+    def test_001_balance_static_max_equivalence(self):
+        # most domains hitting static max - many redistribution rounds
+        for _ in xrange(self.ITERATIONS):
+            domdict = self.random_system()
+            for dom in domdict.values():
+                if self.random.random() < 0.7:
+                    dom.memory_maximum = dom.memory_actual + \
+                        self.random.randint(0, 300) * MB
+            xenfree = self.random.randint(1000, 64000) * MB
+            self.assertRequestsEqual(
+                qubes.qmemman_algo.balance(xenfree, domdict),
+                reference_balance(xenfree, domdict))
+
+    def test_002_balloon_equivalence(self):
+        for _ in xrange(self.ITERATIONS):
+            domdict = self.random_system()
+            memsize = self.random.randint(0, 8000) * MB
+            self.assertEqual(
+                list(qubes.qmemman_algo.balloon(memsize, domdict)),
+                list(reference_balloon(memsize, domdict)))
+
+    def test_010_balance_static_max(self):
+        domdict = {}
+        for id, actual, maximum in (('0', 1000, 4000), ('1', 400, 400),
+                                    ('2', 400, 500), ('3', 400, 8000)):
+            dom = FakeDomainState(id)
+            dom.meminfo = {}
+            dom.mem_used = 200*MB
+            dom.memory_actual = dom.memory_current = actual*MB
+            dom.memory_maximum = maximum*MB
+            domdict[id] = dom
+        requests = dict(qubes.qmemman_algo.balance(2000*MB, domdict))
+        self.assertEqual(requests['1'], 400*MB)
+        self.assertEqual(requests['2'], 500*MB)
+        self.assertLess(requests['0'], 4000*MB)
+        self.assertLess(requests['3'], 8000*MB)
+        self.assertLessEqual(sum(requests.values()),
+            2000*MB + sum(dom.memory_actual for dom in domdict.values()))
+
+    def qos_system(self, *domains):
+        domdict = {}
+        for id, actual, used, maximum in domains:
+            dom = FakeDomainState(id)
+            dom.meminfo = {}
+            dom.mem_used = used*MB
+            dom.memory_actual = dom.memory_current = actual*MB
+            dom.memory_maximum = maximum*MB
+            domdict[id] = dom
+        return domdict
+
+    def test_020_balance_weight(self):
+        domdict = self.qos_system(('1', 400, 200, 8000), ('2', 400, 200, 8000))
+        domdict['2'].weight = 300
+        requests = dict(qubes.qmemman_algo.balance(4000*MB, domdict))
+        # the same preferred memory, 3 times more of the free memory
+        pref = qubes.qmemman_algo.prefmem(domdict['1'])
+        self.assertAlmostEqual(
+            float(requests['2'] - pref) / (requests['1'] - pref), 3, places=2)
+
+    def test_021_balance_min(self):
+        domdict = self.qos_system(('1', 2000, 200, 8000),
+                                  ('2', 2000, 200, 8000),
+                                  ('3', 400, 3000, 8000))
+        domdict['1'].mem_min = 1500*MB
+        requests = dict(qubes.qmemman_algo.balance(0, domdict))
+        # low on memory - domain 2 is squeezed to its prefmem, domain 1
+        # only to the guaranteed memory
+        self.assertEqual(requests['1'], 1500*MB)
+        self.assertEqual(requests['2'],
+            qubes.qmemman_algo.prefmem(domdict['2']))
+
+    def test_022_balance_tiers(self):
+        domdict = self.qos_system(('2', 1000, 1500, 8000),
+                                  ('3', 1000, 1500, 8000))
+        domdict['2'].tier = 2
+        requests = dict(qubes.qmemman_algo.balance(1000*MB, domdict))
+        pref2 = qubes.qmemman_algo.prefmem(domdict['2'])
+        # higher tier gets all it needs, the rest goes to the lower one
+        self.assertEqual(requests['2'], pref2)
+        self.assertLess(requests['3'], pref2)
+        self.assertGreater(requests['3'], 1000*MB)
+        # without tiers, both get the same
+        domdict['2'].tier = qubes.qmemman_algo.DEFAULT_TIER
+        requests = dict(qubes.qmemman_algo.balance(1000*MB, domdict))
+        self.assertEqual(requests['2'], requests['3'])
+
+    def test_023_balance_weight_zero(self):
+        domdict = self.qos_system(('1', 400, 200, 8000))
+        domdict['1'].weight = 0
+        # all the domains with weight 0 - the memory is distributed as if
+        # they had the same weight
+        requests = dict(qubes.qmemman_algo.balance(4000*MB, domdict))
+        self.assertGreater(requests['1'], 4000*MB)
+        domdict = self.qos_system(('1', 1000, 1500, 8000),
+                                  ('2', 1000, 1500, 8000))
+        domdict['1'].weight = domdict['2'].weight = 0
+        requests = dict(qubes.qmemman_algo.balance(1000*MB, domdict))
+        self.assertGreater(requests['1'], 1000*MB)
+        self.assertEqual(requests['1'], requests['2'])
+        # weight 0 next to other weights - no share of the free memory
+        domdict = self.qos_system(('1', 400, 200, 8000),
+                                  ('2', 400, 200, 8000))
+        domdict['1'].weight = 0
+        requests = dict(qubes.qmemman_algo.balance(4000*MB, domdict))
+        self.assertEqual(requests['1'],
+            int(0.999*qubes.qmemman_algo.prefmem(domdict['1'])))
+        self.assertGreater(requests['2'], 4000*MB)
+
+
+class TC_10_QmemmanSimulation(qubes.tests.QubesTestCase):
+    def simulation(self, domains, requests=(), duration=30):
+        return qubes.qmemman_sim.Simulation(16*1024*MB,
+            [qubes.qmemman_sim.SimulatedDomain(id, memory,
+                static_max=static_max, balloon_rate=rate,
+                meminfo_trace=[(0, used)])
+             for id, memory, static_max, used, rate in domains],
+            requests, duration)
+
+    def test_000_balance_stable(self):
+        sim = self.simulation([
+            ('0', 4000*MB, None, 1000*MB, 1000*MB),
+            ('1', 2000*MB, 4000*MB, 400*MB, 1000*MB),
+            ('2', 2000*MB, 4000*MB, 800*MB, 1000*MB),
+        ]).run()
+        # all the free memory distributed once, without further changes
+        self.assertLess(sim.backend.free_memory(), 200*MB)
+        self.assertEqual(sim.backend.oscillations(), 0)
+        self.assertEqual(sim.backend.errors, [])
+
+    def test_001_request(self):
+        sim = self.simulation([
+            ('0', 4000*MB, None, 1000*MB, 1000*MB),
+            ('1', 6000*MB, 8000*MB, 400*MB, 1000*MB),
+            ('2', 6000*MB, 8000*MB, 800*MB, 1000*MB),
+        ], [qubes.qmemman_sim.SimulatedRequest(5, 4000*MB,
+                                               static_max=4000*MB)]).run()
+        rq = sim.requests[0]
+        self.assertTrue(rq.satisfied)
+        self.assertLess(rq.latency, 3)
+        self.assertIn('3', sim.system_state.domdict)
+        self.assertEqual(sim.system_state.reserved_memory, 0)
+        self.assertGreater(sim.backend.min_free, 0)
+
+    def test_002_request_too_big(self):
+        sim = self.simulation([
+            ('0', 4000*MB, None, 1000*MB, 1000*MB),
+            ('1', 6000*MB, 8000*MB, 4000*MB, 1000*MB),
+        ], [qubes.qmemman_sim.SimulatedRequest(5, 12000*MB,
+                                               static_max=12000*MB)]).run()
+        self.assertFalse(sim.requests[0].satisfied)
+        self.assertNotIn('2', sim.system_state.domdict)
+
+    def test_003_stuck_donor(self):
+        sim = self.simulation([
+            ('0', 4000*MB, None, 1000*MB, 1000*MB),
+            ('1', 6000*MB, 8000*MB, 400*MB, 1000*MB),
+            ('2', 6000*MB, 8000*MB, 400*MB, 0),
+        ], [qubes.qmemman_sim.SimulatedRequest(5, 4000*MB,
+                                               static_max=4000*MB)]).run()
+        self.assertTrue(sim.requests[0].satisfied)
+        self.assertTrue(sim.system_state.domdict['2'].no_progress)
+        self.assertIn(('dom2', qubes.qmemman.no_progress_msg),
+                      sim.backend.errors)
+
+    def test_004_fast_admission(self):
+        sim = self.simulation([
+            ('0', 4000*MB, 4000*MB, 1000*MB, 1000*MB),
+            ('1', 2000*MB, 2000*MB, 400*MB, 1000*MB),
+        ], [qubes.qmemman_sim.SimulatedRequest(5, 2000*MB,
+                                               static_max=2000*MB)]).run()
+        rq = sim.requests[0]
+        self.assertTrue(rq.satisfied)
+        # enough free memory - no need to look at other domains
+        self.assertEqual(rq.scans, 0)
+        self.assertEqual(sim.system_state.requests_fast, 1)
+
+    def test_010_bench_percentile(self):
+        percentile = qubes.qmemman_bench.percentile
+        self.assertEqual(percentile([], 99), 0)
+        self.assertEqual(percentile([3, 1, 2], 99), 3)
+        self.assertEqual(percentile([4, 2, 1, 3], 50), 2)
+        self.assertEqual(percentile(range(1, 101), 99), 99)
+
+    def test_011_bench_idle(self):
+        result = qubes.qmemman_bench.run_scenario('idle')
+        # memory moved only by the initial balance
+        self.assertGreater(result['transferred_initial'], 0)
+        self.assertEqual(result['transferred'], 0)
+        self.assertEqual(result['errors'], 0)
+
+
+class TC_11_QmemmanSystemState(qubes.tests.QubesTestCase):
+    def system_state(self, domains, total_memory=8000*MB):
+        backend = RecordingSimulatorBackend(total_memory,
+            [qubes.qmemman_sim.SimulatedDomain(id, memory,
+                static_max=static_max, balloon_rate=rate,
+                meminfo_trace=[(0, used)])
+             for id, memory, static_max, used, rate in domains])
+        state = qubes.qmemman.SystemState(backend)
+        for dom in domains:
+            state.add_domain(dom[0])
+        for id, meminfo in backend.changed_meminfo():
+            state.update_meminfo(id, meminfo)
+        state.refresh_memactual()
+        return state
+
+    def test_000_balloon_wait_backoff(self):
+        state = self.system_state([
+            ('0', 4000*MB, None, 3100*MB, 1000*MB),
+            ('1', 3500*MB, 4000*MB, 400*MB, 0),
+        ])
+        state.BALOON_DELAY = 0.5
+        request = qubes.qmemman.MemoryRequest(1500*MB)
+        state.do_balloon_requests([request])
+        self.assertFalse(request.result)
+        self.assertEqual(request.reason,
+                         qubes.qmemman_client.REASON_BALLOON_FAILED)
+        # no memory released - the delay doubles, but the domains are
+        # checked again before the next memset, BALOON_DELAY after the
+        # first one
+        self.assertEqual([round(t, 6) for t in state.backend.waits],
+                         [0.02, 0.04, 0.08, 0.16, 0.2])
+
+    def test_001_balloon_wait_progress(self):
+        state = self.system_state([
+            ('0', 4000*MB, None, 3100*MB, 1000*MB),
+            ('1', 3500*MB, 4000*MB, 400*MB, 500*MB),
+        ])
+        state.BALOON_DELAY = 0.5
+        request = qubes.qmemman.MemoryRequest(1500*MB)
+        state.do_balloon_requests([request])
+        self.assertTrue(request.result)
+        # the donor keeps releasing memory - checked again as soon as
+        # possible
+        self.assertEqual(set(round(t, 6) for t in state.backend.waits[1:]),
+                         set([state.BALOON_MIN_DELAY]))
+
+    def test_010_reservation(self):
+        domains = [
+            ('0', 4000*MB, None, 1000*MB, 1000*MB),
+            ('1', 2000*MB, 4000*MB, 400*MB, 1000*MB),
+        ]
+        # without a reservation, the free memory is given to the domains
+        state = self.system_state(domains)
+        state.do_balance()
+        state.backend.advance(5)
+        self.assertLess(state.backend.free_memory(), 1000*MB)
+
+        state = self.system_state(domains)
+        request = qubes.qmemman.MemoryRequest(1000*MB)
+        state.do_balloon_requests([request])
+        self.assertTrue(request.result)
+        self.assertEqual(state.requests_fast, 1)
+        self.assertEqual(state.reserved_memory, 1000*MB)
+        # the reserved memory is not redistributed
+        state.do_balance()
+        state.backend.advance(5)
+        self.assertGreaterEqual(state.backend.free_memory(), 1000*MB)
+        # ... nor given to another request
+        state.refresh_memactual()
+        request2 = qubes.qmemman.MemoryRequest(
+            state.get_free_xen_memory() + 1000*MB - state.XEN_FREE_MEM_LEFT)
+        state.do_balloon_requests([request2])
+        self.assertTrue(request2.result)
+        self.assertEqual(state.requests_fast, 1)
+        self.assertEqual(state.balloon_count, 1)
+        self.assertEqual(state.reserved_memory, 1000*MB + request2.amount)
+
+        state.release_memory(request)
+        self.assertEqual(state.reserved_memory, request2.amount)
+        # released already
+        state.release_memory(request)
+        self.assertEqual(state.reserved_memory, request2.amount)
+        state.release_memory(request2)
+        self.assertEqual(state.reserved_memory, 0)
+        self.assertEqual(state.reservations, set())
+
+    def test_011_admission_refused(self):
+        state = self.system_state([
+            ('0', 4000*MB, None, 3100*MB, 1000*MB),
+            ('1', 3500*MB, 4000*MB, 3000*MB, 1000*MB),
+        ])
+        request = qubes.qmemman.MemoryRequest(2000*MB)
+        state.do_balloon_requests([request])
+        # not enough memory even after squeezing all the domains - rejected
+        # without touching them
+        self.assertFalse(request.result)
+        self.assertEqual(request.reason,
+                         qubes.qmemman_client.REASON_NO_MEMORY)
+        self.assertEqual(state.balloon_count, 0)
+        self.assertEqual(state.backend.memsets, 0)
+        self.assertEqual(state.reserved_memory, 0)
+        self.assertEqual(state.requests_failed,
+                         {qubes.qmemman_client.REASON_NO_MEMORY: 1})
+
+    def balance_with_headroom(self, total_memory, domains, request):
+        """
+        Balance memory after a recent request of *request* bytes, with
+        predictive headroom enabled.
+
+        :return: tuple (headroom, total memory assigned to the domains)
+        """
+        state = self.system_state(domains, total_memory)
+        state.HEADROOM_MAX = 1000*MB
+        if request:
+            state.request_history.append((state.backend.time(), request))
+        headroom = state.get_headroom()
+        self.low_on_memory = state.get_free_xen_memory() - headroom - \
+            state.XEN_FREE_MEM_LEFT < sum(
+                qubes.qmemman_algo.memory_needed(dom)
+                for dom in state.domdict.values())
+        state.do_balance()
+        return headroom, sum(dom.last_target for dom in state.domdict.values())
+
+    def test_020_headroom(self):
+        domains = [
+            ('0', 4000*MB, None, 1000*MB, 1000*MB),
+            ('1', 2000*MB, 4000*MB, 400*MB, 1000*MB),
+        ]
+        _, assigned = self.balance_with_headroom(8000*MB, domains, 0)
+        headroom, assigned_headroom = self.balance_with_headroom(8000*MB,
+            domains, 500*MB)
+        self.assertFalse(self.low_on_memory)
+        self.assertEqual(headroom, 500*MB)
+        # the headroom is not given to the domains
+        self.assertAlmostEqual(assigned - assigned_headroom, 0.999*headroom,
+                               delta=MB)
+        # limited by HEADROOM_MAX
+        headroom, _ = self.balance_with_headroom(8000*MB, domains, 2000*MB)
+        self.assertEqual(headroom, 1000*MB)
+
+    def test_021_headroom_low_on_memory(self):
+        domains = [
+            ('0', 4000*MB, None, 3500*MB, 1000*MB),
+            ('1', 2000*MB, 4000*MB, 1900*MB, 1000*MB),
+        ]
+        _, assigned = self.balance_with_headroom(7000*MB, domains, 0)
+        self.assertTrue(self.low_on_memory)
+        headroom, assigned_headroom = self.balance_with_headroom(7000*MB,
+            domains, 500*MB)
+        self.assertTrue(self.low_on_memory)
+        self.assertAlmostEqual(assigned - assigned_headroom, 0.999*headroom,
+                               delta=MB)
+
+    def test_022_headroom_expire(self):
+        state = self.system_state([
+            ('0', 4000*MB, None, 1000*MB, 1000*MB),
+        ])
+        state.HEADROOM_MAX = 1000*MB
+        state.request_history.append((state.backend.time(), 500*MB))
+        state.backend.advance(state.HEADROOM_WINDOW - 1)
+        self.assertEqual(state.get_headroom(), 500*MB)
+        state.backend.advance(2)
+        self.assertEqual(state.get_headroom(), 0)
+        # disabled
+        state.HEADROOM_MAX = 0
+        state.request_history.append((state.backend.time(), 500*MB))
+        self.assertEqual(state.get_headroom(), 0)
+
+    def test_023_headroom_history(self):
+        state = self.system_state([
+            ('0', 4000*MB, None, 1000*MB, 1000*MB),
+        ])
+        # disabled - not recorded at all
+        for i in range(10):
+            state.do_balloon_requests([qubes.qmemman.MemoryRequest(MB)])
+        self.assertEqual(len(state.request_history), 0)
+        # enabled - only the requests from the last HEADROOM_WINDOW kept,
+        # even if the headroom is not computed in the meantime
+        state.HEADROOM_MAX = 1000*MB
+        for i in range(10):
+            state.do_balloon_requests([qubes.qmemman.MemoryRequest(MB)])
+            state.backend.advance(state.HEADROOM_WINDOW / 4.0)
+        self.assertLessEqual(len(state.request_history), 5)
+
+
+class FakeClock(object):
+    """Replacement of time module, with time moved forward explicitly"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class FakeXsHandle(object):
+    """xenstore connection of XS_Watcher, with the content in a dict"""
+    def __init__(self):
+        self.keys = {}
+
+    def watch(self, path, token):
+        pass
+
+    def unwatch(self, path, token):
+        pass
+
+    def read(self, th, path):
+        return self.keys.get(path)
+
+
+class TC_20_QmemmanServer(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_20_QmemmanServer, self).setUp()
+        self.orig_system_state = qubes.qmemman_server.system_state
+        self.orig_time = qubes.qmemman_server.time
+        self.clock = FakeClock()
+        qubes.qmemman_server.time = self.clock
+        self.backend = qubes.qmemman_sim.SimulatorBackend(8000*MB, [
+            qubes.qmemman_sim.SimulatedDomain('0', 4000*MB,
+                meminfo_trace=[(0, 1000*MB)]),
+            qubes.qmemman_sim.SimulatedDomain('1', 2000*MB,
+                static_max=4000*MB, meminfo_trace=[(0, 400*MB)]),
+        ])
+        self.system_state = qubes.qmemman.SystemState(self.backend)
+        for id in self.backend.domains:
+            self.system_state.add_domain(id)
+        qubes.qmemman_server.system_state = self.system_state
+
+    def tearDown(self):
+        qubes.qmemman_server.system_state = self.orig_system_state
+        qubes.qmemman_server.time = self.orig_time
+        super(TC_20_QmemmanServer, self).tearDown()
+
+    def xs_watcher(self):
+        """XS_Watcher with balance passes recorded in self.balances - mem_used
+        of domain 1 seen by each of them"""
+        self.balances = []
+        self.system_state.do_balance = lambda: self.balances.append(
+            self.system_state.domdict['1'].mem_used)
+        return qubes.qmemman_server.XS_Watcher(FakeXsHandle())
+
+    def meminfo_update(self, watcher, used):
+        watcher.handle.keys[qubes.qmemman_server.get_domain_meminfo_key('1')] = \
+            qubes.qmemman_sim.SimulatedDomain('1', 2000*MB,
+                meminfo_trace=[(0, used)]).meminfo(0)
+        watcher.meminfo_changed('1')
+
+    def test_000_meminfo_coalescing(self):
+        watcher = self.xs_watcher()
+        for used in (500*MB, 600*MB, 700*MB):
+            self.meminfo_update(watcher, used)
+            self.clock.now += 0.05
+            watcher.balance_if_due()
+        self.assertEqual(self.balances, [])
+        self.clock.now += qubes.qmemman_server.MEMINFO_COALESCE_DELAY
+        watcher.balance_if_due()
+        # a single balance pass, with the last reported value
+        self.assertEqual(self.balances, [700*MB])
+        self.clock.now += qubes.qmemman_server.MEMINFO_COALESCE_DELAY
+        watcher.balance_if_due()
+        self.assertEqual(self.balances, [700*MB])
+        self.assertEqual(watcher.get_stats()['meminfo_events'], 3)
+        self.assertEqual(watcher.get_stats()['meminfo_balances'], 1)
+
+    def test_001_meminfo_coalescing_max_delay(self):
+        watcher = self.xs_watcher()
+        # updates every 0.1s for 1.5s - never a pause long enough, but memory
+        # is balanced MEMINFO_MAX_DELAY after the first update
+        for i in range(15):
+            self.meminfo_update(watcher, (500 + i)*MB)
+            self.clock.now += 0.1
+            watcher.balance_if_due()
+        self.assertEqual(len(self.balances), 1)
+        self.assertIsNotNone(watcher.balance_due_time())
+
+
+class TC_21_QmemmanProtocol(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_21_QmemmanProtocol, self).setUp()
+        self.orig_system_state = qubes.qmemman_server.system_state
+        self.orig_force_refresh = \
+            qubes.qmemman_server.force_refresh_domain_list
+        self.orig_sock_path = qubes.qmemman_client.SOCK_PATH
+        backend = qubes.qmemman_sim.SimulatorBackend(8000*MB, [
+            qubes.qmemman_sim.SimulatedDomain('0', 4000*MB,
+                meminfo_trace=[(0, 1000*MB)]),
+            qubes.qmemman_sim.SimulatedDomain('1', 2000*MB,
+                static_max=4000*MB, meminfo_trace=[(0, 400*MB)]),
+        ])
+        self.system_state = qubes.qmemman.SystemState(backend)
+        for id in backend.domains:
+            self.system_state.add_domain(id)
+        for id, meminfo in backend.changed_meminfo():
+            self.system_state.update_meminfo(id, meminfo)
+        self.system_state.refresh_memactual()
+        qubes.qmemman_server.system_state = self.system_state
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        qubes.qmemman_server.system_state = self.orig_system_state
+        qubes.qmemman_server.force_refresh_domain_list = \
+            self.orig_force_refresh
+        qubes.qmemman_client.SOCK_PATH = self.orig_sock_path
+        del qubes.qmemman_server.pending_requests[:]
+        shutil.rmtree(self.tmpdir)
+        super(TC_21_QmemmanProtocol, self).tearDown()
+
+    def converse(self, data):
+        """
+        Send *data* to a request handler and disconnect.
+
+        :return: list of lines sent back by the handler
+        """
+        client_sock, server_sock = socket.socketpair()
+        try:
+            client_sock.sendall(data)
+            client_sock.shutdown(socket.SHUT_WR)
+            # handles the whole connection, up to EOF
+            qubes.qmemman_server.QMemmanReqHandler(server_sock, None, None)
+            server_sock.close()
+            response = ''
+            while True:
+                chunk = client_sock.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+        finally:
+            client_sock.close()
+            server_sock.close()
+        return response.splitlines()
+
+    def serve_once(self, response):
+        """
+        Listen on a temporary qmemman socket and answer a single
+        connection with *response*, regardless of what the client sends.
+        """
+        qubes.qmemman_client.SOCK_PATH = os.path.join(self.tmpdir,
+            'qmemman.sock')
+        listen_sock = socket.socket(socket.AF_UNIX)
+        listen_sock.bind(qubes.qmemman_client.SOCK_PATH)
+        listen_sock.listen(1)
+
+        def serve():
+            sock, _ = listen_sock.accept()
+            sock.recv(1024)
+            sock.sendall(response)
+            sock.shutdown(socket.SHUT_WR)
+            # wait for the client to disconnect
+            while sock.recv(1024):
+                pass
+            sock.close()
+            listen_sock.close()
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_000_hello(self):
+        self.assertEqual(self.converse('HELLO 2\n1 QUERY\n'),
+            ['HELLO 2', '1 OK ' + json.dumps({
+                'free_memory': self.system_state.get_free_xen_memory(),
+                'available_memory': int(
+                    self.system_state.get_free_xen_memory() -
+                    self.system_state.XEN_FREE_MEM_LEFT +
+                    qubes.qmemman_algo.available_memory(
+                        self.system_state.domdict)),
+                'reserved_memory': 0,
+                'reservations': 0,
+            })])
+        # a newer client gets the version supported by the server
+        self.assertEqual(self.converse('HELLO 3\n'), ['HELLO 2'])
+
+    def test_001_hello_invalid(self):
+        for hello in ('HELO 2', 'HELLO 1', 'HELLO x', 'HELLO 2 3', 'HELLO',
+                      '', '1 RESERVE 1000'):
+            self.assertEqual(self.converse(hello + '\n1 QUERY\n'), [],
+                             'response to {!r}'.format(hello))
+        # disconnected without any request
+        self.assertEqual(self.converse(''), [])
+
+    def test_002_requests_invalid(self):
+        self.assertEqual(self.converse(
+            'HELLO 2\n'
+            '1\n'
+            '2 UNKNOWN\n'
+            '3 RESERVE\n'
+            '4 RESERVE x\n'
+            '5 RESERVE 1 2\n'
+            '6 RELEASE\n'
+            '7 RELEASE 1\n'
+            '\n'
+            '8 query\n'),
+            ['HELLO 2',
+             '1 FAIL bad-request',
+             '2 FAIL unknown-command',
+             '3 FAIL bad-request',
+             '4 FAIL bad-request',
+             '5 FAIL bad-request',
+             '6 FAIL bad-request',
+             '7 FAIL unknown-reservation',
+             '8 FAIL unknown-command'])
+
+    def test_003_reserve_release(self):
+        self.assertEqual(self.converse(
+            'HELLO 2\n'
+            '1 RESERVE {}\n'
+            '2 RESERVE {}\n'
+            '3 RESERVE 1\n'
+            '1 RESERVE 1\n'
+            '4 RELEASE 1\n'
+            '5 RELEASE 1\n'
+            '6 RESERVE {}\n'.format(500*MB, 300*MB, 100000*MB)),
+            ['HELLO 2',
+             '1 OK',
+             '2 OK',
+             '3 OK',
+             '1 FAIL bad-request',
+             '4 OK',
+             '5 FAIL unknown-reservation',
+             '6 FAIL no-memory'])
+        # not released explicitly - released on disconnect
+        self.assertEqual(self.system_state.reservations, set())
+        self.assertEqual(self.system_state.reserved_memory, 0)
+
+    def test_004_reserve_internal_error(self):
+        def do_balloon_requests(requests):
+            raise RuntimeError('test')
+        self.system_state.do_balloon_requests = do_balloon_requests
+        self.assertEqual(self.converse('HELLO 2\n1 RESERVE 1000\n'),
+                         ['HELLO 2', '1 FAIL internal-error'])
+        self.assertEqual(self.converse('1000\n'), ['FAIL'])
+
+    def test_005_batch_internal_error(self):
+        # queued by another thread, while this one was waiting for
+        # global_lock - handled (and failed) together with its request
+        other_request = qubes.qmemman.MemoryRequest(1000*MB)
+        qubes.qmemman_server.pending_requests.append(other_request)
+        handled = []
+        def do_balloon_requests(requests):
+            handled.extend(requests)
+            raise RuntimeError('test')
+        self.system_state.do_balloon_requests = do_balloon_requests
+        request = qubes.qmemman.MemoryRequest(1000*MB)
+        qubes.qmemman_server.request_memory([request])
+        self.assertEqual(handled, [other_request, request])
+        for rq in (request, other_request):
+            self.assertIs(rq.result, False)
+            self.assertEqual(rq.reason,
+                             qubes.qmemman_client.REASON_INTERNAL_ERROR)
+        # not handled again by the other thread
+        self.assertEqual(qubes.qmemman_server.pending_requests, [])
+
+    def test_010_v1(self):
+        self.assertEqual(self.converse('{}\n'.format(500*MB)), ['OK'])
+        self.assertEqual(self.converse('{}\n'.format(100000*MB)), ['FAIL'])
+        self.assertEqual(self.system_state.reservations, set())
+        self.assertEqual(self.system_state.reserved_memory, 0)
+
+    def test_020_client_wait(self):
+        client = qubes.qmemman_client.QMemmanClient()
+        client.sock, server_sock = socket.socketpair()
+        try:
+            server_sock.sendall('2 OK {"a": 1}\n'
+                                '1 FAIL no-memory some details\n'
+                                '3 OK\n'
+                                'invalid\n')
+            # out of order responses
+            self.assertEqual(client.wait('1'), (False, 'no-memory'))
+            self.assertEqual(client.wait('3'), (True, ''))
+            self.assertEqual(client.wait('2'), (True, '{"a": 1}'))
+            with self.assertRaises(IOError):
+                client.wait('4')
+            server_sock.close()
+            with self.assertRaises(IOError):
+                client.wait('4')
+        finally:
+            client.close()
+            server_sock.close()
+
+    def test_021_client_connect_unsupported(self):
+        # v1 server fails to parse the hello and disconnects, a malformed
+        # or an old version one responds with something else than our hello
+        for response in ('', 'FAIL\n', 'HELLO 1\n', 'HELLO\n', 'HELLO 2 3\n'):
+            thread = self.serve_once(response)
+            client = qubes.qmemman_client.QMemmanClient()
+            with self.assertRaises(IOError):
+                client.connect()
+            self.assertIsNone(client.sock)
+            thread.join()
+            os.unlink(qubes.qmemman_client.SOCK_PATH)
+
+    def test_022_client_connect(self):
+        thread = self.serve_once('HELLO 2\n1 OK\n')
+        client = qubes.qmemman_client.QMemmanClient()
+        try:
+            self.assertTrue(client.request_memory(500*MB))
+        finally:
+            client.close()
+        thread.join()